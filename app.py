@@ -1,23 +1,48 @@
+import logging
 import os
+import json
+import time
+import asyncio
 import tempfile
 import uvicorn
-from fastapi import FastAPI, UploadFile, File, Request
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, UploadFile, File, Request, HTTPException
+from fastapi.responses import HTMLResponse, StreamingResponse, PlainTextResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from pydantic import BaseModel
 from fastapi import Form
-from typing import List, Dict, Optional, Annotated
+from typing import Any, Callable, List, Dict, Optional, Annotated, Tuple
 import shutil
 from dotenv import load_dotenv
 
 from pdf_processor import PDFProcessor
-from embeddings import EmbeddingGenerator
-from vector_db import VectorDB
+from embeddings import EmbeddingGenerator, QueryEmbeddingBatcher
+from embedding_cache import EmbeddingCache
+from cache import TTLCache
+from lexical_index import reciprocal_rank_fusion
 from llm_module import LLMModule
+from context_packer import ContextPacker
+from reranker import CrossEncoderReranker
+from ingest import IngestPipeline
+from jobs import IngestJobQueue, JobQueueFull
+from workspaces import Workspace, WorkspaceManager, WorkspaceLimitExceeded, open_storage
+from model_service import ModelServiceClient
+from metrics import REGISTRY, Histogram, StageTimer
+from warmup import WarmUp
 
 # Load environment variables from config.env
 load_dotenv("config.env")
 
+# Leveled logging for every module; LOG_LEVEL=OFF turns it off entirely
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(
+    level=logging.INFO if LOG_LEVEL == "OFF" else LOG_LEVEL,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+if LOG_LEVEL == "OFF":
+    logging.disable(logging.CRITICAL)
+logger = logging.getLogger(__name__)
+
 # Create directories
 os.makedirs("./uploads", exist_ok=True)
 os.makedirs("./static", exist_ok=True)
@@ -26,243 +51,912 @@ os.makedirs("./templates", exist_ok=True)
 # Initialize FastAPI app
 app = FastAPI(title="PDF Question Answering System")
 
+# Latency histograms exposed on /metrics
+HTTP_REQUEST_SECONDS = Histogram(
+    "rag_http_request_seconds", "HTTP request latency by route", ["method", "route", "status"]
+)
+ASK_STAGE_SECONDS = Histogram(
+    "rag_ask_stage_seconds", "Time spent answering questions, by stage (embed, retrieve, filter, generate)",
+    ["endpoint", "stage"]
+)
+ASK_SECONDS = Histogram("rag_ask_seconds", "End-to-end question answering latency", ["endpoint"])
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    """Record the latency of every request, labelled by route template rather than raw path"""
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - start,
+        method=request.method,
+        route=getattr(route, "path", "unmatched"),
+        status=response.status_code
+    )
+    return response
+
 # Initialize templates
 templates = Jinja2Templates(directory="templates")
 
-# Initialize components
+# Initialize components. Models and indexes are loaded on first use, so importing
+# the app is fast; see warm_up below for loading them ahead of the first request.
 pdf_processor = PDFProcessor(chunk_size=1000, chunk_overlap=200)
-embedding_generator = EmbeddingGenerator()
-vector_db = VectorDB(persist_directory="./chroma_db")
+
+# With MODEL_SERVICE_ADDRESS set, the embedding model and every workspace's vector DB
+# and catalog live in one model service process (python model_service.py) shared by
+# all uvicorn workers, instead of being loaded in each of them
+model_service = ModelServiceClient() if os.getenv("MODEL_SERVICE_ADDRESS") else None
+if model_service is not None:
+    # The service keeps the embedding cache
+    embedding_cache = None
+    embedding_generator = model_service.embedding_generator()
+else:
+    # Persistent cache so unchanged chunks are not re-encoded on re-upload
+    embedding_cache = EmbeddingCache() if os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true" else None
+    embedding_generator = EmbeddingGenerator(cache=embedding_cache)
+
+# Each workspace has its own vector DB, document catalog and answer cache, loaded
+# on first use and evicted when idle. The default workspace lives in ./chroma_db.
+workspaces = WorkspaceManager(
+    default_directory="./chroma_db",
+    storage=model_service.open_storage if model_service is not None else open_storage
+)
+
+# Batch query embeddings across concurrent /ask requests
+query_batcher = QueryEmbeddingBatcher(embedding_generator)
+
+# Query embeddings only depend on the question, so this cache is shared by all
+# workspaces; answers are cached per workspace and dropped when its corpus changes
+query_embedding_cache = TTLCache(
+    max_size=int(os.getenv("QUERY_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("QUERY_CACHE_TTL", "3600"))
+)
+
+# Retrieval strategies for /ask: dense vectors, BM25 keywords, or both fused by reciprocal rank
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid")
+DEFAULT_RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid").lower()
+HYBRID_CANDIDATE_FACTOR = int(os.getenv("HYBRID_CANDIDATE_FACTOR", "2"))
+
+# Optional cross-encoder pass over over-fetched candidates that keeps only relevant chunks
+reranker = CrossEncoderReranker() if os.getenv("RERANK_ENABLED", "false").lower() == "true" else None
+
+def normalize_question(question: str) -> str:
+    """Collapse whitespace so trivially different questions share cache entries"""
+    return " ".join(question.split())
 
 # Initialize LLM with model from environment variable or use default
 model_name = os.getenv("GEMINI_MODEL", "gemini-1.5-pro")
-llm = LLMModule(model_name=model_name)
+llm = LLMModule(model_name=model_name, context_packer=ContextPacker(chunk_overlap=pdf_processor.chunk_overlap))
+
+# Run PDF parsing, embedding and vector DB writes off the event loop. The pipeline
+# is shared; every upload is written to its workspace's vector DB and catalog.
+ingest_pipeline = IngestPipeline(pdf_processor, embedding_generator, None)
 
-# Track uploaded files
-uploaded_files = {}
+# Load the models and the default workspace in the background once the server is
+# up, so the port is bound right away; /ready answers 503 until this has finished
+warm_up = WarmUp()
+if os.getenv("WARMUP_ON_STARTUP", "true").lower() == "true":
+    # A dummy encode also initializes the parts of the model that are set up lazily
+    warmup_encode = os.getenv("WARMUP_ENCODE", "true").lower() == "true"
+    warm_up.add("embedding_model", lambda: embedding_generator.warm_up(encode=warmup_encode))
+    if reranker is not None:
+        warm_up.add("reranker", lambda: reranker.warm_up(encode=warmup_encode))
+    warm_up.add("llm", llm.warm_up)
+    warm_up.add("default_workspace", lambda: workspaces.get(None))
 
 # For handling file paths properly
 import pathlib
 
+async def run_blocking(func: Callable, *args) -> Any:
+    """
+    Run a call into a workspace's storage on a worker thread
+    
+    Vector DB, catalog and lexical index calls block, on disk or on the model
+    service's socket, so async handlers never make them on the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+async def open_workspace(name: Optional[str]) -> Workspace:
+    """
+    Load the requested workspace and count a request against its limits
+    
+    Every successful call must be paired with workspace.end_request().
+    """
+    try:
+        return await workspaces.abegin_request(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except WorkspaceLimitExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+async def get_workspace(name: Optional[str]) -> Workspace:
+    """
+    Load and pin the requested workspace for a quick read that needs no request slot
+    
+    The pin keeps the workspace from being evicted and closed while it is
+    read; every successful call must be paired with workspace.unpin().
+    """
+    try:
+        return await workspaces.aget(name, pin=True)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/", response_class=HTMLResponse)
-async def index(request: Request):
+async def index(request: Request, workspace: Optional[str] = None):
     """Render the main page"""
+    current = await get_workspace(workspace)
+    try:
+        uploaded_files = await run_blocking(current.registry.sources)
+    finally:
+        current.unpin()
     return templates.TemplateResponse(
         "index.html",
-        {"request": request, "uploaded_files": list(uploaded_files.keys())}
+        {"request": request, "uploaded_files": uploaded_files, "workspace": current.name}
     )
 
+# Background ingestion queue feeding the pipeline; documents are catalogued by the pipeline
+ingest_queue = IngestJobQueue(ingest_pipeline)
+
+@app.on_event("startup")
+async def start_ingest_queue():
+    """Start the background ingestion workers"""
+    await ingest_queue.start()
+
+@app.on_event("startup")
+async def start_warm_up():
+    """Start loading components in the background without delaying startup"""
+    warm_up.start()
+
 @app.post("/upload")
-async def upload_pdf(files: Annotated[List[UploadFile], File()]):
+async def upload_pdf(
+    files: Annotated[List[UploadFile], File()],
+    wait: Annotated[bool, Form()] = False,
+    workspace: Annotated[Optional[str], Form()] = None
+):
     """
-    Upload one or more PDF files, process them, and add to the vector database
+    Upload one or more PDF files into a workspace and queue them for processing
+    
+    Returns one job per file right away; poll /jobs/{job_id} for progress.
+    With wait=true the response is sent once every file has been processed
+    and includes the ingestion throughput. Uploads are rejected once the
+    workspace has reached its chunk quota (WORKSPACE_MAX_CHUNKS), and a file
+    whose chunks would take it over the quota fails its job.
     """
-    print(f"Received {len(files)} files for upload")
+    current = await open_workspace(workspace)
+    try:
+        return await save_and_queue_uploads(current, files, wait)
+    finally:
+        current.end_request()
+
+async def save_and_queue_uploads(workspace: Workspace, files: List[UploadFile], wait: bool) -> List[Dict]:
+    logger.info(f"Received {len(files)} files for upload to workspace '{workspace.name}'")
+    
+    try:
+        await run_blocking(workspace.check_chunk_quota)
+    except WorkspaceLimitExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    
+    # Reject the whole batch up front rather than queueing part of it
+    if ingest_queue.free_slots() < len(files):
+        raise HTTPException(
+            status_code=429,
+            detail="Ingestion queue is full, please retry later."
+        )
+    
     results = []
+    saved_files = []
     
     for file in files:
-        # Save file temporarily
+        # Save file temporarily; the job removes it once processed
         temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
         temp_file_path = temp_file.name
         temp_file.close()  # Close the file handle immediately
         
         try:
-            print(f"Processing file: {file.filename}")
             contents = await file.read()
             with open(temp_file_path, "wb") as f:
                 f.write(contents)
             
-            print(f"Saved {len(contents)} bytes to temporary file: {temp_file_path}")
-            
-            # Process PDF
-            chunks, _ = pdf_processor.process_pdf(temp_file_path)
-            
-            if not chunks:
-                print(f"WARNING: No chunks were created for {file.filename}")
-                results.append({
-                    "filename": file.filename,
-                    "status": "warning",
-                    "error": "No text content could be extracted from this PDF.",
-                    "num_chunks": 0
-                })
-                continue
-                
-            print(f"Generated {len(chunks)} chunks for {file.filename}")
-            
-            # Generate embeddings for chunks
-            chunks_with_embeddings = embedding_generator.process_chunks(chunks)
-            
-            # Add to vector DB
-            vector_db.add_chunks(chunks_with_embeddings)
-            
-            # Store the original filename for lookup
-            file_key = file.filename
-            
-            # Track the file - IMPORTANT: Use the exact raw filename for storage
-            # This ensures the source filter will match exactly
-            source_name = file.filename
-            
-            # Add to our tracked files dictionary
-            uploaded_files[file_key] = {
-                "filename": file.filename,
-                "source_name": source_name,
-                "num_chunks": len(chunks)
-            }
-            
-            # Add a success message 
-            results.append({
-                "filename": file.filename,
-                "status": "success",
-                "num_chunks": len(chunks),
-                "source_name": source_name  # Include the source name in response
-            })
-            print(f"Successfully processed {file.filename} with {len(chunks)} chunks")
-            print(f"Source name for filtering: {source_name}")
+            logger.debug(f"Saved {len(contents)} bytes to temporary file: {temp_file_path}")
+            saved_files.append((file.filename, temp_file_path))
             
         except Exception as e:
-            print(f"Error processing {file.filename}: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.error(f"Error saving {file.filename}: {str(e)}")
+            if os.path.exists(temp_file_path):
+                os.unlink(temp_file_path)
             
             results.append({
                 "filename": file.filename,
                 "status": "error",
                 "error": str(e)
             })
-        finally:
-            try:
-                if os.path.exists(temp_file_path):
-                    os.unlink(temp_file_path)
-            except Exception as e:
-                print(f"Warning: Could not delete temporary file {temp_file_path}: {str(e)}")
     
-    print(f"Uploaded files: {list(uploaded_files.keys())}")
+    if not saved_files:
+        return results
+    
+    try:
+        jobs = ingest_queue.submit(saved_files, workspace=workspace)
+    except JobQueueFull as e:
+        for _, temp_file_path in saved_files:
+            os.unlink(temp_file_path)
+        raise HTTPException(status_code=429, detail=str(e))
+    
+    if wait:
+        await asyncio.gather(*(job.wait() for job in jobs))
+        results.extend(job.to_dict() for job in jobs)
+        return results
+    
+    results.extend({
+        "filename": job.filename,
+        "status": "queued",
+        "job_id": job.job_id
+    } for job in jobs)
     return results
 
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, workspace: Optional[str] = None):
+    """Report the stage, chunk count and timings of an ingestion job"""
+    try:
+        workspace_name = workspaces.resolve_name(workspace)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    job = ingest_queue.get(job_id)
+    # Jobs of other workspaces are not visible
+    if job is None or job.workspace_name != workspace_name:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job.to_dict()
+
+NO_DOCUMENTS_ANSWER = "Please upload some PDF documents first."
+NO_RESULTS_ANSWER = "No relevant information found in the uploaded documents. Try uploading more PDFs or rephrasing your question."
+
+def resolve_source_filter(workspace: Workspace, source_file: Optional[str]) -> Optional[str]:
+    """Map the requested source file to the source stored on its chunks (None for no filter)"""
+    if not source_file:
+        return None
+    
+    logger.debug(f"Filtering by source: {source_file}")
+    # Chunks are stored under the exact uploaded filename, so the
+    # catalog entry for it is the source filter to use
+    if workspace.registry.get(source_file) is not None:
+        logger.debug(f"Found matching file, using source: {source_file}")
+        return source_file
+    
+    logger.warning(f"Source file {source_file} not found in uploaded files. Available files: {workspace.registry.sources()}")
+    logger.debug("Will search without source filter")
+    return None
+
+def resolve_retrieval_mode(workspace: Workspace, retrieval_mode: Optional[str]) -> str:
+    """Validate the requested retrieval mode, falling back to RETRIEVAL_MODE"""
+    mode = (retrieval_mode or DEFAULT_RETRIEVAL_MODE).lower()
+    if mode not in RETRIEVAL_MODES:
+        raise HTTPException(status_code=400, detail=f"retrieval_mode must be one of {list(RETRIEVAL_MODES)}")
+    if mode != "vector" and workspace.vector_db.lexical_index is None:
+        logger.info(f"Lexical index is disabled, using vector retrieval instead of {mode}")
+        return "vector"
+    return mode
+
+def answer_cache_key(
+    workspace: Workspace,
+    question: str,
+    actual_source: Optional[str],
+    num_results: int,
+    retrieval_mode: str
+) -> tuple:
+    """Key in the workspace's answer cache; includes the corpus version so any write invalidates it"""
+    return (normalize_question(question).lower(), actual_source, num_results, retrieval_mode, workspace.vector_db.version)
+
+def prepare_question(
+    workspace: Workspace,
+    question: str,
+    source_file: Optional[str],
+    num_results: int,
+    retrieval_mode: str
+) -> Tuple[bool, Optional[str], Optional[tuple]]:
+    """
+    Catalog lookups made before answering a question; blocking, see run_blocking
+    
+    Returns:
+        Tuple of (whether the workspace has documents, source filter, answer cache key)
+    """
+    if not len(workspace.registry):
+        return False, None, None
+    actual_source = resolve_source_filter(workspace, source_file)
+    return True, actual_source, answer_cache_key(workspace, question, actual_source, num_results, retrieval_mode)
+
+def candidate_count(num_results: int, retrieval_mode: str) -> int:
+    """Chunks to take from each retriever; hybrid over-fetches so fusion has something to re-order"""
+    return num_results * HYBRID_CANDIDATE_FACTOR if retrieval_mode == "hybrid" else num_results
+
+def select_chunks(
+    workspace: Workspace,
+    question: str,
+    retrieval_mode: str,
+    actual_source: Optional[str],
+    num_results: int,
+    vector_hits: Optional[Dict[str, List]] = None
+) -> Tuple[List[str], List[str], List[Dict]]:
+    """
+    Combine vector DB hits with BM25 hits according to the retrieval mode
+    
+    Args:
+        vector_hits: ids, documents and metadatas of one vector DB query (unused in lexical mode)
+        
+    Returns:
+        Tuple of (ids, documents, metadatas) of the selected chunks, best first
+    """
+    if retrieval_mode == "vector":
+        return (
+            vector_hits["ids"][:num_results],
+            vector_hits["documents"][:num_results],
+            vector_hits["metadatas"][:num_results]
+        )
+    
+    lexical_ids = [
+        chunk_id for chunk_id, _ in workspace.vector_db.lexical_index.search(
+            question, n_results=candidate_count(num_results, retrieval_mode), filter_source=actual_source
+        )
+    ]
+    logger.debug(f"Keyword search found {len(lexical_ids)} chunks")
+    if retrieval_mode == "lexical":
+        ranked_ids = lexical_ids[:num_results]
+    else:
+        ranked_ids = reciprocal_rank_fusion([vector_hits["ids"], lexical_ids])[:num_results]
+    
+    # Keyword-only hits still need their text from the vector DB
+    known = {}
+    if vector_hits:
+        known = {
+            chunk_id: (document, metadata)
+            for chunk_id, document, metadata in zip(vector_hits["ids"], vector_hits["documents"], vector_hits["metadatas"])
+        }
+    for chunk in workspace.vector_db.get_chunks([chunk_id for chunk_id in ranked_ids if chunk_id not in known]):
+        known[chunk["id"]] = (chunk["text"], chunk["metadata"])
+    
+    selected_ids = [chunk_id for chunk_id in ranked_ids if chunk_id in known]
+    return (
+        selected_ids,
+        [known[chunk_id][0] for chunk_id in selected_ids],
+        [known[chunk_id][1] for chunk_id in selected_ids]
+    )
+
+def retrieval_count(num_results: int) -> int:
+    """Chunks to select before re-ranking; over-fetched when the re-ranker is enabled"""
+    return reranker.candidate_count(num_results) if reranker is not None else num_results
+
+async def rerank_chunks(
+    question: str,
+    ids: List[str],
+    documents: List[str],
+    metadatas: List[Dict],
+    num_results: int,
+    started_at: Optional[float] = None
+) -> Tuple[List[str], List[Dict]]:
+    """Keep the num_results most relevant selected chunks, by cross-encoder score when enabled"""
+    if reranker is None:
+        return documents[:num_results], metadatas[:num_results]
+    return await reranker.rerank(question, ids, documents, metadatas, num_results, started_at)
+
+async def retrieve_contexts(
+    workspace: Workspace,
+    question: str,
+    actual_source: Optional[str],
+    num_results: int,
+    retrieval_mode: str = "vector",
+    timer: Optional[StageTimer] = None
+) -> Tuple[List[str], List[str], int]:
+    """
+    Retrieve chunks for the question and select the contexts for the LLM
+    
+    Vector modes embed the question and query the vector DB; lexical modes
+    rank chunks by BM25; hybrid fuses both rankings. With the re-ranker
+    enabled, more candidates are retrieved and re-scored against the question.
+    
+    Args:
+        timer: StageTimer of the request; the embed, retrieve and filter stages are
+            added to it and its start time bounds the re-ranking latency budget
+        
+    Returns:
+        Tuple of (contexts, unique sources, number of chunks retrieved)
+    """
+    timer = timer or StageTimer()
+    query_embedding = None
+    if retrieval_mode != "lexical":
+        # Generate query embedding, batched with concurrent requests
+        with timer.stage("embed"):
+            embedding_key = normalize_question(question)
+            query_embedding = query_embedding_cache.get(embedding_key)
+            if query_embedding is None:
+                logger.debug("Generating query embedding...")
+                query_embedding = await query_batcher.embed(question)
+                query_embedding_cache.put(embedding_key, query_embedding)
+    
+    with timer.stage("retrieve"):
+        ids, documents, metadatas = await run_blocking(
+            search_chunks, workspace, question, retrieval_mode, actual_source, num_results, query_embedding
+        )
+    
+    with timer.stage("filter"):
+        documents, metadatas = await rerank_chunks(question, ids, documents, metadatas, num_results, timer.started_at)
+        return build_contexts(question, documents, metadatas)
+
+def search_chunks(
+    workspace: Workspace,
+    question: str,
+    retrieval_mode: str,
+    actual_source: Optional[str],
+    num_results: int,
+    query_embedding: Optional[List[float]]
+) -> Tuple[List[str], List[str], List[Dict]]:
+    """Query the vector DB (except in lexical mode) and select the chunks; blocking, see run_blocking"""
+    vector_hits = None
+    if retrieval_mode != "lexical":
+        # Query vector DB
+        logger.debug("Querying vector database...")
+        
+        results = workspace.vector_db.query(
+            query_embedding=query_embedding,
+            n_results=candidate_count(retrieval_count(num_results), retrieval_mode),
+            filter_source=actual_source
+        )
+        vector_hits = {
+            "ids": results.get('ids', [[]])[0],
+            "documents": results.get('documents', [[]])[0],
+            "metadatas": results.get('metadatas', [[]])[0]
+        }
+    
+    return select_chunks(workspace, question, retrieval_mode, actual_source, retrieval_count(num_results), vector_hits)
+
+def build_contexts(question: str, documents: List[str], metadatas: List[Dict]) -> Tuple[List[str], List[str], int]:
+    """
+    Select the contexts for the LLM from the retrieved chunks
+    
+    Returns:
+        Tuple of (contexts, unique sources, number of chunks retrieved)
+    """
+    logger.debug(f"Found {len(documents)} document chunks")
+    
+    if metadatas and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Sources of retrieved chunks: {[meta.get('source') for meta in metadatas]}")
+    
+    if not documents:
+        return [], [], 0
+    
+    # Filter relevant contexts
+    logger.debug("Filtering relevant contexts...")
+    contexts = llm.filter_relevant_contexts(question, [
+        {"document": doc, "metadata": metadata}
+        for doc, metadata in zip(documents, metadatas)
+    ])
+    
+    logger.debug(f"Using {len(contexts)} contexts to generate answer")
+    if contexts:
+        logger.debug(f"First context sample: {contexts[0][:100]}...")
+    
+    # Calculate sources
+    sources = [metadata["source"] for metadata in metadatas]
+    unique_sources = list(set(sources))
+    
+    return contexts, unique_sources, len(documents)
+
 @app.post("/ask")
 async def ask_question(
     question: Annotated[str, Form()],
     source_file: Annotated[Optional[str], Form()] = None,
-    num_results: Annotated[int, Form()] = 5
+    num_results: Annotated[int, Form()] = 5,
+    retrieval_mode: Annotated[Optional[str], Form()] = None,
+    workspace: Annotated[Optional[str], Form()] = None,
+    include_timings: Annotated[bool, Form()] = False
 ):
     """
-    Answer a question based on the uploaded PDFs
+    Answer a question based on the PDFs uploaded to a workspace
+    
+    With include_timings, the response also has the per-stage "timings" in milliseconds.
     """
+    timer = StageTimer()
+    current = await open_workspace(workspace)
+    try:
+        response = await answer_question(current, question, source_file, num_results, retrieval_mode, timer)
+    finally:
+        current.end_request()
+    
+    timer.observe(ASK_STAGE_SECONDS, endpoint="ask")
+    ASK_SECONDS.observe(timer.elapsed(), endpoint="ask")
+    if include_timings:
+        response["timings"] = timer.as_ms()
+    return response
+
+async def answer_question(
+    workspace: Workspace,
+    question: str,
+    source_file: Optional[str],
+    num_results: int,
+    retrieval_mode: Optional[str],
+    timer: Optional[StageTimer] = None
+) -> Dict:
+    timer = timer or StageTimer()
+    retrieval_mode = resolve_retrieval_mode(workspace, retrieval_mode)
     try:
-        print(f"Processing question: {question}")
-        print(f"Source file filter: {source_file}")
-        print(f"Number of results: {num_results}")
+        logger.debug(f"Processing question in workspace '{workspace.name}': {question}")
+        logger.debug(f"Source file filter: {source_file}")
+        logger.debug(f"Number of results: {num_results}")
+        logger.debug(f"Retrieval mode: {retrieval_mode}")
         
-        if not uploaded_files:
+        has_documents, actual_source, answer_key = await run_blocking(
+            prepare_question, workspace, question, source_file, num_results, retrieval_mode
+        )
+        if not has_documents:
             return {
-                "answer": "Please upload some PDF documents first.",
+                "answer": NO_DOCUMENTS_ANSWER,
                 "sources": [],
                 "num_chunks_used": 0
             }
         
-        # Generate query embedding
-        print("Generating query embedding...")
-        query_embedding = embedding_generator.generate_embeddings(question)
-        print(f"Embedding shape: {type(query_embedding)}")
-        
-        # Fix embedding format - ensure it's a single list of numbers
-        if hasattr(query_embedding, 'cpu'):
-            # Convert tensor to numpy and then to list
-            query_embedding = query_embedding.cpu().numpy()
-            # If it's a batch of embeddings (2D array), take the first one
-            if len(query_embedding.shape) > 1 and query_embedding.shape[0] == 1:
-                query_embedding = query_embedding[0]
-            # Convert to list
-            query_embedding = query_embedding.tolist()
-        
-        # Query vector DB
-        print("Querying vector database...")
-        print(f"Available files: {list(uploaded_files.keys())}")
-        
-        # Debug source file filtering
-        if source_file:
-            print(f"Filtering by source: {source_file}")
-            # Check if the source file is in the uploaded files
-            
-            # Try to find the source_file in uploaded_files
-            found = False
-            actual_source = source_file
-            
-            for key, info in uploaded_files.items():
-                if key == source_file or info.get("filename") == source_file:
-                    found = True
-                    actual_source = info.get("source_name", source_file)
-                    print(f"Found matching file: {key}, using source: {actual_source}")
-                    break
-                    
-            if not found:
-                print(f"WARNING: Source file {source_file} not found in uploaded files. Available files: {list(uploaded_files.keys())}")
-                print("Will search without source filter")
-                actual_source = None
-        else:
-            actual_source = None
+        # Serve repeated questions against an unchanged corpus from the cache
+        cached_response = workspace.answer_cache.get(answer_key)
+        if cached_response is not None:
+            logger.debug("Answer served from cache")
+            return dict(cached_response)
         
-        results = vector_db.query(
-            query_embedding=query_embedding,
-            n_results=num_results,
-            filter_source=actual_source
+        contexts, unique_sources, num_chunks = await retrieve_contexts(
+            workspace, question, actual_source, num_results, retrieval_mode, timer
         )
         
-        # Extract documents
-        documents = results.get('documents', [[]])[0]
-        metadatas = results.get('metadatas', [[]])[0]
-        print(f"Found {len(documents)} document chunks")
-        
-        if metadatas:
-            print(f"Sources of retrieved chunks: {[meta.get('source') for meta in metadatas]}")
-        
-        if not documents:
+        if not num_chunks:
             return {
-                "answer": "No relevant information found in the uploaded documents. Try uploading more PDFs or rephrasing your question.",
+                "answer": NO_RESULTS_ANSWER,
                 "sources": [],
                 "num_chunks_used": 0
             }
         
-        # Filter relevant contexts
-        print("Filtering relevant contexts...")
-        contexts = llm.filter_relevant_contexts(question, [
-            {"document": doc, "metadata": metadata}
-            for doc, metadata in zip(documents, metadatas)
-        ])
-        
-        print(f"Using {len(contexts)} contexts to generate answer")
-        if contexts:
-            print(f"First context sample: {contexts[0][:100]}...")
-        
         # Generate answer
-        print("Generating answer with LLM...")
-        answer = llm.generate_answer(question, contexts)
-        print(f"Generated answer: {answer}")
-        
-        # Calculate sources
-        sources = [metadata["source"] for metadata in metadatas]
-        unique_sources = list(set(sources))
+        logger.debug("Generating answer with LLM...")
+        with timer.stage("generate"):
+            answer = await llm.agenerate_answer(question, contexts)
+        logger.debug(f"Generated answer: {answer[:100]}...")
         
-        return {
+        response = {
             "answer": answer,
             "sources": unique_sources,
-            "num_chunks_used": len(documents)
+            "num_chunks_used": num_chunks
         }
+        workspace.answer_cache.put(answer_key, response)
+        return dict(response)
         
     except Exception as e:
-        print(f"Error in ask_question: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error in ask_question: {str(e)}")
         return {
             "answer": f"Error: {str(e)}",
             "sources": [],
             "num_chunks_used": 0
         }
 
+def sse_event(event: str, data: Dict) -> str:
+    """Format a Server-Sent Events message with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/ask/stream")
+async def ask_question_stream(
+    question: Annotated[str, Form()],
+    source_file: Annotated[Optional[str], Form()] = None,
+    num_results: Annotated[int, Form()] = 5,
+    retrieval_mode: Annotated[Optional[str], Form()] = None,
+    workspace: Annotated[Optional[str], Form()] = None,
+    include_timings: Annotated[bool, Form()] = False
+):
+    """
+    Answer a question as a stream of Server-Sent Events
+    
+    Emits a "sources" event once retrieval is done, "token" events as the
+    answer is generated and a final "done" event (or "error"), which carries
+    the per-stage "timings" with include_timings. The request counts against
+    the workspace's concurrency limit until the stream ends.
+    """
+    logger.debug(f"Processing streamed question: {question}")
+    timer = StageTimer()
+    
+    def done_event(num_chunks_used: int) -> str:
+        data = {"num_chunks_used": num_chunks_used}
+        if include_timings:
+            data["timings"] = timer.as_ms()
+        return sse_event("done", data)
+    
+    current = await open_workspace(workspace)
+    try:
+        retrieval_mode = resolve_retrieval_mode(current, retrieval_mode)
+    except Exception:
+        current.end_request()
+        raise
+    
+    async def events():
+        try:
+            has_documents, actual_source, answer_key = await run_blocking(
+                prepare_question, current, question, source_file, num_results, retrieval_mode
+            )
+            if not has_documents:
+                yield sse_event("sources", {"sources": [], "num_chunks_used": 0})
+                yield sse_event("token", {"text": NO_DOCUMENTS_ANSWER})
+                yield done_event(0)
+                return
+            
+            cached_response = current.answer_cache.get(answer_key)
+            if cached_response is not None:
+                logger.debug("Answer served from cache")
+                yield sse_event("sources", {"sources": cached_response["sources"], "num_chunks_used": cached_response["num_chunks_used"]})
+                yield sse_event("token", {"text": cached_response["answer"]})
+                yield done_event(cached_response["num_chunks_used"])
+                return
+            
+            contexts, unique_sources, num_chunks = await retrieve_contexts(
+                current, question, actual_source, num_results, retrieval_mode, timer
+            )
+            yield sse_event("sources", {"sources": unique_sources, "num_chunks_used": num_chunks})
+            
+            if not num_chunks:
+                yield sse_event("token", {"text": NO_RESULTS_ANSWER})
+                yield done_event(0)
+                return
+            
+            answer_parts = []
+            generate_start = time.perf_counter()
+            async for text in llm.astream_answer(question, contexts):
+                answer_parts.append(text)
+                yield sse_event("token", {"text": text})
+            timer.add("generate", time.perf_counter() - generate_start)
+            yield done_event(num_chunks)
+            
+            current.answer_cache.put(answer_key, {
+                "answer": "".join(answer_parts).strip(),
+                "sources": unique_sources,
+                "num_chunks_used": num_chunks
+            })
+        except Exception as e:
+            logger.exception(f"Error in ask_question_stream: {str(e)}")
+            yield sse_event("error", {"error": str(e)})
+        finally:
+            current.end_request()
+            timer.observe(ASK_STAGE_SECONDS, endpoint="ask_stream")
+            ASK_SECONDS.observe(timer.elapsed(), endpoint="ask_stream")
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+class BatchQuestion(BaseModel):
+    question: str
+    source_file: Optional[str] = None
+
+class BatchAskRequest(BaseModel):
+    questions: List[BatchQuestion]
+    num_results: int = 5
+    retrieval_mode: Optional[str] = None
+    workspace: Optional[str] = None
+
+@app.post("/ask/batch")
+async def ask_batch(request: BatchAskRequest):
+    """
+    Answer a list of questions about one workspace in one request
+    
+    All question embeddings are computed with one model call, questions that
+    share a source filter are retrieved with one multi-query vector DB call,
+    and answers are generated concurrently (bounded by ASK_BATCH_CONCURRENCY).
+    Results are returned in request order with per-item timings.
+    """
+    current = await open_workspace(request.workspace)
+    try:
+        return await answer_batch(current, request)
+    finally:
+        current.end_request()
+
+async def answer_batch(workspace: Workspace, request: BatchAskRequest) -> Dict:
+    batch_timer = StageTimer()
+    items = request.questions
+    num_results = request.num_results
+    retrieval_mode = resolve_retrieval_mode(workspace, request.retrieval_mode)
+    logger.info(f"Processing batch of {len(items)} questions")
+    
+    results = [None] * len(items)
+    timings = [{} for _ in items]
+    
+    if not await run_blocking(len, workspace.registry):
+        return {"results": [{
+            "question": item.question,
+            "answer": NO_DOCUMENTS_ANSWER,
+            "sources": [],
+            "num_chunks_used": 0,
+            "cached": False,
+            "timings": {}
+        } for item in items]}
+    
+    # Resolve filters and serve cached answers
+    def resolve_items() -> Tuple[List[Optional[str]], List[tuple]]:
+        actual_sources = [resolve_source_filter(workspace, item.source_file) for item in items]
+        return actual_sources, [
+            answer_cache_key(workspace, item.question, source, num_results, retrieval_mode)
+            for item, source in zip(items, actual_sources)
+        ]
+    actual_sources, answer_keys = await run_blocking(resolve_items)
+    pending = []
+    for index, key in enumerate(answer_keys):
+        cached_response = workspace.answer_cache.get(key)
+        if cached_response is not None:
+            results[index] = dict(cached_response, question=items[index].question, cached=True)
+        else:
+            pending.append(index)
+    
+    # Embed every uncached question in a single model call
+    stage_start = time.perf_counter()
+    embeddings = {}
+    to_encode = []
+    for index in (pending if retrieval_mode != "lexical" else []):
+        embedding_key = normalize_question(items[index].question)
+        cached_embedding = query_embedding_cache.get(embedding_key)
+        if cached_embedding is not None:
+            embeddings[index] = cached_embedding
+        else:
+            to_encode.append(index)
+    if to_encode:
+        loop = asyncio.get_running_loop()
+        encoded = await loop.run_in_executor(
+            query_batcher.executor,
+            embedding_generator.encode_batch,
+            [items[index].question for index in to_encode]
+        )
+        for index, embedding in zip(to_encode, encoded):
+            embeddings[index] = embedding.tolist()
+            query_embedding_cache.put(normalize_question(items[index].question), embeddings[index])
+    embed_time = time.perf_counter() - stage_start
+    batch_timer.add("embed", embed_time)
+    
+    # One multi-query call per distinct source filter
+    stage_start = time.perf_counter()
+    groups = {}
+    for index in pending:
+        groups.setdefault(actual_sources[index], []).append(index)
+    
+    def retrieve_all() -> Dict[int, Tuple[List[str], List[str], List[Dict]]]:
+        retrieved = {}
+        for source, indexes in groups.items():
+            query_results = None
+            if retrieval_mode != "lexical":
+                query_results = workspace.vector_db.query_many(
+                    [embeddings[index] for index in indexes],
+                    n_results=candidate_count(retrieval_count(num_results), retrieval_mode),
+                    filter_source=source
+                )
+            for position, index in enumerate(indexes):
+                vector_hits = None
+                if query_results is not None:
+                    vector_hits = {key: query_results[key][position] for key in ("ids", "documents", "metadatas")}
+                retrieved[index] = select_chunks(
+                    workspace, items[index].question, retrieval_mode, source, retrieval_count(num_results), vector_hits
+                )
+        return retrieved
+    retrieved = await run_blocking(retrieve_all)
+    retrieve_time = time.perf_counter() - stage_start
+    batch_timer.add("retrieve", retrieve_time)
+    
+    semaphore = asyncio.Semaphore(int(os.getenv("ASK_BATCH_CONCURRENCY", "8")))
+    
+    async def answer(index: int) -> None:
+        item_timer = StageTimer()
+        question = items[index].question
+        try:
+            ids, documents, metadatas = retrieved[index]
+            with item_timer.stage("filter"):
+                documents, metadatas = await rerank_chunks(
+                    question, ids, documents, metadatas, num_results, batch_timer.started_at
+                )
+                contexts, unique_sources, num_chunks = build_contexts(question, documents, metadatas)
+            if not num_chunks:
+                answer_text = NO_RESULTS_ANSWER
+            else:
+                async with semaphore:
+                    with item_timer.stage("generate"):
+                        answer_text = await llm.agenerate_answer(question, contexts)
+            response = {
+                "answer": answer_text,
+                "sources": unique_sources,
+                "num_chunks_used": num_chunks
+            }
+            if num_chunks:
+                workspace.answer_cache.put(answer_keys[index], response)
+            results[index] = dict(response, question=question, cached=False)
+        except Exception as e:
+            logger.error(f"Error answering batch question {index}: {str(e)}")
+            results[index] = {
+                "question": question,
+                "answer": f"Error: {str(e)}",
+                "sources": [],
+                "num_chunks_used": 0,
+                "cached": False
+            }
+        item_timer.observe(ASK_STAGE_SECONDS, endpoint="ask_batch")
+        timings[index] = {
+            "embed": round(embed_time, 4),
+            "retrieve": round(retrieve_time, 4),
+            "filter": round(item_timer.timings.get("filter", 0.0), 4),
+            "generate": round(item_timer.timings.get("generate", 0.0), 4)
+        }
+    
+    await asyncio.gather(*(answer(index) for index in pending))
+    
+    for result, item_timings in zip(results, timings):
+        result["timings"] = item_timings
+    
+    total_time = batch_timer.elapsed()
+    batch_timer.observe(ASK_STAGE_SECONDS, endpoint="ask_batch")
+    ASK_SECONDS.observe(total_time, endpoint="ask_batch")
+    logger.info(f"Answered {len(items)} questions in {total_time:.2f} seconds")
+    return {
+        "results": results,
+        "timings": {
+            "embed": round(embed_time, 4),
+            "retrieve": round(retrieve_time, 4),
+            "total": round(total_time, 4)
+        }
+    }
+
+@app.on_event("shutdown")
+async def shutdown_ingest_pipeline():
+    """Stop the ingestion workers and pools"""
+    await ingest_queue.stop()
+    ingest_pipeline.shutdown()
+    query_batcher.shutdown()
+    if reranker is not None:
+        reranker.shutdown()
+    if embedding_cache:
+        embedding_cache.close()
+    workspaces.close()
+    if model_service is not None:
+        model_service.close()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Latency histograms in the Prometheus text format"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health")
+async def health():
+    """Liveness probe: the server is up, whether or not its components are loaded"""
+    return {"status": "ok"}
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 503 until the background warm-up has loaded every component"""
+    return JSONResponse(warm_up.stats(), status_code=200 if warm_up.ready else 503)
+
+@app.get("/stats")
+async def get_stats():
+    """Report runtime statistics of the serving components"""
+    return {
+        "query_embedding_batcher": query_batcher.stats(),
+        "embedding_cache": embedding_cache.stats() if embedding_cache else None,
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "reranker": reranker.stats() if reranker is not None else None,
+        "model_service": await run_blocking(model_service.stats) if model_service is not None else None,
+        "workspaces": await run_blocking(workspaces.stats),
+        "warm_up": warm_up.stats()
+    }
+
 @app.get("/files")
-async def list_files():
-    """List all uploaded files"""
-    return {"files": list(uploaded_files.keys())}
+async def list_files(workspace: Optional[str] = None):
+    """List all files uploaded to a workspace"""
+    current = await open_workspace(workspace)
+    try:
+        return {
+            "workspace": current.name,
+            "files": await run_blocking(current.registry.sources),
+            "documents": await run_blocking(current.registry.list_documents)
+        }
+    finally:
+        current.end_request()
+
+@app.get("/workspaces")
+async def list_workspaces():
+    """List all workspaces"""
+    return {"workspaces": workspaces.list_workspaces(), "default": workspaces.default_workspace}
 
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""
+Parity and speed of the ONNX Runtime embedding backend against PyTorch
+
+Embeds the same chunks with sentence-transformers (PyTorch) and with the
+exported ONNX model, float32 and int8, and reports the cosine similarity of
+each ONNX embedding to its PyTorch counterpart and the encoding throughput
+of every backend. Exits with status 1 if any embedding agrees less than the
+given minimum, so it can gate changes to the export or the encoder.
+
+Chunks come from the given PDFs, or from synthetic PDFs made like
+benchmarks/pipeline.py does.
+
+Usage:
+    python benchmarks/onnx_parity.py --threads 1 2 4 --json onnx.json
+    python benchmarks/onnx_parity.py --pdf manual.pdf --batch-size 64
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embeddings import EmbeddingGenerator
+from onnx_encoder import OnnxEncoder
+from pdf_processor import PDFProcessor
+from pipeline import make_corpus
+
+
+def load_chunks(pdfs, num_docs: int, seed: int):
+    processor = PDFProcessor(chunk_size=1000, chunk_overlap=200)
+    with tempfile.TemporaryDirectory() as directory:
+        if not pdfs:
+            pdfs, _ = make_corpus(directory, num_docs, 10, 400, seed)
+        chunks = [chunk for path in pdfs for chunk in processor.process_pdf(path)[0]]
+    # Mix in short texts, as questions and the last chunk of a document are
+    rng = np.random.default_rng(seed)
+    texts = [chunk["text"] for chunk in chunks]
+    texts += [" ".join(text.split()[:int(rng.integers(3, 30))]) for text in texts[::4]]
+    return texts
+
+
+def time_encode(model, texts, batch_size: int, repeats: int):
+    """Best-of-repeats wall time of encoding all texts, and the embeddings"""
+    model.encode(texts[:batch_size], batch_size=batch_size)
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        embeddings = np.asarray(model.encode(texts, batch_size=batch_size), dtype=np.float32)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, embeddings
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return (a * b).sum(axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--pdf", nargs="*", default=[], help="PDFs to take chunks from instead of synthetic ones")
+    parser.add_argument("--docs", type=int, default=10, help="Synthetic PDFs to generate without --pdf")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, nargs="*", default=[0],
+                        help="ONNX intra-op thread counts to compare, 0 for one per physical core")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--min-cosine", type=float, default=0.999, help="Minimum agreement of float32 ONNX")
+    parser.add_argument("--min-cosine-int8", type=float, default=0.95, help="Minimum agreement of int8 ONNX")
+    parser.add_argument("--cache-dir", help="Directory of exported models (defaults to env ONNX_MODEL_DIR)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+    
+    texts = load_chunks(args.pdf, args.docs, args.seed)
+    torch_model = EmbeddingGenerator(args.model, backend="torch").model
+    torch_seconds, reference = time_encode(torch_model, texts, args.batch_size, args.repeats)
+    
+    results = [{
+        "backend": "torch",
+        "threads": None,
+        "texts_per_second": round(len(texts) / torch_seconds, 1),
+        "speedup": 1.0,
+    }]
+    failed = False
+    for quantize, minimum in ((False, args.min_cosine), (True, args.min_cosine_int8)):
+        for threads in args.threads:
+            encoder = OnnxEncoder(args.model, cache_dir=args.cache_dir, quantize=quantize, intra_op_threads=threads)
+            seconds, embeddings = time_encode(encoder, texts, args.batch_size, args.repeats)
+            agreement = cosine(embeddings, reference)
+            failed = failed or float(agreement.min()) < minimum
+            results.append({
+                "backend": "onnx-int8" if quantize else "onnx",
+                "threads": threads,
+                "texts_per_second": round(len(texts) / seconds, 1),
+                "speedup": round(torch_seconds / seconds, 2),
+                "min_cosine": round(float(agreement.min()), 5),
+                "mean_cosine": round(float(agreement.mean()), 5),
+                "min_cosine_required": minimum,
+            })
+    
+    print(f"{len(texts)} texts, {args.model}, batch size {args.batch_size}")
+    print(f"{'backend':<11}{'threads':>8}{'texts/s':>10}{'speedup':>9}{'min cos':>10}{'mean cos':>10}")
+    for row in results:
+        threads = "-" if row["threads"] is None else row["threads"] or "auto"
+        print(f"{row['backend']:<11}{threads:>8}{row['texts_per_second']:>10}{row['speedup']:>9}"
+              f"{row.get('min_cosine', '-'):>10}{row.get('mean_cosine', '-'):>10}")
+    
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "num_texts": len(texts), "results": results}, f, indent=2)
+    if failed:
+        print("ONNX embeddings disagree with PyTorch beyond the allowed minimum cosine")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""
+End-to-end throughput, latency and recall of the ingest and question paths
+
+Generates synthetic PDFs with PyMuPDF at a controlled page and word count,
+each page carrying one planted fact ("The access code for unit K003-012 is
+...") so every question has a known answer chunk. Then:
+
+  * times extraction, chunking, embedding and indexing with the app's own
+    components and reports their throughput,
+  * reports recall@k of the vector, lexical and hybrid retrieval paths
+    (share of questions whose planted fact is in the top k chunks),
+  * starts the server on the indexed corpus with the fake Gemini model
+    (GEMINI_FAKE), reports how long it takes to bind its port (/health) and
+    to finish warming up (/ready), and then /ask p50/p95/p99 latency under
+    concurrent load.
+
+Results can be written as JSON and diffed across commits. The embedding
+backend follows EMBEDDING_BACKEND, so running with EMBEDDING_BACKEND=onnx
+shows the effect of the ONNX backend on ingest and /ask.
+
+Usage:
+    python benchmarks/pipeline.py --docs 20 --pages 10 --words-per-page 400 --json bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz  # PyMuPDF
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from document_registry import file_sha256, DocumentRegistry
+from embeddings import EmbeddingGenerator
+from lexical_index import reciprocal_rank_fusion
+from pdf_processor import PDFProcessor, StreamingChunker
+from vector_store import create_vector_db
+
+WORKSPACE = "bench"
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid")
+
+
+def make_vocabulary(rng: np.random.Generator, size: int):
+    """Pronounceable pseudo-words, so the text tokenizes like prose without real-world meaning"""
+    consonants = list("bcdfghklmnprstvz")
+    vowels = list("aeiou")
+    words = set()
+    while len(words) < size:
+        length = int(rng.integers(2, 5))
+        words.add("".join(rng.choice(consonants) + rng.choice(vowels) for _ in range(length)))
+    return sorted(words)
+
+
+def make_corpus(directory: str, num_docs: int, num_pages: int, words_per_page: int, seed: int):
+    """
+    Write synthetic PDFs with one planted fact per page
+    
+    Returns:
+        (paths, facts) where each fact is a dict with the question and the
+        sentence fragment that answers it
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary(rng, 5000)
+    # Zipf-like word frequencies, as in natural text
+    weights = 1.0 / np.arange(1, len(vocabulary) + 1)
+    weights /= weights.sum()
+    
+    paths, facts = [], []
+    for doc in range(num_docs):
+        pdf = fitz.open()
+        for page_number in range(num_pages):
+            words = rng.choice(vocabulary, size=words_per_page, p=weights)
+            lengths = rng.integers(8, 20, size=words_per_page // 8 + 1)
+            sentences, start = [], 0
+            for length in lengths:
+                if start >= len(words):
+                    break
+                sentence = " ".join(words[start:start + length])
+                sentences.append(sentence[0].upper() + sentence[1:] + ".")
+                start += length
+            
+            unit = f"K{doc:03d}-{page_number:03d}"
+            code = str(rng.choice(vocabulary))
+            sentences.insert(int(rng.integers(0, len(sentences) + 1)), f"The access code for unit {unit} is {code}.")
+            facts.append({
+                "question": f"What is the access code for unit {unit}?",
+                "answer": f"unit {unit} is {code}",
+            })
+            
+            page = pdf.new_page(width=595, height=842)
+            lines = textwrap.wrap(" ".join(sentences), width=110)
+            if len(lines) > 100:
+                raise ValueError(f"{words_per_page} words do not fit on one page; use fewer --words-per-page")
+            for line_number, line in enumerate(lines):
+                page.insert_text((36, 40 + 7.8 * line_number), line, fontsize=6)
+        
+        path = os.path.join(directory, f"synthetic_{doc:03d}.pdf")
+        pdf.save(path)
+        pdf.close()
+        paths.append(path)
+    return paths, facts
+
+
+def throughput(count: int, seconds: float, unit: str) -> dict:
+    return {unit: count, "seconds": round(seconds, 4), f"{unit}_per_second": round(count / seconds, 2) if seconds else None}
+
+
+def bench_ingest(paths, directory: str, backend: str, embedding_generator: EmbeddingGenerator, batch_size: int):
+    """Run each ingest stage over the whole corpus in turn and time it"""
+    processor = PDFProcessor(chunk_size=1000, chunk_overlap=200)
+    results = {}
+    
+    start = time.perf_counter()
+    pages = {path: list(processor.iter_page_texts(path)) for path in paths}
+    num_pages = sum(len(texts) for texts in pages.values())
+    results["extract"] = throughput(num_pages, time.perf_counter() - start, "pages")
+    results["extract"]["mb"] = round(sum(os.path.getsize(path) for path in paths) / 2 ** 20, 2)
+    
+    start = time.perf_counter()
+    chunks_by_source = {}
+    for path, texts in pages.items():
+        chunker = StreamingChunker(os.path.basename(path), processor.chunk_size, processor.chunk_overlap)
+        chunks = []
+        for text in texts:
+            chunks.extend(chunker.feed(text))
+        chunks.extend(chunker.finish())
+        chunks_by_source[path] = chunks
+    all_chunks = [chunk for chunks in chunks_by_source.values() for chunk in chunks]
+    results["chunk"] = throughput(len(all_chunks), time.perf_counter() - start, "chunks")
+    
+    start = time.perf_counter()
+    for offset in range(0, len(all_chunks), batch_size):
+        embedding_generator.process_chunks(all_chunks[offset:offset + batch_size])
+    results["embed"] = throughput(len(all_chunks), time.perf_counter() - start, "chunks")
+    
+    start = time.perf_counter()
+    vector_db = create_vector_db(persist_directory=directory, backend=backend)
+    registry = DocumentRegistry(os.path.join(vector_db.persist_directory, "document_registry.sqlite3"))
+    for offset in range(0, len(all_chunks), batch_size):
+        vector_db.add_chunks(all_chunks[offset:offset + batch_size])
+    for path, chunks in chunks_by_source.items():
+        registry.save(
+            os.path.basename(path), file_sha256(path), len(pages[path]),
+            [chunk["id"] for chunk in chunks], embedding_generator.model_name
+        )
+    results["index"] = throughput(len(all_chunks), time.perf_counter() - start, "chunks")
+    results["index"]["backend"] = backend
+    
+    return vector_db, registry, results
+
+
+def bench_recall(vector_db, embedding_generator: EmbeddingGenerator, facts, k: int) -> dict:
+    """Share of questions with the chunk holding their planted fact in the top k, per retrieval mode"""
+    questions = [fact["question"] for fact in facts]
+    # Hybrid fuses over-fetched candidates from both retrievers, as the app does
+    num_candidates = k * int(os.getenv("HYBRID_CANDIDATE_FACTOR", "2"))
+    embeddings = embedding_generator.encode_batch(questions)
+    vector_ids = vector_db.query_many(embeddings.tolist(), n_results=num_candidates)["ids"]
+    lexical_ids = [
+        [chunk_id for chunk_id, _ in vector_db.lexical_index.search(question, n_results=num_candidates)]
+        for question in questions
+    ]
+    rankings = {
+        "vector": [ids[:k] for ids in vector_ids],
+        "lexical": [ids[:k] for ids in lexical_ids],
+        "hybrid": [reciprocal_rank_fusion([v, l])[:k] for v, l in zip(vector_ids, lexical_ids)],
+    }
+    
+    texts = {}
+    for ids in rankings.values():
+        missing = {chunk_id for row in ids for chunk_id in row} - set(texts)
+        texts.update((chunk["id"], chunk["text"]) for chunk in vector_db.get_chunks(sorted(missing)))
+    
+    recall = {}
+    for mode in RETRIEVAL_MODES:
+        hits = [
+            any(fact["answer"] in texts.get(chunk_id, "") for chunk_id in ids)
+            for fact, ids in zip(facts, rankings[mode])
+        ]
+        recall[mode] = round(float(np.mean(hits)), 4)
+    return recall
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(process: subprocess.Popen, url: str, timeout: float = 600) -> dict:
+    """Poll url until it answers 200 and return its JSON body"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode} during startup")
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            # 503 from the readiness probe while components are still loading
+            body = json.loads(e.read() or b"{}")
+            if body.get("status") == "failed":
+                raise RuntimeError(f"Server warm-up failed: {body.get('error')}")
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(f"Server did not answer {url} within {timeout} seconds")
+
+
+def start_server(workspaces_dir: str, backend: str, llm_latency_ms: float, cache: bool, port: int):
+    """
+    Start the app on the indexed corpus
+    
+    Returns:
+        (process, startup) where startup has the seconds until the port
+        answered (/health) and until the warm-up finished (/ready)
+    """
+    env = dict(
+        os.environ,
+        WORKSPACES_DIR=workspaces_dir,
+        VECTOR_DB_BACKEND=backend,
+        GEMINI_FAKE="true",
+        GEMINI_FAKE_LATENCY_MS=str(llm_latency_ms),
+        EMBEDDING_CACHE_ENABLED="false",
+        LOG_LEVEL="WARNING",
+    )
+    if not cache:
+        env.update(ANSWER_CACHE_SIZE="0", QUERY_CACHE_SIZE="0")
+    
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_ROOT,
+        env=env
+    )
+    try:
+        wait_for(process, f"http://127.0.0.1:{port}/health")
+        listening = time.perf_counter() - start
+        warm_up = wait_for(process, f"http://127.0.0.1:{port}/ready")
+        ready = time.perf_counter() - start
+    except Exception:
+        process.terminate()
+        raise
+    return process, {
+        "listening_seconds": round(listening, 3),
+        "ready_seconds": round(ready, 3),
+        "warm_up_step_seconds": warm_up.get("step_seconds", {}),
+    }
+
+
+def bench_ask(port: int, facts, num_requests: int, concurrency: int, k: int, retrieval_mode: str) -> dict:
+    """/ask latency percentiles with concurrency requests in flight"""
+    def ask(index: int):
+        data = urllib.parse.urlencode({
+            "question": facts[index % len(facts)]["question"],
+            "num_results": k,
+            "retrieval_mode": retrieval_mode,
+            "workspace": WORKSPACE,
+        }).encode("utf-8")
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/ask", data=data, timeout=120) as response:
+                ok = not json.loads(response.read())["answer"].startswith("Error:")
+        except (urllib.error.URLError, ConnectionError):
+            ok = False
+        return time.perf_counter() - start, ok
+    
+    # Warm up the model and connections before measuring
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(ask, range(concurrency)))
+        start = time.perf_counter()
+        results = list(executor.map(ask, range(num_requests)))
+        elapsed = time.perf_counter() - start
+    
+    latencies = np.array([seconds for seconds, _ in results]) * 1000
+    return {
+        "requests": num_requests,
+        "concurrency": concurrency,
+        "retrieval_mode": retrieval_mode,
+        "errors": sum(1 for _, ok in results if not ok),
+        "requests_per_second": round(num_requests / elapsed, 2),
+        "mean_ms": round(float(latencies.mean()), 2),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--docs", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--backend", choices=["numpy", "chroma"], default="numpy")
+    parser.add_argument("--batch-size", type=int, default=64, help="Chunks per embedding/index batch")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--retrieval-mode", choices=RETRIEVAL_MODES, default="hybrid")
+    parser.add_argument("--llm-latency-ms", type=float, default=200, help="Latency of the fake LLM")
+    parser.add_argument("--cache", action="store_true", help="Keep the answer and query caches on during the load test")
+    parser.add_argument("--skip-ask", action="store_true", help="Only benchmark ingestion and recall")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+    
+    report = {
+        "config": vars(args),
+        "environment": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+    }
+    
+    with tempfile.TemporaryDirectory() as root:
+        corpus_dir = os.path.join(root, "corpus")
+        os.makedirs(corpus_dir)
+        paths, facts = make_corpus(corpus_dir, args.docs, args.pages, args.words_per_page, args.seed)
+        
+        embedding_generator = EmbeddingGenerator()
+        report["environment"]["embedding_backend"] = embedding_generator.backend
+        workspaces_dir = os.path.join(root, "workspaces")
+        vector_db, registry, report["ingest"] = bench_ingest(
+            paths, os.path.join(workspaces_dir, WORKSPACE), args.backend, embedding_generator, args.batch_size
+        )
+        report["recall"] = {f"recall@{args.k}": bench_recall(vector_db, embedding_generator, facts, args.k)}
+        # The server opens the same index; release it first
+        vector_db.close()
+        registry.close()
+        
+        if not args.skip_ask:
+            port = free_port()
+            process, report["startup"] = start_server(
+                workspaces_dir, args.backend, args.llm_latency_ms, args.cache, port
+            )
+            try:
+                report["ask"] = bench_ask(
+                    port, facts, args.requests, args.concurrency, args.k, args.retrieval_mode
+                )
+            finally:
+                process.terminate()
+                process.wait(timeout=30)
+    
+    print(f"{args.docs} docs x {args.pages} pages x {args.words_per_page} words, {args.backend} backend")
+    print(f"{'stage':<10}{'items':>10}{'seconds':>10}{'items/s':>12}")
+    for stage, row in report["ingest"].items():
+        unit = "pages" if "pages" in row else "chunks"
+        print(f"{stage:<10}{row[unit]:>10}{row['seconds']:>10}{row[f'{unit}_per_second']:>12}")
+    print()
+    print(f"{'mode':<10}{'recall@' + str(args.k):>10}")
+    for mode, recall in report["recall"][f"recall@{args.k}"].items():
+        print(f"{mode:<10}{recall:>10}")
+    if "ask" in report:
+        ask = report["ask"]
+        print()
+        startup = report["startup"]
+        print(f"server listening after {startup['listening_seconds']} s, ready after {startup['ready_seconds']} s")
+        print(f"/ask {ask['requests']} requests, concurrency {ask['concurrency']}, {ask['retrieval_mode']}: "
+              f"p50 {ask['p50_ms']} ms, p95 {ask['p95_ms']} ms, p99 {ask['p99_ms']} ms, "
+              f"{ask['requests_per_second']} req/s, {ask['errors']} errors")
+    
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Recall@k of quantized NumPy index storage against the float32 baseline
+
+Builds one index per storage format over the same synthetic corpus, runs the
+same queries through each and reports recall@k (overlap with the float32
+top-k), mean query latency and on-disk size of the embedding matrices.
+
+Usage:
+    python benchmarks/quantization_recall.py --chunks 50000 --queries 200 --k 5
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from numpy_vector_db import NumpyVectorDB
+
+CONFIGS = [
+    ("float32", False),
+    ("float16", False),
+    ("int8", False),
+    ("float16", True),
+    ("int8", True),
+]
+
+
+def synthetic_corpus(num_chunks: int, dim: int, num_topics: int, seed: int):
+    """Clustered unit vectors, so neighbours are close in score like real chunk embeddings"""
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(num_topics, dim))
+    labels = rng.integers(0, num_topics, size=num_chunks)
+    vectors = topics[labels] + 0.6 * rng.normal(size=(num_chunks, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32), rng
+
+
+def build_index(directory: str, vectors: np.ndarray, quantization: str, rescore: bool) -> NumpyVectorDB:
+    db = NumpyVectorDB(
+        directory,
+        initial_capacity=len(vectors),
+        quantization=quantization,
+        rescore=rescore
+    )
+    batch_size = 5000
+    for start in range(0, len(vectors), batch_size):
+        chunks = [
+            {"text": f"chunk {i}", "source": f"doc{i % 50}.pdf", "chunk_size": 8, "embedding": vectors[i]}
+            for i in range(start, min(start + batch_size, len(vectors)))
+        ]
+        db.add_chunks(chunks)
+    return db
+
+
+def matrix_bytes(directory: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(directory, name))
+        for name in ("embeddings.npy", "scales.npy", "exact.npy")
+        if os.path.exists(os.path.join(directory, name))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+    
+    vectors, rng = synthetic_corpus(args.chunks, args.dim, args.topics, args.seed)
+    # Queries are perturbed corpus vectors, like questions about a known passage
+    picks = rng.integers(0, args.chunks, size=args.queries)
+    queries = vectors[picks] + 0.5 * rng.normal(size=(args.queries, args.dim)).astype(np.float32) / np.sqrt(args.dim)
+    
+    results = []
+    baseline = None
+    with tempfile.TemporaryDirectory() as root:
+        for quantization, rescore in CONFIGS:
+            name = quantization + ("+rescore" if rescore else "")
+            directory = os.path.join(root, name)
+            # The index logs every batch; keep the report readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                db = build_index(directory, vectors, quantization, rescore)
+                start = time.perf_counter()
+                found = [db.query(query.tolist(), n_results=args.k)["ids"][0] for query in queries]
+                elapsed = time.perf_counter() - start
+                db.close()
+            
+            if baseline is None:
+                baseline = found
+            recall = np.mean([len(set(a) & set(b)) / args.k for a, b in zip(found, baseline)])
+            results.append({
+                "storage": name,
+                f"recall@{args.k}": round(float(recall), 4),
+                "query_ms": round(1000 * elapsed / args.queries, 3),
+                "matrix_mb": round(matrix_bytes(directory) / 2 ** 20, 2),
+            })
+    
+    print(f"{args.chunks} chunks x {args.dim} dims, {args.queries} queries")
+    print(f"{'storage':<18}{'recall@' + str(args.k):>10}{'query ms':>10}{'matrix MB':>11}")
+    for row in results:
+        print(f"{row['storage']:<18}{row[f'recall@{args.k}']:>10}{row['query_ms']:>10}{row['matrix_mb']:>11}")
+    
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import logging
+import os
+import re
+from typing import Dict, Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Rough characters per token for English text with Gemini/SentencePiece-style tokenizers
+CHARS_PER_TOKEN = 4
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap estimate of the number of LLM tokens in a text
+    
+    Computed once per chunk at ingest time and stored as its token_count, so
+    packing a prompt never has to re-tokenize the retrieved chunks.
+    """
+    return max(1, (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN)
+
+
+def _shingles(text: str, size: int = 5) -> set:
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class ContextPacker:
+    def __init__(
+        self,
+        token_budget: Optional[int] = None,
+        chunk_overlap: int = 200,
+        duplicate_threshold: Optional[float] = None
+    ):
+        """
+        Select and arrange retrieved chunks to fill a prompt token budget
+        
+        Chunks are taken in relevance order. Neighbouring chunks of the same
+        document are merged into one passage with the overlap that chunking
+        repeats between them removed, passages that mostly repeat an earlier
+        one are dropped, and passages are added until the budget is spent.
+        
+        Args:
+            token_budget: Tokens of context per prompt (env PROMPT_TOKEN_BUDGET)
+            chunk_overlap: Characters the chunker repeats between consecutive chunks
+            duplicate_threshold: Share of a passage's word 5-grams already present in a
+                selected passage above which it is dropped (env CONTEXT_DUPLICATE_THRESHOLD)
+        """
+        self.token_budget = token_budget or int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+        self.chunk_overlap = chunk_overlap
+        self.duplicate_threshold = duplicate_threshold or float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", "0.8"))
+    
+    def pack(self, contexts: List[Dict[str, Any]]) -> List[str]:
+        """
+        Build the context passages for a prompt
+        
+        Args:
+            contexts: Retrieved chunks, best first, with "document" text and
+                "metadata" (source, and chunk_index/token_count when stored)
+        
+        Returns:
+            Passages in relevance order whose estimated tokens fit the budget;
+            the best passage is truncated to the budget if it alone is too long
+        """
+        passages = self._merge_neighbours(contexts)
+        
+        packed = []
+        packed_shingles = []
+        used_tokens = 0
+        for text, tokens in passages:
+            shingles = _shingles(text)
+            if any(self._is_duplicate(shingles, seen) for seen in packed_shingles):
+                continue
+            if used_tokens + tokens > self.token_budget:
+                if packed:
+                    # A shorter passage further down may still fit
+                    continue
+                text = text[:self.token_budget * CHARS_PER_TOKEN]
+                tokens = self.token_budget
+            packed.append(text)
+            packed_shingles.append(shingles)
+            used_tokens += tokens
+        
+        logger.debug(f"Packed {len(packed)} passages from {len(contexts)} chunks "
+                     f"(~{used_tokens}/{self.token_budget} tokens)")
+        return packed
+    
+    def _is_duplicate(self, shingles: set, seen: set) -> bool:
+        return len(shingles & seen) >= self.duplicate_threshold * len(shingles)
+    
+    def _merge_neighbours(self, contexts: List[Dict[str, Any]]) -> List[Tuple[str, int]]:
+        """
+        Merge retrieved chunks that follow each other in their document
+        
+        Returns:
+            (text, estimated tokens) per passage, ordered by the rank of the
+            best chunk in each passage
+        """
+        # Runs of chunks with consecutive chunk_index in the same source, in document order
+        run_of = {}
+        indexed = sorted(
+            (context["metadata"].get("source"), context["metadata"]["chunk_index"], rank)
+            for rank, context in enumerate(contexts)
+            if context["metadata"].get("chunk_index") is not None
+        )
+        previous = None
+        for source, chunk_index, rank in indexed:
+            if (
+                previous is not None
+                and previous[0] == source
+                and chunk_index == previous[1] + 1
+                and self._overlap(contexts[previous[2]]["document"], contexts[rank]["document"]) is not None
+            ):
+                run = run_of[previous[2]]
+                run.append(rank)
+            else:
+                run = [rank]
+            run_of[rank] = run
+            previous = (source, chunk_index, rank)
+        
+        passages = []
+        for rank, context in enumerate(contexts):
+            run = run_of.get(rank)
+            if run is None:
+                passages.append((rank, context["document"], self._tokens(context)))
+                continue
+            if min(run) != rank:
+                continue
+            
+            text = contexts[run[0]]["document"]
+            tokens = self._tokens(contexts[run[0]])
+            for prev_rank, next_rank in zip(run, run[1:]):
+                next_context = contexts[next_rank]
+                overlap = self._overlap(contexts[prev_rank]["document"], next_context["document"])
+                text += next_context["document"][overlap:]
+                tokens += self._tokens(next_context) - overlap // CHARS_PER_TOKEN
+            passages.append((rank, text, tokens))
+        
+        return [(text, tokens) for _, text, tokens in sorted(passages, key=lambda passage: passage[0])]
+    
+    def _overlap(self, previous: str, following: str) -> Optional[int]:
+        """
+        Characters at the start of following that repeat the end of previous
+        
+        The chunker starts each chunk with the last chunk_overlap characters of
+        the one before it, so consecutive chunks are recognised by that
+        prefix. Returns None if following does not continue previous.
+        """
+        tail = previous[-self.chunk_overlap:]
+        if tail and following.startswith(tail):
+            return len(tail)
+        return None
+    
+    @staticmethod
+    def _tokens(context: Dict[str, Any]) -> int:
+        # Counted at ingest time; chunks stored before that are estimated now
+        return context["metadata"].get("token_count") or estimate_tokens(context["document"])
@@ -2,7 +2,8 @@ import os
 import sys
 from pdf_processor import PDFProcessor
 from embeddings import EmbeddingGenerator
-from vector_db import VectorDB
+from vector_store import create_vector_db
+from document_registry import DocumentRegistry, file_sha256
 import shutil
 
 def main():
@@ -16,31 +17,32 @@ def main():
         print(f"Contents: {dirs}")
         
         # Check if it has data
-        vector_db = VectorDB(persist_directory=db_path)
-        count = vector_db.collection.count()
+        vector_db = create_vector_db(persist_directory=db_path)
+        count = vector_db.count()
         print(f"Number of chunks in database: {count}")
         
         if count > 0:
             # Show sample entries
             try:
-                results = vector_db.collection.get(limit=3)
-                if results and 'metadatas' in results:
+                samples = vector_db.peek(limit=3)
+                if samples:
                     print("\nSample entries:")
-                    for i, (meta, doc) in enumerate(zip(results['metadatas'], results['documents'])):
-                        print(f"{i+1}. Source: {meta.get('source')}")
-                        print(f"   Text preview: {doc[:100]}...\n")
+                    for i, sample in enumerate(samples):
+                        print(f"{i+1}. Source: {sample['metadata'].get('source')}")
+                        print(f"   Text preview: {sample['text'][:100]}...\n")
                 
-                # List all sources
-                results = vector_db.collection.get()
-                if results and 'metadatas' in results:
-                    sources = {}
-                    for meta in results['metadatas']:
-                        source = meta.get('source', 'unknown')
-                        sources[source] = sources.get(source, 0) + 1
-                    
-                    print("\nSources in database:")
-                    for source, count in sources.items():
-                        print(f"- {source}: {count} chunks")
+                # List all sources from the document catalog
+                registry = DocumentRegistry(
+                    os.path.join(vector_db.persist_directory, "document_registry.sqlite3"),
+                    backfill=vector_db.get_chunk_ids_by_source
+                )
+                documents = registry.list_documents()
+                registry.close()
+                
+                print("\nSources in database:")
+                for info in documents:
+                    print(f"- {info['source']}: {info['num_chunks']} chunks, {info['num_pages']} pages, "
+                          f"model {info['embedding_model'] or 'unknown'}")
             except Exception as e:
                 print(f"Error retrieving data: {e}")
     else:
@@ -85,8 +87,23 @@ def main():
                     
                     if add_choice == 'y':
                         print("\nAdding chunks to vector database...")
-                        db = VectorDB()
+                        db = create_vector_db()
                         db.add_chunks(chunks_with_embeddings)
+                        
+                        # Catalog the document and drop chunks left from an older version
+                        source = chunks_with_embeddings[0]["source"]
+                        chunk_ids = [chunk["id"] for chunk in chunks_with_embeddings]
+                        registry = DocumentRegistry(os.path.join(db.persist_directory, "document_registry.sqlite3"))
+                        current_ids = set(chunk_ids)
+                        db.delete_chunks([i for i in registry.get_chunk_ids(source) if i not in current_ids])
+                        registry.save(
+                            source,
+                            file_sha256(pdf_path),
+                            processor.count_pages(pdf_path),
+                            chunk_ids,
+                            embedding_model=embedding_gen.model_name
+                        )
+                        registry.close()
                         print("Chunks added successfully")
                 else:
                     print("No chunks created. The PDF might be empty or contains only images.")
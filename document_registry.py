@@ -0,0 +1,196 @@
+import logging
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, List, Optional, Callable
+
+logger = logging.getLogger(__name__)
+
+
+def file_sha256(file_path: str) -> str:
+    """SHA-256 of a file's contents, read in 1 MiB blocks"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DocumentRegistry:
+    def __init__(self, path: str, backfill: Optional[Callable[[], Dict[str, List[str]]]] = None):
+        """
+        Persistent SQLite catalog of ingested documents and their chunk IDs
+        
+        The catalog survives restarts, so the set of uploaded documents no
+        longer has to be rebuilt from the vector DB. It is read from disk
+        lazily on first use and kept in memory afterwards. It also makes
+        re-uploads idempotent: an unchanged file is skipped and a changed file
+        only has its differing chunks embedded and replaced.
+        
+        Args:
+            path: SQLite file holding the catalog
+            backfill: Optional function returning {source: chunk IDs} for a vector
+                DB populated before the catalog existed; called once if the
+                catalog is empty
+        """
+        self.path = path
+        self.backfill = backfill
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        
+        self._lock = threading.RLock()
+        self._conn = None
+        self._documents = None
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "source TEXT PRIMARY KEY, sha256 TEXT NOT NULL, num_pages INTEGER NOT NULL, "
+                "num_chunks INTEGER NOT NULL, ingested_at REAL NOT NULL, embedding_model TEXT)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS document_chunks ("
+                "source TEXT NOT NULL, position INTEGER NOT NULL, chunk_id TEXT NOT NULL, "
+                "PRIMARY KEY (source, position))"
+            )
+            # Catalogs created before embedding_model was tracked
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(documents)")]
+            if "embedding_model" not in columns:
+                self._conn.execute("ALTER TABLE documents ADD COLUMN embedding_model TEXT")
+            self._conn.commit()
+        return self._conn
+    
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        """Read the catalog into memory on first use"""
+        with self._lock:
+            if self._documents is not None:
+                return self._documents
+            
+            conn = self._connect()
+            rows = conn.execute(
+                "SELECT source, sha256, num_pages, num_chunks, ingested_at, embedding_model FROM documents"
+            ).fetchall()
+            self._documents = {
+                row[0]: {
+                    "source": row[0],
+                    "sha256": row[1],
+                    "num_pages": row[2],
+                    "num_chunks": row[3],
+                    "ingested_at": row[4],
+                    "embedding_model": row[5]
+                }
+                for row in rows
+            }
+            logger.info(f"Loaded {len(self._documents)} documents from catalog {self.path}")
+            
+            if not self._documents and self.backfill is not None:
+                self._backfill()
+            return self._documents
+    
+    def _backfill(self) -> None:
+        existing = self.backfill()
+        if not existing:
+            return
+        logger.info(f"Backfilling catalog with {len(existing)} documents found in the vector DB")
+        for source, chunk_ids in existing.items():
+            # The file hash is unknown, so the next upload of the file re-ingests it
+            self.save(source, "", 0, chunk_ids)
+    
+    def list_documents(self) -> List[Dict[str, Any]]:
+        """All catalogued documents, oldest first"""
+        documents = self._load()
+        with self._lock:
+            return sorted((dict(info) for info in documents.values()), key=lambda info: info["ingested_at"])
+    
+    def sources(self) -> List[str]:
+        """Source names of all catalogued documents, oldest first"""
+        return [info["source"] for info in self.list_documents()]
+    
+    def __len__(self) -> int:
+        return len(self._load())
+    
+    def get(self, source: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a document
+        
+        Args:
+            source: The document's source name
+            
+        Returns:
+            Dictionary with sha256, num_pages, num_chunks, ingested_at and
+            embedding_model, or None
+        """
+        documents = self._load()
+        with self._lock:
+            info = documents.get(source)
+            return dict(info) if info is not None else None
+    
+    def get_chunk_ids(self, source: str) -> List[str]:
+        """Chunk IDs of a document in document order"""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT chunk_id FROM document_chunks WHERE source = ? ORDER BY position", (source,)
+            ).fetchall()
+        return [row[0] for row in rows]
+    
+    def save(
+        self,
+        source: str,
+        sha256: str,
+        num_pages: int,
+        chunk_ids: List[str],
+        embedding_model: Optional[str] = None
+    ) -> None:
+        """
+        Record a document and replace its chunk list
+        
+        Args:
+            source: The document's source name
+            sha256: SHA-256 of the file contents
+            num_pages: Number of pages in the file
+            chunk_ids: IDs of the document's chunks in order
+            embedding_model: Name of the model the chunks were embedded with
+        """
+        info = {
+            "source": source,
+            "sha256": sha256,
+            "num_pages": num_pages,
+            "num_chunks": len(chunk_ids),
+            "ingested_at": time.time(),
+            "embedding_model": embedding_model
+        }
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO documents "
+                    "(source, sha256, num_pages, num_chunks, ingested_at, embedding_model) VALUES (?, ?, ?, ?, ?, ?)",
+                    (source, sha256, num_pages, info["num_chunks"], info["ingested_at"], embedding_model)
+                )
+                conn.execute("DELETE FROM document_chunks WHERE source = ?", (source,))
+                conn.executemany(
+                    "INSERT INTO document_chunks (source, position, chunk_id) VALUES (?, ?, ?)",
+                    [(source, position, chunk_id) for position, chunk_id in enumerate(chunk_ids)]
+                )
+            if self._documents is not None:
+                self._documents[source] = info
+    
+    def remove(self, source: str) -> None:
+        """Forget a document and its chunk list"""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM documents WHERE source = ?", (source,))
+                conn.execute("DELETE FROM document_chunks WHERE source = ?", (source,))
+            if self._documents is not None:
+                self._documents.pop(source, None)
+    
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,139 @@
+import logging
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Any, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    def __init__(self, path: Optional[str] = None, max_entries: Optional[int] = None):
+        """
+        Persistent content-addressed cache of chunk embeddings backed by SQLite
+        
+        Entries are keyed by (model name, normalized text hash), so identical
+        chunks from re-uploaded or overlapping documents are only encoded once.
+        Least recently used entries are evicted once max_entries is exceeded.
+        
+        Args:
+            path: SQLite file holding the cache (env EMBEDDING_CACHE_PATH)
+            max_entries: Maximum number of cached embeddings (env EMBEDDING_CACHE_MAX_ENTRIES)
+        """
+        self.path = path or os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache.sqlite3")
+        self.max_entries = max_entries or int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+        
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, dim INTEGER NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+        
+        self._num_entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        logger.info(f"Embedding cache at {self.path} has {self._num_entries} entries (max {self.max_entries})")
+    
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        """Cache key for a text embedded with the given model"""
+        normalized = " ".join(text.split())
+        return hashlib.sha256(f"{model_name}\0{normalized}".encode("utf-8")).hexdigest()
+    
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Look up embeddings and mark them as recently used
+        
+        Args:
+            keys: Cache keys from make_key
+            
+        Returns:
+            Dictionary of the keys that were found and their float32 embeddings
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        now = time.time()
+        
+        with self._lock:
+            # Stay below SQLite's limit on bound parameters
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+                if rows:
+                    self._conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                        [(now, key) for key, _ in rows]
+                    )
+            self._conn.commit()
+            
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        
+        return found
+    
+    def put_many(self, items: Dict[str, np.ndarray]) -> None:
+        """
+        Store embeddings, evicting the least recently used entries if over capacity
+        
+        Args:
+            items: Dictionary of cache key to embedding
+        """
+        if not items:
+            return
+        now = time.time()
+        rows = [
+            (key, int(np.asarray(vector).shape[-1]), np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for key, vector in items.items()
+        ]
+        
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, dim, vector, last_used) VALUES (?, ?, ?, ?)", rows
+            )
+            self._num_entries += self._conn.total_changes - before
+            
+            excess = self._num_entries - self.max_entries
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)", (excess,)
+                )
+                self._num_entries -= excess
+                self.evictions += excess
+            self._conn.commit()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and size of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self._num_entries,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions
+            }
+    
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
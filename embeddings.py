@@ -1,17 +1,143 @@
-import torch
-from sentence_transformers import SentenceTransformer
-from typing import List, Dict, Any, Union
+import asyncio
+import importlib.util
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from typing import Callable, List, Dict, Any, Union, Optional
+
+from embedding_cache import EmbeddingCache
+
+EMBEDDING_BACKENDS: List[str] = ["torch", "onnx"]
 
 class EmbeddingGenerator:
-    def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
+    def __init__(
+        self,
+        model_name: str = "all-MiniLM-L6-v2",
+        cache: Optional[EmbeddingCache] = None,
+        backend: Optional[str] = None,
+        batch_size: Optional[int] = None,
+        normalize: Optional[bool] = None,
+        numpy_output: Optional[bool] = None
+    ):
         """
         Initialize the embedding generator
         
+        The model is loaded on first use, or ahead of it by warm_up(), so
+        constructing the generator (and importing this module) stays cheap.
+        
         Args:
             model_name: Name of the sentence-transformers model to use
+            cache: Optional persistent cache consulted before encoding chunks
+            backend: "torch" for sentence-transformers or "onnx" for an exported
+                model on ONNX Runtime, see OnnxEncoder (env EMBEDDING_BACKEND)
+            batch_size: Texts per model call when encoding (env EMBEDDING_BATCH_SIZE)
+            normalize: Scale embeddings to unit length (env EMBEDDING_NORMALIZE)
+            numpy_output: Leave chunk embeddings as float32 NumPy rows instead
+                of lists of floats (env EMBEDDING_NUMPY_OUTPUT)
+        
+        Raises:
+            ValueError: If the backend is unknown
+            ImportError: If the onnx backend is selected without onnxruntime installed
+        """
+        self.model_name = model_name
+        self.cache = cache
+        self.backend = (backend or os.getenv("EMBEDDING_BACKEND", "torch")).lower()
+        if self.backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Unknown embedding backend '{self.backend}', expected one of {EMBEDDING_BACKENDS}")
+        # The model loads lazily, so check here rather than fail on the first encode
+        if self.backend == "onnx" and importlib.util.find_spec("onnxruntime") is None:
+            raise ImportError("EMBEDDING_BACKEND=onnx needs onnxruntime, install it with: pip install onnxruntime")
+        # int8 embeddings differ slightly from float ones, so they are cached separately
+        quantized = self.backend == "onnx" and os.getenv("ONNX_QUANTIZE", "false").lower() == "true"
+        self.cache_model_name = f"{model_name}:int8" if quantized else model_name
+        self.batch_size = batch_size or int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+        self.normalize = (
+            normalize if normalize is not None else os.getenv("EMBEDDING_NORMALIZE", "false").lower() == "true"
+        )
+        self.numpy_output = (
+            numpy_output if numpy_output is not None
+            else os.getenv("EMBEDDING_NUMPY_OUTPUT", "true").lower() == "true"
+        )
+        self._model = None
+        self._load_lock = threading.Lock()
+    
+    @property
+    def model(self):
+        """The SentenceTransformer (or OnnxEncoder), loaded on first access"""
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    # Imported here so that torch is only loaded once the model is needed
+                    if self.backend == "onnx":
+                        from onnx_encoder import OnnxEncoder
+                        self._model = OnnxEncoder(self.model_name)
+                    else:
+                        from sentence_transformers import SentenceTransformer
+                        self._model = SentenceTransformer(self.model_name)
+        return self._model
+    
+    @property
+    def embedding_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+    
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+    
+    def warm_up(self, encode: bool = True) -> None:
+        """
+        Load the model ahead of the first request
+        
+        Args:
+            encode: Also run one dummy encode, which initializes the lazily set
+                up parts of the model and its thread pools
+        """
+        if encode:
+            self.encode_batch(["warm up"])
+        else:
+            self.model
+    
+    def encode_batch(
+        self,
+        texts: List[str],
+        progress: Optional[Callable[[int, int], None]] = None
+    ) -> np.ndarray:
         """
-        self.model = SentenceTransformer(model_name)
-        self.embedding_dimension = self.model.get_sentence_embedding_dimension()
+        Encode a list of texts in length-sorted batches of batch_size
+        
+        Texts are sorted by length before they are cut into batches, so each
+        model call pads its texts to a similar length instead of every short
+        chunk being padded to the longest one of a document.
+        
+        Args:
+            texts: List of strings to embed
+            progress: Optional callback called with (texts encoded, total)
+                after every model call
+            
+        Returns:
+            2D float32 array with one row per text, in the order of texts
+        """
+        if not texts:
+            return np.zeros((0, self.embedding_dimension), dtype=np.float32)
+        
+        order = sorted(range(len(texts)), key=lambda index: len(texts[index]))
+        embeddings = None
+        for start in range(0, len(order), self.batch_size):
+            rows = order[start:start + self.batch_size]
+            batch = self.model.encode(
+                [texts[row] for row in rows],
+                batch_size=len(rows),
+                convert_to_numpy=True,
+                show_progress_bar=False
+            )
+            if embeddings is None:
+                embeddings = np.empty((len(texts), batch.shape[1]), dtype=np.float32)
+            embeddings[rows] = batch
+            if progress is not None:
+                progress(start + len(rows), len(texts))
+        
+        return self._normalize(embeddings) if self.normalize else embeddings
     
     def generate_embeddings(self, texts: Union[str, List[str]]):
         """
@@ -26,8 +152,7 @@ class EmbeddingGenerator:
         if isinstance(texts, str):
             texts = [texts]
             
-        # Generate embeddings as numpy arrays (not tensors)
-        embeddings = self.model.encode(texts, convert_to_numpy=True)
+        embeddings = self.encode_batch(texts)
         
         # If it's a single text, return a single embedding
         if len(texts) == 1:
@@ -36,28 +161,213 @@ class EmbeddingGenerator:
         # Return as list of lists for multiple texts
         return embeddings.tolist()
     
-    def process_chunks(self, chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def process_chunks(
+        self,
+        chunks: List[Dict[str, Any]],
+        progress: Optional[Callable[[int, int], None]] = None
+    ) -> List[Dict[str, Any]]:
         """
         Process a list of text chunks and add embeddings
         
         Args:
             chunks: List of chunk dictionaries with 'text' key
+            progress: Optional callback called with (chunks embedded, total)
+                as the chunks are encoded, for long documents
             
         Returns:
-            Chunks with added embeddings
+            Chunks with added embeddings, float32 NumPy rows unless
+            numpy_output is off
         """
         if not chunks:
             return []
             
         texts = [chunk["text"] for chunk in chunks]
-        embeddings = self.generate_embeddings(texts)
         
-        # If single chunk, embeddings is a single list
-        if len(chunks) == 1:
-            chunks[0]["embedding"] = embeddings
+        if self.cache is not None:
+            embeddings = self._encode_with_cache(texts, progress)
         else:
-            # Otherwise embeddings is a list of lists
-            for i, chunk in enumerate(chunks):
-                chunk["embedding"] = embeddings[i]
+            embeddings = self.encode_batch(texts, progress)
+        
+        for chunk, embedding in zip(chunks, embeddings):
+            chunk["embedding"] = embedding if self.numpy_output else embedding.tolist()
+            
+        return chunks
+    
+    def _encode_with_cache(
+        self,
+        texts: List[str],
+        progress: Optional[Callable[[int, int], None]] = None
+    ) -> np.ndarray:
+        """Encode only the texts missing from the cache and store the new embeddings"""
+        keys = [EmbeddingCache.make_key(self.cache_model_name, text) for text in texts]
+        found = self.cache.get_many(keys)
+        
+        # Encode each missing text once, even if it repeats within the batch
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        
+        if missing:
+            encode_progress = None
+            if progress is not None:
+                # Count the cached texts as done from the start
+                num_cached = len(texts) - len(missing)
+                encode_progress = lambda done, _: progress(num_cached + done, len(texts))
+            new_embeddings = self.encode_batch(list(missing.values()), encode_progress)
+            computed = dict(zip(missing.keys(), new_embeddings))
+            self.cache.put_many(computed)
+            found.update(computed)
+        elif progress is not None:
+            progress(len(texts), len(texts))
+        
+        embeddings = np.asarray(np.stack([found[key] for key in keys]), dtype=np.float32)
+        # Entries cached before normalize was turned on may not be unit length yet
+        return self._normalize(embeddings) if self.normalize else embeddings
+    
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+
+class QueryEmbeddingBatcher:
+    # Upper bounds of the batch-size histogram buckets
+    HISTOGRAM_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+    # Upper bounds of the queue-depth histogram buckets
+    QUEUE_DEPTH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+    
+    def __init__(
+        self,
+        embedding_generator: EmbeddingGenerator,
+        max_batch_size: Optional[int] = None,
+        max_wait_ms: Optional[float] = None
+    ):
+        """
+        Micro-batch query embeddings across concurrent requests
+        
+        Texts submitted within max_wait_ms of each other (or until
+        max_batch_size texts are waiting) are encoded with one model call on
+        a dedicated thread. While a batch is being encoded, new texts keep
+        accumulating and are sent as the next batch.
+        
+        Args:
+            embedding_generator: EmbeddingGenerator that owns the model
+            max_batch_size: Max texts per model call (env EMBED_BATCH_MAX_SIZE)
+            max_wait_ms: Max time a text waits for others (env EMBED_BATCH_MAX_WAIT_MS)
+        """
+        self.embedding_generator = embedding_generator
+        self.max_batch_size = max_batch_size or int(os.getenv("EMBED_BATCH_MAX_SIZE", "32"))
+        self.max_wait_ms = max_wait_ms if max_wait_ms is not None else float(os.getenv("EMBED_BATCH_MAX_WAIT_MS", "5"))
+        
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="query-embedding")
+        self._pending = []
+        self._timer = None
+        self._busy = False
+        
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.batch_size_histogram = self._new_histogram(self.HISTOGRAM_BUCKETS)
+        # Texts waiting when each batch is taken off the queue
+        self.queue_depth_histogram = self._new_histogram(self.QUEUE_DEPTH_BUCKETS)
+    
+    async def embed(self, text: str) -> List[float]:
+        """
+        Embed a single query text, batched with other concurrent callers
+        
+        Args:
+            text: The text to embed
             
-        return chunks 
\ No newline at end of file
+        Returns:
+            The embedding as a list of floats
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        
+        if not self._busy:
+            if len(self._pending) >= self.max_batch_size:
+                self._flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.max_wait_ms / 1000.0, self._flush)
+        
+        return await future
+    
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._busy or not self._pending:
+            return
+        
+        self._record_queue_depth(len(self._pending))
+        batch = self._pending[:self.max_batch_size]
+        self._pending = self._pending[self.max_batch_size:]
+        self._busy = True
+        asyncio.get_running_loop().create_task(self._run_batch(batch))
+    
+    async def _run_batch(self, batch) -> None:
+        loop = asyncio.get_running_loop()
+        texts = [text for text, _ in batch]
+        self._record_batch(len(texts))
+        
+        try:
+            embeddings = await loop.run_in_executor(self.executor, self.embedding_generator.encode_batch, texts)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding.tolist())
+        finally:
+            self._busy = False
+            # Texts that arrived while this batch was encoding go out right away
+            if self._pending:
+                self._flush()
+    
+    @staticmethod
+    def _new_histogram(buckets) -> Dict[str, int]:
+        histogram = {str(bucket): 0 for bucket in buckets}
+        histogram["+Inf"] = 0
+        return histogram
+    
+    @staticmethod
+    def _observe(histogram: Dict[str, int], buckets, value: int) -> None:
+        for bucket in buckets:
+            if value <= bucket:
+                histogram[str(bucket)] += 1
+                break
+        else:
+            histogram["+Inf"] += 1
+    
+    def _record_batch(self, size: int) -> None:
+        with self._lock:
+            self.num_requests += size
+            self.num_batches += 1
+            self._observe(self.batch_size_histogram, self.HISTOGRAM_BUCKETS, size)
+    
+    def _record_queue_depth(self, depth: int) -> None:
+        with self._lock:
+            self._observe(self.queue_depth_histogram, self.QUEUE_DEPTH_BUCKETS, depth)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and batch-size statistics"""
+        with self._lock:
+            return {
+                "queue_depth": len(self._pending),
+                "in_flight": self._busy,
+                "requests": self.num_requests,
+                "batches": self.num_batches,
+                "mean_batch_size": round(self.num_requests / self.num_batches, 2) if self.num_batches else 0.0,
+                "batch_size_histogram": dict(self.batch_size_histogram),
+                "queue_depth_histogram": dict(self.queue_depth_histogram),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait_ms
+            }
+    
+    def shutdown(self) -> None:
+        """Stop the encoding thread"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,57 @@
+import asyncio
+import os
+import re
+import time
+from typing import Optional
+
+
+class FakeGeminiResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGeminiModel:
+    def __init__(self, latency_ms: Optional[float] = None, fail_first: Optional[int] = None, chunk_chars: int = 20):
+        """
+        Local stand-in for genai.GenerativeModel used for testing and benchmarks
+        
+        It answers with the first sentences of the prompt's context after a
+        fixed delay, and can fail its first calls with a 429 to exercise retries.
+        
+        Args:
+            latency_ms: Simulated generation time (env GEMINI_FAKE_LATENCY_MS)
+            fail_first: Number of initial calls that raise a 429 error (env GEMINI_FAKE_FAIL_FIRST)
+            chunk_chars: Characters per chunk when streaming
+        """
+        self.latency_ms = latency_ms if latency_ms is not None else float(os.getenv("GEMINI_FAKE_LATENCY_MS", "200"))
+        self.fail_first = fail_first if fail_first is not None else int(os.getenv("GEMINI_FAKE_FAIL_FIRST", "0"))
+        self.chunk_chars = chunk_chars
+        self.calls = 0
+    
+    def _answer(self, prompt: str) -> str:
+        self.calls += 1
+        if self.calls <= self.fail_first:
+            raise RuntimeError("429 Resource has been exhausted (fake)")
+        
+        match = re.search(r"CONTEXT INFORMATION:\s*(.*?)\s*IMPORTANT INSTRUCTIONS:", prompt, re.S)
+        context = match.group(1) if match else prompt
+        sentences = re.split(r'(?<=[.!?])\s+', context.strip())
+        return " ".join(sentences[:2]) or "No answer."
+    
+    def generate_content(self, prompt: str, stream: bool = False):
+        time.sleep(self.latency_ms / 1000.0)
+        return FakeGeminiResponse(self._answer(prompt))
+    
+    async def generate_content_async(self, prompt: str, stream: bool = False):
+        if stream:
+            # Spread the latency over the streamed chunks, like a real model would
+            answer = self._answer(prompt)
+            return self._stream(answer)
+        await asyncio.sleep(self.latency_ms / 1000.0)
+        return FakeGeminiResponse(self._answer(prompt))
+    
+    async def _stream(self, answer: str):
+        pieces = [answer[i:i + self.chunk_chars] for i in range(0, len(answer), self.chunk_chars)] or [""]
+        for piece in pieces:
+            await asyncio.sleep(self.latency_ms / 1000.0 / len(pieces))
+            yield FakeGeminiResponse(piece)
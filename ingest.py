@@ -0,0 +1,517 @@
+import logging
+import asyncio
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Callable, Tuple
+
+from pdf_processor import PDFProcessor, StreamingChunker
+from document_registry import DocumentRegistry, file_sha256
+from metrics import Histogram, StageTimer
+
+logger = logging.getLogger(__name__)
+
+INGEST_STAGE_SECONDS = Histogram(
+    "rag_ingest_stage_seconds", "Time spent ingesting a file, by stage (extract, chunk, embed, write)", ["stage"]
+)
+
+
+def _inspect_file_worker(file_path: str) -> Tuple[str, int]:
+    """Hash a PDF and count its pages inside a worker process"""
+    return file_sha256(file_path), PDFProcessor().count_pages(file_path)
+
+
+def _extract_pages_worker(file_path: str, start_page: int, end_page: int) -> List[str]:
+    """
+    Extract the text of a page range inside a worker process.
+    
+    Kept at module level so it can be pickled by ProcessPoolExecutor.
+    """
+    return list(PDFProcessor().iter_page_texts(file_path, start_page, end_page))
+
+
+def _no_stage(stage: str) -> None:
+    pass
+
+
+def _no_progress(num_embedded_chunks: int) -> None:
+    pass
+
+
+class IngestPipeline:
+    def __init__(
+        self,
+        pdf_processor: PDFProcessor,
+        embedding_generator,
+        vector_db,
+        parse_workers: Optional[int] = None,
+        parse_concurrency: Optional[int] = None,
+        embed_concurrency: Optional[int] = None,
+        write_concurrency: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        page_window: Optional[int] = None,
+        window_prefetch: Optional[int] = None,
+        parallel: Optional[bool] = None,
+        registry: Optional[DocumentRegistry] = None
+    ):
+        """
+        Run PDF ingestion off the event loop
+        
+        PDF parsing happens in a process pool, embedding and vector DB writes in
+        thread pools of their own. Each stage has its own concurrency limit,
+        which also sizes its pool, so a large upload cannot starve the others.
+        
+        Documents are streamed: pages are extracted a window at a time, chunked
+        incrementally, and chunks are embedded and written in fixed-size batches,
+        so peak memory depends on the batch size rather than the document size.
+        
+        In parallel mode, page windows of every file in an upload are extracted
+        concurrently across the parser processes, and the chunks of all files
+        are funneled into a single batched embedding stage.
+        
+        With a document registry, re-uploading an unchanged file is a no-op and
+        a changed file only has the chunks that differ embedded and replaced.
+        
+        Args:
+            pdf_processor: Processor whose chunk settings are used by the workers
+            embedding_generator: EmbeddingGenerator used for chunk embeddings
+            vector_db: VectorDB the embedded chunks are written to by default
+            parse_workers: Number of parser processes (env INGEST_PARSE_WORKERS)
+            parse_concurrency: Max parser tasks in flight (env INGEST_PARSE_CONCURRENCY)
+            embed_concurrency: Embedding threads, and so max embedding batches in
+                flight (env INGEST_EMBED_CONCURRENCY)
+            write_concurrency: Writer threads, and so max vector DB writes in
+                flight (env INGEST_WRITE_CONCURRENCY)
+            batch_size: Chunks per embedding/write batch (env INGEST_BATCH_SIZE)
+            page_window: Pages extracted per parser task (env INGEST_PAGE_WINDOW)
+            window_prefetch: Page windows of one file extracted ahead (env INGEST_WINDOW_PREFETCH)
+            parallel: Process the files of an upload concurrently (env INGEST_PARALLEL)
+            registry: Optional default DocumentRegistry used to skip unchanged content
+        """
+        self.pdf_processor = pdf_processor
+        self.embedding_generator = embedding_generator
+        self.vector_db = vector_db
+        
+        self.parse_workers = parse_workers or int(os.getenv("INGEST_PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+        self.parse_concurrency = parse_concurrency or int(os.getenv("INGEST_PARSE_CONCURRENCY", str(self.parse_workers)))
+        self.embed_concurrency = embed_concurrency or int(os.getenv("INGEST_EMBED_CONCURRENCY", "1"))
+        self.write_concurrency = write_concurrency or int(os.getenv("INGEST_WRITE_CONCURRENCY", "1"))
+        self.batch_size = batch_size or int(os.getenv("INGEST_BATCH_SIZE", "64"))
+        self.page_window = page_window or int(os.getenv("INGEST_PAGE_WINDOW", "16"))
+        self.window_prefetch = window_prefetch or int(os.getenv("INGEST_WINDOW_PREFETCH", str(self.parse_workers)))
+        if parallel is None:
+            parallel = os.getenv("INGEST_PARALLEL", "true").lower() == "true"
+        self.parallel = parallel
+        self.registry = registry
+        
+        self.parse_executor = ProcessPoolExecutor(max_workers=self.parse_workers)
+        self.embed_executor = ThreadPoolExecutor(max_workers=self.embed_concurrency, thread_name_prefix="embedding")
+        self.write_executor = ThreadPoolExecutor(
+            max_workers=self.write_concurrency, thread_name_prefix="vector-db-writer"
+        )
+        
+        # Semaphores are created lazily so they bind to the running event loop
+        self._parse_semaphore = None
+        self._embed_semaphore = None
+        self._write_semaphore = None
+        
+        logger.info(f"Ingest pipeline ready: {self.parse_workers} parser processes, "
+                    f"limits parse={self.parse_concurrency} embed={self.embed_concurrency} write={self.write_concurrency}, "
+                    f"batch size {self.batch_size}, page window {self.page_window}, parallel={self.parallel}")
+    
+    def _semaphores(self):
+        if self._parse_semaphore is None:
+            self._parse_semaphore = asyncio.Semaphore(self.parse_concurrency)
+            self._embed_semaphore = asyncio.Semaphore(self.embed_concurrency)
+            self._write_semaphore = asyncio.Semaphore(self.write_concurrency)
+        return self._parse_semaphore, self._embed_semaphore, self._write_semaphore
+    
+    async def ingest_file(
+        self,
+        file_path: str,
+        source_name: str,
+        on_stage: Optional[Callable[[str], None]] = None,
+        vector_db=None,
+        registry: Optional[DocumentRegistry] = None,
+        on_progress: Optional[Callable[[int], None]] = None,
+        quota=None
+    ) -> int:
+        """
+        Parse, embed and store a single PDF without blocking the event loop
+        
+        Args:
+            file_path: Path to the PDF file on disk
+            source_name: Name stored as the chunk source (the original filename)
+            on_stage: Optional callback told when the file enters each stage
+                ("extracting", "embedding", "writing"); stages repeat per batch
+            vector_db: VectorDB to write to instead of the pipeline's own
+            registry: DocumentRegistry to use instead of the pipeline's own
+            on_progress: Optional callback told the number of the file's chunks
+                embedded so far
+            quota: Optional chunk quota to enforce, see ingest_files
+                
+        Returns:
+            Number of chunks added to the vector DB
+        """
+        result = await self.ingest_files(
+            [(file_path, source_name)], [on_stage or _no_stage], vector_db=vector_db, registry=registry,
+            on_progress=[on_progress or _no_progress], quota=quota
+        )
+        file_result = result["files"][0]
+        if file_result["error"] is not None:
+            raise file_result["error"]
+        return file_result["num_chunks"]
+    
+    async def ingest_files(
+        self,
+        files: List[Tuple[str, str]],
+        on_stage: Optional[List[Callable[[str], None]]] = None,
+        vector_db=None,
+        registry: Optional[DocumentRegistry] = None,
+        on_progress: Optional[List[Callable[[int], None]]] = None,
+        quota=None
+    ) -> Dict[str, Any]:
+        """
+        Parse, embed and store several PDFs through one shared embedding stage
+        
+        The parser processes and embedding thread are shared by every caller;
+        vector_db and registry select where this call's documents are stored,
+        so one pipeline can serve several isolated indexes.
+        
+        Args:
+            files: List of (file_path, source_name) pairs
+            on_stage: Optional per-file stage callbacks, aligned with files
+            vector_db: VectorDB to write to (defaults to the pipeline's own)
+            registry: DocumentRegistry to use (defaults to the pipeline's own)
+            on_progress: Optional per-file callbacks, aligned with files, told
+                the number of the file's chunks embedded so far; they are called
+                from the embedding thread
+            quota: Optional object with reserve_chunks(n) and release_chunks(n),
+                such as a Workspace. Room is reserved for every batch before it
+                is embedded; if reserve_chunks raises, the batch's files fail
+                and none of their remaining chunks are written
+            
+        Returns:
+            Dictionary with per-file results under "files" ("num_pages",
+            "num_chunks", "num_new_chunks", "num_embedded_chunks",
+            "num_removed_chunks", "unchanged", "error", and "stage_timings" in
+            seconds for extract, chunk, embed and write) and overall
+            throughput figures under "throughput"
+        """
+        on_stage = on_stage or [_no_stage] * len(files)
+        on_progress = on_progress or [_no_progress] * len(files)
+        vector_db = vector_db if vector_db is not None else self.vector_db
+        registry = registry if registry is not None else self.registry
+        results = [{
+            "num_pages": 0,
+            "num_chunks": 0,
+            "num_new_chunks": 0,
+            "num_embedded_chunks": 0,
+            "num_removed_chunks": 0,
+            "unchanged": False,
+            "error": None,
+            "sha256": None,
+            "chunk_ids": [],
+            "existing_chunk_ids": set(),
+            "written_chunk_ids": [],
+            "timer": StageTimer()
+        } for _ in files]
+        start_time = time.perf_counter()
+        
+        # Bounded funnel between the extractors and the embedding stage
+        chunk_queue = asyncio.Queue(maxsize=self.batch_size * 4)
+        consumer = asyncio.create_task(
+            self._consume_chunks(chunk_queue, results, on_stage, on_progress, vector_db, quota)
+        )
+        
+        async def produce(index: int, file_path: str, source_name: str) -> None:
+            try:
+                await self._produce_chunks(
+                    index, file_path, source_name, chunk_queue, results[index], on_stage[index], registry
+                )
+            except Exception as e:
+                logger.error(f"Error extracting {source_name}: {str(e)}")
+                results[index]["error"] = e
+        
+        try:
+            if self.parallel:
+                await asyncio.gather(*(produce(i, path, name) for i, (path, name) in enumerate(files)))
+            else:
+                for i, (path, name) in enumerate(files):
+                    await produce(i, path, name)
+            await chunk_queue.put(None)
+            await consumer
+        finally:
+            if not consumer.done():
+                consumer.cancel()
+        
+        for (_, source_name), result in zip(files, results):
+            await self._finalize_document(source_name, result, vector_db, registry)
+        
+        elapsed = time.perf_counter() - start_time
+        # Unchanged files were skipped, so they do not count towards throughput
+        processed = [result for result in results if not result["unchanged"]]
+        num_pages = sum(result["num_pages"] for result in processed)
+        num_chunks = sum(result["num_chunks"] for result in processed)
+        throughput = {
+            "files": len(files),
+            "pages": num_pages,
+            "chunks": num_chunks,
+            "seconds": round(elapsed, 4),
+            "pages_per_second": round(num_pages / elapsed, 2) if elapsed > 0 else 0.0,
+            "chunks_per_second": round(num_chunks / elapsed, 2) if elapsed > 0 else 0.0
+        }
+        logger.info(f"Ingested {len(files)} files: {num_pages} pages, {num_chunks} chunks in {elapsed:.2f}s "
+                    f"({throughput['pages_per_second']} pages/s, {throughput['chunks_per_second']} chunks/s)")
+        
+        for result in results:
+            del result["chunk_ids"]
+            del result["existing_chunk_ids"]
+            del result["written_chunk_ids"]
+            timer = result.pop("timer")
+            timer.observe(INGEST_STAGE_SECONDS)
+            result["stage_timings"] = {name: round(seconds, 4) for name, seconds in timer.timings.items()}
+        return {"files": results, "throughput": throughput}
+    
+    async def _finalize_document(
+        self,
+        source_name: str,
+        result: Dict[str, Any],
+        vector_db,
+        registry: Optional[DocumentRegistry]
+    ) -> None:
+        """Drop chunks that no longer exist in a re-uploaded file and record the document"""
+        if result["unchanged"]:
+            return
+        if result["error"] is not None:
+            await self._discard_written_chunks(source_name, result, vector_db)
+            return
+        result["num_chunks"] = len(result["chunk_ids"])
+        if registry is None:
+            return
+        
+        loop = asyncio.get_running_loop()
+        current_ids = set(result["chunk_ids"])
+        stale_ids = [chunk_id for chunk_id in result["existing_chunk_ids"] if chunk_id not in current_ids]
+        result["num_removed_chunks"] = len(stale_ids)
+        
+        def write() -> None:
+            vector_db.delete_chunks(stale_ids)
+            registry.save(
+                source_name,
+                result["sha256"],
+                result["num_pages"],
+                result["chunk_ids"],
+                embedding_model=getattr(self.embedding_generator, "model_name", None)
+            )
+        
+        try:
+            with result["timer"].stage("write"):
+                await loop.run_in_executor(self.write_executor, write)
+        except Exception as e:
+            logger.error(f"Error updating document registry for {source_name}: {str(e)}")
+            result["error"] = e
+    
+    async def _discard_written_chunks(self, source_name: str, result: Dict[str, Any], vector_db) -> None:
+        """Remove the chunks a failed file had already written, so no uncatalogued part of it stays searchable"""
+        if not result["written_chunk_ids"]:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.write_executor, vector_db.delete_chunks, result["written_chunk_ids"])
+            logger.info(f"Removed {len(result['written_chunk_ids'])} chunks written before {source_name} failed")
+        except Exception as e:
+            logger.error(f"Error removing the chunks of failed file {source_name}: {str(e)}")
+    
+    async def _extract_window(self, file_path: str, start_page: int) -> List[str]:
+        loop = asyncio.get_running_loop()
+        parse_semaphore, _, _ = self._semaphores()
+        async with parse_semaphore:
+            return await loop.run_in_executor(
+                self.parse_executor,
+                _extract_pages_worker,
+                file_path,
+                start_page,
+                start_page + self.page_window
+            )
+    
+    async def _produce_chunks(
+        self,
+        index: int,
+        file_path: str,
+        source_name: str,
+        chunk_queue: asyncio.Queue,
+        result: Dict[str, Any],
+        on_stage: Callable[[str], None],
+        registry: Optional[DocumentRegistry]
+    ) -> None:
+        """Extract a file's page windows concurrently and feed its chunks, in order, to the queue"""
+        loop = asyncio.get_running_loop()
+        parse_semaphore, _, _ = self._semaphores()
+        chunker = StreamingChunker(source_name, self.pdf_processor.chunk_size, self.pdf_processor.chunk_overlap)
+        
+        timer = result["timer"]
+        on_stage("extracting")
+        with timer.stage("extract"):
+            async with parse_semaphore:
+                result["sha256"], result["num_pages"] = await loop.run_in_executor(
+                    self.parse_executor, _inspect_file_worker, file_path
+                )
+        
+        if registry is not None:
+            # Catalog reads block (on SQLite or the model service), so they run off the event loop
+            existing = await loop.run_in_executor(None, registry.get, source_name)
+            if existing is not None and existing["sha256"] == result["sha256"]:
+                logger.info(f"{source_name} is unchanged since it was last ingested, skipping")
+                result["unchanged"] = True
+                result["num_chunks"] = existing["num_chunks"]
+                return
+            if existing is not None:
+                result["existing_chunk_ids"] = set(
+                    await loop.run_in_executor(None, registry.get_chunk_ids, source_name)
+                )
+        
+        logger.debug(f"Streaming {result['num_pages']} pages from {source_name}")
+        
+        # Keep up to window_prefetch page windows in flight, consuming them in page order
+        window_starts = iter(range(0, result["num_pages"], self.page_window))
+        in_flight = deque()
+        
+        def schedule_next() -> None:
+            start_page = next(window_starts, None)
+            if start_page is not None:
+                in_flight.append(asyncio.create_task(self._extract_window(file_path, start_page)))
+        
+        try:
+            for _ in range(self.window_prefetch):
+                schedule_next()
+            
+            while in_flight:
+                with timer.stage("extract"):
+                    page_texts = await in_flight.popleft()
+                schedule_next()
+                for page_text in page_texts:
+                    with timer.stage("chunk"):
+                        chunks = chunker.feed(page_text)
+                    for chunk in chunks:
+                        await self._emit_chunk(index, chunk, chunk_queue, result)
+            
+            with timer.stage("chunk"):
+                chunks = chunker.finish()
+            for chunk in chunks:
+                await self._emit_chunk(index, chunk, chunk_queue, result)
+        finally:
+            for task in in_flight:
+                task.cancel()
+    
+    async def _emit_chunk(
+        self,
+        index: int,
+        chunk: Dict[str, Any],
+        chunk_queue: asyncio.Queue,
+        result: Dict[str, Any]
+    ) -> None:
+        result["chunk_ids"].append(chunk["id"])
+        # Chunks already stored from a previous version of the file are kept as-is
+        if chunk["id"] not in result["existing_chunk_ids"]:
+            await chunk_queue.put((index, chunk))
+    
+    async def _consume_chunks(
+        self,
+        chunk_queue: asyncio.Queue,
+        results: List[Dict[str, Any]],
+        on_stage: List[Callable[[str], None]],
+        on_progress: List[Callable[[int], None]],
+        vector_db,
+        quota
+    ) -> None:
+        """Single embedding stage: batch chunks from every file and store them"""
+        batch = []
+        while True:
+            item = await chunk_queue.get()
+            if item is not None:
+                batch.append(item)
+            if batch and (item is None or len(batch) >= self.batch_size):
+                await self._store_batch(batch, results, on_stage, on_progress, vector_db, quota)
+                batch = []
+            if item is None:
+                return
+    
+    async def _store_batch(
+        self,
+        batch: List[Tuple[int, Dict[str, Any]]],
+        results: List[Dict[str, Any]],
+        on_stage: List[Callable[[str], None]],
+        on_progress: List[Callable[[int], None]],
+        vector_db,
+        quota
+    ) -> None:
+        """Embed a batch of chunks in the embedding thread and write it to the vector DB"""
+        # Files that already failed (e.g. over quota) get no more chunks written
+        batch = [(index, chunk) for index, chunk in batch if results[index]["error"] is None]
+        if not batch:
+            return
+        loop = asyncio.get_running_loop()
+        _, embed_semaphore, write_semaphore = self._semaphores()
+        file_indexes = sorted({index for index, _ in batch})
+        chunks = [chunk for _, chunk in batch]
+        embedded_before = {index: results[index]["num_embedded_chunks"] for index in file_indexes}
+        
+        def credit(index: int, num_chunks: int) -> None:
+            results[index]["num_embedded_chunks"] = embedded_before[index] + num_chunks
+            on_progress[index](results[index]["num_embedded_chunks"])
+        
+        # Chunks are encoded shortest first, so progress within the batch can
+        # only be credited as it happens when the batch holds a single file
+        progress = None
+        if len(file_indexes) == 1:
+            progress = lambda done, _: credit(file_indexes[0], done)
+        
+        reserved = False
+        try:
+            if quota is not None:
+                # Checked before embedding, so chunks over the quota are not embedded for nothing
+                await loop.run_in_executor(None, quota.reserve_chunks, len(chunks))
+                reserved = True
+            for index in file_indexes:
+                on_stage[index]("embedding")
+            stage_start = time.perf_counter()
+            async with embed_semaphore:
+                chunks = await loop.run_in_executor(
+                    self.embed_executor,
+                    self.embedding_generator.process_chunks,
+                    chunks,
+                    progress
+                )
+            for index, num_chunks in Counter(index for index, _ in batch).items():
+                credit(index, num_chunks)
+            # The batch is shared, so every file in it waited for the whole batch
+            for index in file_indexes:
+                results[index]["timer"].add("embed", time.perf_counter() - stage_start)
+            
+            for index in file_indexes:
+                on_stage[index]("writing")
+            stage_start = time.perf_counter()
+            async with write_semaphore:
+                await loop.run_in_executor(self.write_executor, vector_db.add_chunks, chunks)
+            for index in file_indexes:
+                results[index]["timer"].add("write", time.perf_counter() - stage_start)
+            
+            for index, chunk in batch:
+                results[index]["num_new_chunks"] += 1
+                results[index]["written_chunk_ids"].append(chunk["id"])
+        except Exception as e:
+            # Keep draining the queue so the other files can finish
+            logger.error(f"Error storing batch of {len(chunks)} chunks: {str(e)}")
+            for index in file_indexes:
+                results[index]["error"] = e
+        finally:
+            if reserved:
+                quota.release_chunks(len(chunks))
+    
+    def shutdown(self) -> None:
+        """Stop the worker pools"""
+        self.parse_executor.shutdown(wait=False, cancel_futures=True)
+        self.embed_executor.shutdown(wait=False, cancel_futures=True)
+        self.write_executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,272 @@
+import logging
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """Raised when the ingestion queue cannot accept more jobs"""
+
+
+class IngestJob:
+    def __init__(self, filename: str, file_path: str, workspace=None):
+        """
+        State of a single file moving through the ingestion pipeline
+        
+        Args:
+            filename: Original name of the uploaded file
+            file_path: Temporary path the upload was saved to
+            workspace: Optional Workspace the file is ingested into
+        """
+        self.job_id = uuid.uuid4().hex
+        self.filename = filename
+        self.file_path = file_path
+        self.workspace = workspace
+        self.workspace_name = workspace.name if workspace is not None else None
+        self.status = "queued"
+        self.stage = "queued"
+        self.num_pages = 0
+        self.num_chunks = 0
+        self.num_new_chunks = 0
+        # Updated from the embedding thread while the file is being embedded
+        self.num_embedded_chunks = 0
+        self.num_removed_chunks = 0
+        self.unchanged = False
+        self.throughput = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.timings = {}
+        # Time spent in extract, chunk, embed and write, as measured by the pipeline
+        self.stage_timings = {}
+        self._stage_started = None
+        self._done = asyncio.Event()
+    
+    def set_stage(self, stage: str) -> None:
+        """Move the job to a new stage and record how long the previous one took"""
+        now = time.time()
+        if self._stage_started is not None and self.stage not in ("queued", "done", "error"):
+            # Streaming ingestion revisits stages once per batch, so accumulate
+            self.timings[self.stage] = round(self.timings.get(self.stage, 0) + now - self._stage_started, 4)
+        self.stage = stage
+        self._stage_started = now
+    
+    def set_progress(self, num_embedded_chunks: int) -> None:
+        """Record how many of the file's new chunks have been embedded so far"""
+        self.num_embedded_chunks = num_embedded_chunks
+    
+    def finish(self, status: str, error: Optional[str] = None) -> None:
+        """Mark the job as finished with the given status"""
+        self.set_stage("done" if status != "error" else "error")
+        self.status = status
+        self.error = error
+        self.finished_at = time.time()
+        if self.started_at is not None:
+            self.timings["total"] = round(self.finished_at - self.started_at, 4)
+        self._done.set()
+    
+    async def wait(self) -> None:
+        """Wait until the job has finished"""
+        await self._done.wait()
+    
+    @property
+    def is_finished(self) -> bool:
+        return self.finished_at is not None
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "filename": self.filename,
+            "workspace": self.workspace_name,
+            "status": self.status,
+            "stage": self.stage,
+            "num_pages": self.num_pages,
+            "num_chunks": self.num_chunks,
+            "num_new_chunks": self.num_new_chunks,
+            "num_embedded_chunks": self.num_embedded_chunks,
+            "num_removed_chunks": self.num_removed_chunks,
+            "unchanged": self.unchanged,
+            "throughput": self.throughput,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "timings": dict(self.timings),
+            "stage_timings": dict(self.stage_timings)
+        }
+
+
+class IngestJobQueue:
+    def __init__(
+        self,
+        pipeline,
+        num_workers: Optional[int] = None,
+        max_pending: Optional[int] = None,
+        history_limit: Optional[int] = None,
+        on_complete: Optional[Callable[[IngestJob], None]] = None
+    ):
+        """
+        Bounded background queue that feeds uploads into the ingest pipeline
+        
+        Each upload is queued as one batch so its files can be ingested
+        together through the pipeline's shared embedding stage.
+        
+        Args:
+            pipeline: IngestPipeline used to process each batch of files
+            num_workers: Number of uploads processed concurrently (env INGEST_QUEUE_WORKERS)
+            max_pending: Max files waiting in the queue before rejecting (env INGEST_QUEUE_SIZE)
+            history_limit: Number of finished jobs kept for status lookups (env INGEST_JOB_HISTORY)
+            on_complete: Callback run with the job after a file is stored successfully
+        """
+        self.pipeline = pipeline
+        self.num_workers = num_workers or int(os.getenv("INGEST_QUEUE_WORKERS", "2"))
+        self.max_pending = max_pending or int(os.getenv("INGEST_QUEUE_SIZE", "100"))
+        self.history_limit = history_limit or int(os.getenv("INGEST_JOB_HISTORY", "1000"))
+        self.on_complete = on_complete
+        
+        self.jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self._queue = None
+        self._workers = []
+        self._pending_files = 0
+    
+    async def start(self) -> None:
+        """Start the background workers (call from the running event loop)"""
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.num_workers)]
+        logger.info(f"Ingestion queue started with {self.num_workers} workers, capacity {self.max_pending} files")
+    
+    async def stop(self) -> None:
+        """Cancel the background workers"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+    
+    def free_slots(self) -> int:
+        """Number of files that can still be queued"""
+        if self._queue is None:
+            return 0
+        return self.max_pending - self._pending_files
+    
+    def submit(self, files: List[Tuple[str, str]], workspace=None) -> List[IngestJob]:
+        """
+        Queue saved uploads for ingestion as one batch
+        
+        Args:
+            files: List of (filename, file_path) pairs; the files are removed once processed
+            workspace: Optional Workspace whose vector DB and catalog receive the
+                files; it stays pinned (not evicted) until the batch is done
+            
+        Returns:
+            One queued job per file
+            
+        Raises:
+            JobQueueFull: If the queue cannot take all of the files
+        """
+        if self._queue is None:
+            raise JobQueueFull("Ingestion queue is not running")
+        if self.free_slots() < len(files):
+            raise JobQueueFull(f"Ingestion queue is full ({self.max_pending} pending files)")
+        
+        jobs = [IngestJob(filename, file_path, workspace) for filename, file_path in files]
+        if workspace is not None:
+            workspace.pin()
+        self._pending_files += len(jobs)
+        self._queue.put_nowait(jobs)
+        
+        for job in jobs:
+            self.jobs[job.job_id] = job
+        self._trim_history()
+        return jobs
+    
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        return self.jobs.get(job_id)
+    
+    def _trim_history(self) -> None:
+        # Drop the oldest finished jobs once we keep more than history_limit
+        excess = len(self.jobs) - self.history_limit
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.is_finished][:excess]:
+            del self.jobs[job_id]
+    
+    async def _worker(self, worker_id: int) -> None:
+        while True:
+            jobs = await self._queue.get()
+            try:
+                await self._run_jobs(jobs)
+            finally:
+                self._pending_files -= len(jobs)
+                self._queue.task_done()
+    
+    async def _run_jobs(self, jobs: List[IngestJob]) -> None:
+        started_at = time.time()
+        for job in jobs:
+            job.started_at = started_at
+            job.timings["queued"] = round(started_at - job.created_at, 4)
+            job.status = "processing"
+            logger.info(f"Processing file: {job.filename} (job {job.job_id})")
+        
+        workspace = jobs[0].workspace
+        try:
+            target = {}
+            if workspace is not None:
+                target = {"vector_db": workspace.vector_db, "registry": workspace.registry, "quota": workspace}
+            result = await self.pipeline.ingest_files(
+                [(job.file_path, job.filename) for job in jobs],
+                [job.set_stage for job in jobs],
+                on_progress=[job.set_progress for job in jobs],
+                **target
+            )
+            
+            for job, file_result in zip(jobs, result["files"]):
+                job.num_pages = file_result["num_pages"]
+                job.num_chunks = file_result["num_chunks"]
+                job.num_new_chunks = file_result["num_new_chunks"]
+                job.num_embedded_chunks = file_result["num_embedded_chunks"]
+                job.num_removed_chunks = file_result["num_removed_chunks"]
+                job.unchanged = file_result["unchanged"]
+                job.stage_timings = file_result["stage_timings"]
+                job.throughput = result["throughput"]
+                self._finish_job(job, file_result["error"])
+        except Exception as e:
+            logger.exception(f"Error processing batch: {str(e)}")
+            for job in jobs:
+                if not job.is_finished:
+                    job.finish("error", str(e))
+        finally:
+            if workspace is not None:
+                workspace.unpin()
+            for job in jobs:
+                # Finished jobs stay in the history; do not keep evicted workspaces alive
+                job.workspace = None
+                try:
+                    if os.path.exists(job.file_path):
+                        os.unlink(job.file_path)
+                except Exception as e:
+                    logger.warning(f"Could not delete temporary file {job.file_path}: {str(e)}")
+    
+    def _finish_job(self, job: IngestJob, error: Optional[Exception]) -> None:
+        if error is not None:
+            logger.error(f"Error processing {job.filename}: {str(error)}")
+            job.finish("error", str(error))
+            return
+        
+        if not job.num_chunks:
+            logger.warning(f"No chunks were created for {job.filename}")
+            job.finish("warning", "No text content could be extracted from this PDF.")
+            return
+        
+        if self.on_complete:
+            self.on_complete(job)
+        job.finish("success")
+        logger.info(f"Successfully processed {job.filename} with {job.num_chunks} chunks")
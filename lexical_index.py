@@ -0,0 +1,270 @@
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+from typing import Dict, Any, List, Optional, Callable, Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Words, numbers and joined identifiers such as part numbers (XJ-900), error
+# codes (0x80070005) and versions (v2.1.3)
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./:][a-z0-9]+)*")
+PART_SEPARATORS = re.compile(r"[-_./:]")
+
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have how in is it its of on or that the "
+    "this to was were what when where which who why will with do does did can".split()
+)
+
+
+def tokenize(text: str) -> Iterator[str]:
+    """
+    Lowercased index terms of a text
+    
+    Joined identifiers are kept whole, so exact codes match exactly, and are
+    also split into their parts so "XJ 900" still finds "XJ-900".
+    """
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token not in STOPWORDS:
+            yield token
+        if PART_SEPARATORS.search(token):
+            for part in PART_SEPARATORS.split(token):
+                if part and part not in STOPWORDS:
+                    yield part
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[str]:
+    """
+    Merge ranked ID lists by reciprocal rank fusion
+    
+    Each list contributes 1 / (k + rank) for every ID it contains, so IDs
+    ranked well by several retrievers rise to the top without having to
+    calibrate their scores against each other.
+    
+    Args:
+        rankings: ID lists, best first
+        k: Damping constant; 60 is the value from the original RRF paper
+    
+    Returns:
+        All IDs ordered by fused score, best first
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda item: scores[item], reverse=True)
+
+
+class LexicalIndex:
+    def __init__(
+        self,
+        path: str,
+        backfill: Optional[Callable[[], List[Dict[str, Any]]]] = None,
+        k1: float = 1.2,
+        b: float = 0.75
+    ):
+        """
+        Persistent SQLite inverted index with BM25 scoring
+        
+        Postings are added and removed per chunk as the vector DB changes, so
+        the index never needs a full rebuild. Document frequencies and corpus
+        length statistics are maintained incrementally alongside them.
+        
+        Args:
+            path: SQLite file holding the index
+            backfill: Optional function returning the chunks (id, text and
+                metadata) of a vector DB populated before the index existed;
+                called once if the index is empty
+            k1: BM25 term frequency saturation
+            b: BM25 length normalization
+        """
+        self.path = path
+        self.backfill = backfill
+        self.k1 = k1
+        self.b = b
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        
+        self._lock = threading.RLock()
+        self._conn = None
+        self._num_chunks = None
+        self._total_length = 0
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS lexical_chunks ("
+                "chunk_id TEXT PRIMARY KEY, source TEXT NOT NULL, length INTEGER NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS lexical_terms ("
+                "term TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS lexical_postings ("
+                "term TEXT NOT NULL, chunk_id TEXT NOT NULL, tf INTEGER NOT NULL, "
+                "PRIMARY KEY (term, chunk_id)) WITHOUT ROWID"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS lexical_postings_by_chunk ON lexical_postings (chunk_id)"
+            )
+            self._conn.commit()
+        return self._conn
+    
+    def _load(self) -> sqlite3.Connection:
+        """Read the corpus statistics on first use"""
+        with self._lock:
+            conn = self._connect()
+            if self._num_chunks is None:
+                self._num_chunks, total_length = conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM lexical_chunks"
+                ).fetchone()
+                self._total_length = total_length
+                logger.info(f"Loaded lexical index {self.path} with {self._num_chunks} chunks")
+                
+                if not self._num_chunks and self.backfill is not None:
+                    self._backfill()
+            return conn
+    
+    def _backfill(self) -> None:
+        existing = self.backfill()
+        if not existing:
+            return
+        logger.info(f"Backfilling lexical index with {len(existing)} chunks found in the vector DB")
+        self.add_chunks([
+            {"id": chunk["id"], "text": chunk["text"], "source": chunk["metadata"].get("source", "unknown")}
+            for chunk in existing
+        ])
+    
+    def __len__(self) -> int:
+        self._load()
+        return self._num_chunks
+    
+    def add_chunks(self, chunks: List[Dict[str, Any]]) -> None:
+        """
+        Index chunks, replacing the postings of chunks that are already indexed
+        
+        Args:
+            chunks: Chunks with id, text and source
+        """
+        if not chunks:
+            return
+        
+        with self._lock:
+            conn = self._load()
+            with conn:
+                self._remove(conn, [chunk["id"] for chunk in chunks])
+                
+                document_frequencies = Counter()
+                postings = []
+                rows = []
+                for chunk in chunks:
+                    term_counts = Counter(tokenize(chunk["text"]))
+                    length = sum(term_counts.values())
+                    rows.append((chunk["id"], chunk["source"], length))
+                    postings.extend((term, chunk["id"], tf) for term, tf in term_counts.items())
+                    document_frequencies.update(term_counts.keys())
+                    self._num_chunks += 1
+                    self._total_length += length
+                
+                conn.executemany(
+                    "INSERT INTO lexical_chunks (chunk_id, source, length) VALUES (?, ?, ?)", rows
+                )
+                conn.executemany(
+                    "INSERT INTO lexical_postings (term, chunk_id, tf) VALUES (?, ?, ?)", postings
+                )
+                conn.executemany(
+                    "INSERT INTO lexical_terms (term, df) VALUES (?, ?) "
+                    "ON CONFLICT (term) DO UPDATE SET df = df + excluded.df",
+                    document_frequencies.items()
+                )
+    
+    def delete_chunks(self, ids: List[str]) -> None:
+        """Remove the postings of the given chunks"""
+        if not ids:
+            return
+        
+        with self._lock:
+            conn = self._load()
+            with conn:
+                self._remove(conn, ids)
+    
+    def _remove(self, conn: sqlite3.Connection, ids: List[str]) -> None:
+        """Delete chunks and their postings and update the statistics; caller holds the lock"""
+        batch_size = 400
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            placeholders = ",".join("?" * len(batch))
+            removed = conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM lexical_chunks WHERE chunk_id IN ({placeholders})", batch
+            ).fetchone()
+            if not removed[0]:
+                continue
+            
+            conn.execute(
+                "UPDATE lexical_terms SET df = df - ("
+                f"SELECT COUNT(*) FROM lexical_postings p WHERE p.term = lexical_terms.term AND p.chunk_id IN ({placeholders})) "
+                f"WHERE term IN (SELECT term FROM lexical_postings WHERE chunk_id IN ({placeholders}))",
+                batch + batch
+            )
+            conn.execute("DELETE FROM lexical_terms WHERE df <= 0")
+            conn.execute(f"DELETE FROM lexical_postings WHERE chunk_id IN ({placeholders})", batch)
+            conn.execute(f"DELETE FROM lexical_chunks WHERE chunk_id IN ({placeholders})", batch)
+            self._num_chunks -= removed[0]
+            self._total_length -= removed[1]
+    
+    def search(self, query: str, n_results: int = 5, filter_source: Optional[str] = None) -> List[Tuple[str, float]]:
+        """
+        Rank chunks against a query with BM25
+        
+        Args:
+            query: Query text
+            n_results: Number of results to return
+            filter_source: Only return chunks from this source
+        
+        Returns:
+            List of (chunk ID, score), best first
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        
+        with self._lock:
+            conn = self._load()
+            if not self._num_chunks:
+                return []
+            num_chunks = self._num_chunks
+            average_length = self._total_length / num_chunks or 1.0
+            
+            scores = {}
+            for term in terms:
+                row = conn.execute("SELECT df FROM lexical_terms WHERE term = ?", (term,)).fetchone()
+                if row is None:
+                    continue
+                idf = math.log(1.0 + (num_chunks - row[0] + 0.5) / (row[0] + 0.5))
+                
+                sql = (
+                    "SELECT p.chunk_id, p.tf, c.length FROM lexical_postings p "
+                    "JOIN lexical_chunks c ON c.chunk_id = p.chunk_id WHERE p.term = ?"
+                )
+                params = [term]
+                if filter_source:
+                    sql += " AND c.source = ?"
+                    params.append(filter_source)
+                
+                for chunk_id, tf, length in conn.execute(sql, params):
+                    norm = self.k1 * (1.0 - self.b + self.b * length / average_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.k1 + 1.0) / (tf + norm)
+        
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:n_results]
+    
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
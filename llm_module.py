@@ -1,41 +1,67 @@
-import google.generativeai as genai
+import logging
+import asyncio
 import os
+import threading
 import time
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, AsyncIterator
 from dotenv import load_dotenv
 import re
 import random
 
+from context_packer import ContextPacker
+
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv("config.env")
 
+def is_retryable_error(error: Exception) -> bool:
+    """Whether a Gemini API error is transient (rate limit, overload or timeout)"""
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    if type(error).__name__ in ("ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "InternalServerError"):
+        return True
+    message = str(error)
+    return any(marker in message for marker in ("429", "500", "503", "Resource has been exhausted"))
+
+
 class LLMModule:
-    def __init__(self, model_name: str = None):
+    def __init__(self, model_name: str = None, client=None, context_packer: Optional[ContextPacker] = None):
         """
         Initialize the LLM module with Gemini API
         
         Args:
             model_name: Gemini model name (optional, defaults to env variable)
+            client: Optional model object with generate_content/generate_content_async,
+                used instead of Gemini (e.g. a FakeGeminiModel); GEMINI_FAKE=true
+                selects the local fake
+            context_packer: ContextPacker that fits retrieved chunks into the
+                prompt token budget (defaults to one configured from env)
         """
-        print("Initializing Gemini LLM module")
+        logger.info("Initializing Gemini LLM module")
         start_time = time.time()
         
         try:
-            # Get API key from environment variable
-            api_key = os.getenv("GEMINI_API_KEY")
-            if not api_key or api_key == "your_gemini_api_key_here":
-                raise ValueError("Please set your Gemini API key in config.env file")
+            if client is None and os.getenv("GEMINI_FAKE", "false").lower() == "true":
+                from fake_gemini import FakeGeminiModel
+                client = FakeGeminiModel()
+                logger.info("Using local fake Gemini model")
             
-            # Configure Gemini API
-            genai.configure(api_key=api_key)
+            self.api_key = None
+            if client is None:
+                # Get API key from environment variable
+                api_key = os.getenv("GEMINI_API_KEY")
+                if not api_key or api_key == "your_gemini_api_key_here":
+                    raise ValueError("Please set your Gemini API key in config.env file")
+                self.api_key = api_key
             
             # Set up the model
             self.model_name = model_name or os.getenv("GEMINI_MODEL", "gemini-1.5-pro")
             self.temperature = float(os.getenv("TEMPERATURE", "0.2"))
             self.max_tokens = int(os.getenv("MAX_TOKENS", "1024"))
             
-            print(f"Using Gemini model: {self.model_name}")
-            print(f"Model configured successfully in {time.time() - start_time:.2f} seconds")
+            logger.info(f"Using Gemini model: {self.model_name}")
+            logger.info(f"Model configured successfully in {time.time() - start_time:.2f} seconds")
             
             # Generation config
             self.generation_config = {
@@ -45,33 +71,67 @@ class LLMModule:
                 "top_k": 0,
             }
             
+            # Created on first use (or by warm_up()) and reused, with its connection, for every request
+            self._model = client
+            self._model_lock = threading.Lock()
+            
+            # Async generation limits: concurrency, retries with backoff and an overall deadline
+            self.max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+            self.max_retries = int(os.getenv("LLM_MAX_RETRIES", "3"))
+            self.backoff_base = float(os.getenv("LLM_BACKOFF_BASE", "1.0"))
+            self.backoff_max = float(os.getenv("LLM_BACKOFF_MAX", "20.0"))
+            self.deadline = float(os.getenv("LLM_DEADLINE_SECONDS", "60"))
+            self._semaphore = None
+            
+            self.context_packer = context_packer or ContextPacker()
+            
         except Exception as e:
-            print(f"Error initializing Gemini model: {e}")
+            logger.error(f"Error initializing Gemini model: {e}")
             raise
     
-    def generate_answer(self, question: str, contexts: List[str], max_length: int = 1024) -> str:
+    @property
+    def model(self):
+        """The Gemini model; the SDK is imported and configured on first access"""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    import google.generativeai as genai
+                    genai.configure(api_key=self.api_key)
+                    self._model = genai.GenerativeModel(
+                        model_name=self.model_name,
+                        generation_config=self.generation_config
+                    )
+        return self._model
+    
+    def warm_up(self) -> None:
+        """Import the SDK and create the model ahead of the first request"""
+        self.model
+    
+    def generate_answer(self, question: str, contexts: List[str], deadline: Optional[float] = None) -> str:
         """
-        Generate an answer to a question based on the provided contexts using Gemini API
+        Generate an answer from synchronous code such as scripts
+        
+        Runs agenerate_answer on a private event loop, so both share one retry
+        policy (backoff with jitter, bounded by the deadline) and the local
+        extraction fallback. Async callers must use agenerate_answer directly.
         
         Args:
             question: The question to answer
             contexts: List of context passages from documents
-            max_length: Maximum output length (overridden by env variable)
+            deadline: Overall time limit in seconds (defaults to LLM_DEADLINE_SECONDS)
             
         Returns:
             Generated answer
         """
-        if not contexts:
-            return "No context information available to answer this question."
-            
-        print(f"Generating answer for question: '{question}'")
-        print(f"Using {len(contexts)} context passages")
-        
-        # Combine context passages into a single context with appropriate handling
-        combined_context = "\n\n".join(contexts[:5])  # Use up to 5 context chunks
+        return asyncio.run(self.agenerate_answer(question, contexts, deadline))
+    
+    def _build_prompt(self, question: str, contexts: List[str]) -> str:
+        """Build the Gemini prompt from the question and context passages"""
+        # Contexts are already packed to the prompt token budget by filter_relevant_contexts
+        combined_context = "\n\n".join(contexts)
         
         # Create an improved prompt
-        prompt = f"""You are an intelligent assistant tasked with answering questions based mostly on the provided context information.
+        return f"""You are an intelligent assistant tasked with answering questions based mostly on the provided context information.
 Your goal is to be accurate, comprehensive, and helpful.
 
 CONTEXT INFORMATION:
@@ -83,58 +143,145 @@ IMPORTANT INSTRUCTIONS:
 QUESTION: {question}
 
 ANSWER:"""
+
+    def _semaphore_for_loop(self) -> asyncio.Semaphore:
+        # Created lazily so it binds to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+    
+    def _backoff_delay(self, attempt: int) -> float:
+        """Exponential backoff with full jitter for the given retry attempt (1-based)"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1))))
+    
+    async def agenerate_answer(self, question: str, contexts: List[str], deadline: Optional[float] = None) -> str:
+        """
+        Generate an answer without blocking the event loop
         
-        print(f"Prompt created with {len(combined_context)} characters of context")
+        Calls share a global concurrency limit, transient errors are retried with
+        exponential backoff and jitter, and the whole call (including retries)
+        is bounded by a deadline. Falls back to local extraction on failure.
         
-        try:
-            # Generate content with Gemini
-            print("Sending request to Gemini API...")
-            start_time = time.time()
-            
-            model = genai.GenerativeModel(
-                model_name=self.model_name,
-                generation_config=self.generation_config
-            )
-            
-            # Add retry logic for rate limit errors
-            max_retries = 2
-            retry_count = 0
+        Args:
+            question: The question to answer
+            contexts: List of context passages from documents
+            deadline: Overall time limit in seconds (defaults to LLM_DEADLINE_SECONDS)
             
-            while retry_count <= max_retries:
+        Returns:
+            Generated answer
+        """
+        if not contexts:
+            return "No context information available to answer this question."
+        
+        prompt = self._build_prompt(question, contexts)
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        give_up_at = start_time + (deadline if deadline is not None else self.deadline)
+        semaphore = self._semaphore_for_loop()
+        attempt = 0
+        
+        try:
+            while True:
+                remaining = give_up_at - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError("LLM deadline exceeded")
                 try:
-                    response = model.generate_content(prompt)
-                    generation_time = time.time() - start_time
-                    print(f"Response received in {generation_time:.2f} seconds")
-                    
-                    # Extract the answer text
+                    async with semaphore:
+                        response = await asyncio.wait_for(
+                            self.model.generate_content_async(prompt),
+                            timeout=give_up_at - loop.time()
+                        )
                     answer = response.text.strip()
-                    print(f"Answer generated: {answer[:100]}...")
+                    logger.debug(f"Response received in {loop.time() - start_time:.2f} seconds")
                     return answer
-                
                 except Exception as api_error:
-                    if "429" in str(api_error) and retry_count < max_retries:
-                        # Rate limit error, wait and retry
-                        retry_count += 1
-                        wait_time = 5 * retry_count  # Increasing backoff
-                        print(f"Rate limit exceeded. Waiting {wait_time} seconds before retry {retry_count}/{max_retries}...")
-                        time.sleep(wait_time)
-                    else:
-                        # Either not a rate limit error or we've exhausted retries
+                    attempt += 1
+                    if not is_retryable_error(api_error) or attempt > self.max_retries:
                         raise
-            
+                    wait_time = self._backoff_delay(attempt)
+                    if loop.time() + wait_time >= give_up_at:
+                        raise
+                    logger.warning(f"Transient Gemini error ({api_error}). Retry {attempt}/{self.max_retries} in {wait_time:.2f} seconds...")
+                    await asyncio.sleep(wait_time)
         except Exception as e:
-            print(f"Error in generate_answer: {e}")
-            import traceback
-            traceback.print_exc()
-            
+            logger.error(f"Error in agenerate_answer: {e!r}")
             # Fallback to simple extraction-based answer when API fails
             try:
-                print("API call failed. Using fallback local extraction method...")
+                logger.warning("API call failed. Using fallback local extraction method...")
                 return self._extract_answer_locally(question, contexts)
             except Exception as fallback_error:
-                print(f"Fallback method also failed: {fallback_error}")
+                logger.error(f"Fallback method also failed: {fallback_error}")
                 return f"Unable to generate answer. API error: {str(e)}"
     
+    async def astream_answer(self, question: str, contexts: List[str], deadline: Optional[float] = None) -> AsyncIterator[str]:
+        """
+        Generate an answer, yielding text as Gemini produces it
+        
+        Transient errors are retried with backoff until the first text arrives;
+        after that a failure ends the stream. If no text could be generated the
+        local extraction fallback is yielded instead.
+        
+        Args:
+            question: The question to answer
+            contexts: List of context passages from documents
+            deadline: Overall time limit in seconds (defaults to LLM_DEADLINE_SECONDS)
+            
+        Yields:
+            Pieces of the answer text
+        """
+        if not contexts:
+            yield "No context information available to answer this question."
+            return
+        
+        prompt = self._build_prompt(question, contexts)
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        give_up_at = start_time + (deadline if deadline is not None else self.deadline)
+        semaphore = self._semaphore_for_loop()
+        attempt = 0
+        started = False
+        
+        try:
+            while True:
+                try:
+                    async with semaphore:
+                        response = await asyncio.wait_for(
+                            self.model.generate_content_async(prompt, stream=True),
+                            timeout=max(0.0, give_up_at - loop.time())
+                        )
+                        chunks = response.__aiter__()
+                        while True:
+                            # Bound every wait, so a stream that stalls between chunks still ends at the deadline
+                            try:
+                                chunk = await asyncio.wait_for(
+                                    chunks.__anext__(), timeout=max(0.0, give_up_at - loop.time())
+                                )
+                            except StopAsyncIteration:
+                                break
+                            text = chunk.text
+                            if not text:
+                                continue
+                            if not started:
+                                started = True
+                                logger.debug(f"First token received in {loop.time() - start_time:.2f} seconds")
+                            yield text
+                    return
+                except Exception as api_error:
+                    attempt += 1
+                    if started or not is_retryable_error(api_error) or attempt > self.max_retries:
+                        raise
+                    wait_time = self._backoff_delay(attempt)
+                    if loop.time() + wait_time >= give_up_at:
+                        raise
+                    logger.warning(f"Transient Gemini error ({api_error}). Retry {attempt}/{self.max_retries} in {wait_time:.2f} seconds...")
+                    await asyncio.sleep(wait_time)
+        except Exception as e:
+            logger.error(f"Error in astream_answer: {e!r}")
+            if started:
+                raise
+            logger.warning("API call failed. Using fallback local extraction method...")
+            yield self._extract_answer_locally(question, contexts)
+    
     def _extract_answer_locally(self, question: str, contexts: List[str]) -> str:
         """
         Simple fallback method that extracts sentences from the context that might answer the question.
@@ -175,27 +322,23 @@ ANSWER:"""
     
     def filter_relevant_contexts(self, question: str, contexts: List[Dict[str, Any]], threshold: float = 0.5) -> List[str]:
         """
-        Filter contexts to keep only the most relevant ones
+        Select the contexts to put in the prompt
+        
+        Neighbouring chunks are merged, near-duplicates dropped and the rest
+        packed into the prompt token budget (see ContextPacker).
         
         Args:
             question: The question being asked
-            contexts: List of context dictionaries from the vector DB
-            threshold: Relevance threshold
+            contexts: List of context dictionaries from the vector DB, best first
+            threshold: Relevance threshold (unused; chunks are filtered by the re-ranker, see RERANK_THRESHOLD)
             
         Returns:
             List of relevant context strings
         """
-        print(f"Filtering contexts for question: '{question}'")
-        print(f"Number of contexts before filtering: {len(contexts)}")
-        
-        # Get all documents
-        documents = [context["document"] for context in contexts]
+        logger.debug(f"Filtering contexts for question: '{question}'")
+        logger.debug(f"Number of contexts before filtering: {len(contexts)}")
         
-        # Use a smart filtering approach:
-        # 1. Sort by vector similarity (which ChromaDB already did for us)
-        # 2. Limit to reasonable number to avoid context overflow
-        max_contexts = min(5, len(documents))
-        filtered_contexts = documents[:max_contexts]
+        filtered_contexts = self.context_packer.pack(contexts)
         
-        print(f"Returning {len(filtered_contexts)} most relevant contexts")
+        logger.debug(f"Returning {len(filtered_contexts)} most relevant contexts")
         return filtered_contexts 
\ No newline at end of file
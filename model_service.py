@@ -0,0 +1,630 @@
+import argparse
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from embedding_cache import EmbeddingCache
+from embeddings import EmbeddingGenerator
+from workspaces import open_storage
+
+logger = logging.getLogger(__name__)
+
+# Calls a worker may make, by target kind; anything else is refused
+EMBEDDINGS = "embeddings"
+ALLOWED_CALLS = {
+    EMBEDDINGS: {"encode_batch", "embed_texts", "info", "warm_up"},
+    "vector_db": {
+        "add_chunks", "delete_chunks", "query", "query_many", "count", "peek",
+        "get_chunks", "get_chunk_ids_by_source", "all_chunks", "version"
+    },
+    "lexical_index": {"search"},
+    "registry": {"list_documents", "sources", "__len__", "get", "get_chunk_ids", "save", "remove"},
+    "service": {"open_storage", "stats"},
+}
+
+_STOP = object()
+
+
+class ModelServiceError(Exception):
+    """Raised in an API worker when the model service cannot complete a call"""
+
+
+class _ModelThread:
+    def __init__(self, embedding_generator, max_batch_size: int, max_wait_ms: float):
+        """
+        Run every model call of the service on one thread
+        
+        Encode requests that arrive within max_wait_ms of each other, from any
+        worker, are merged into one model call of up to max_batch_size texts.
+        """
+        self.embedding_generator = embedding_generator
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.num_requests = 0
+        self.num_batches = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="model-service", daemon=True)
+        self._thread.start()
+    
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Embeddings of texts, encoded together with concurrent requests"""
+        return self._submit("encode", texts)
+    
+    def call(self, function: Callable, *args) -> Any:
+        """Run another model call on the model thread"""
+        return self._submit("call", (function, args))
+    
+    def _submit(self, kind: str, payload) -> Any:
+        job = (kind, payload, threading.Event(), {})
+        self._queue.put(job)
+        job[2].wait()
+        if "error" in job[3]:
+            raise job[3]["error"]
+        return job[3]["result"]
+    
+    def _run(self) -> None:
+        held = None
+        while True:
+            job = held if held is not None else self._queue.get()
+            held = None
+            if job is _STOP:
+                return
+            kind, payload, done, outcome = job
+            if kind == "call":
+                function, args = payload
+                try:
+                    outcome["result"] = function(*args)
+                except Exception as e:
+                    outcome["error"] = e
+                done.set()
+                continue
+            
+            batch = [job]
+            num_texts = len(payload)
+            deadline = time.monotonic() + self.max_wait_ms / 1000.0
+            while num_texts < self.max_batch_size:
+                try:
+                    following = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if following is _STOP or following[0] != "encode":
+                    held = following
+                    break
+                batch.append(following)
+                num_texts += len(following[1])
+            
+            self.num_requests += len(batch)
+            self.num_batches += 1
+            try:
+                embeddings = self.embedding_generator.encode_batch([text for item in batch for text in item[1]])
+            except Exception as e:
+                for _, _, item_done, item_outcome in batch:
+                    item_outcome["error"] = e
+                    item_done.set()
+                continue
+            offset = 0
+            for _, texts, item_done, item_outcome in batch:
+                item_outcome["result"] = embeddings[offset:offset + len(texts)]
+                offset += len(texts)
+                item_done.set()
+    
+    def stop(self) -> None:
+        self._queue.put(_STOP)
+
+
+class ModelService:
+    def __init__(
+        self,
+        address: Optional[str] = None,
+        authkey: Optional[bytes] = None,
+        embedding_generator=None,
+        storage: Optional[Callable] = None,
+        max_batch_size: Optional[int] = None,
+        max_wait_ms: Optional[float] = None
+    ):
+        """
+        Process that owns the embedding model and the indexes of every workspace
+        
+        With uvicorn --workers N, each worker would otherwise load its own copy
+        of the model and open its own clients on the same index files. Workers
+        started with MODEL_SERVICE_ADDRESS instead reach this process over a
+        Unix socket through ModelServiceClient, so the model stays resident
+        once, every index has a single writer, and concurrent query encodes
+        from all workers are batched together.
+        
+        Requests are pickled, so anyone who can connect can run code in the
+        service; the socket is only accessible to its owner, and an authkey
+        can be required on top.
+        
+        Args:
+            address: Path of the Unix socket (env MODEL_SERVICE_ADDRESS)
+            authkey: Shared secret clients must present (env MODEL_SERVICE_AUTHKEY)
+            embedding_generator: EmbeddingGenerator to serve (defaults to one with
+                the persistent embedding cache unless EMBEDDING_CACHE_ENABLED is false)
+            storage: Opens the vector DB and catalog of a workspace directory
+                (defaults to workspaces.open_storage)
+            max_batch_size: Max texts per merged encode (env MODEL_SERVICE_BATCH_MAX_SIZE)
+            max_wait_ms: Max time an encode waits for requests from other workers
+                (env MODEL_SERVICE_BATCH_WAIT_MS)
+        """
+        self.address = os.path.abspath(address or os.getenv("MODEL_SERVICE_ADDRESS") or "./model_service.sock")
+        self.authkey = authkey if authkey is not None else _env_authkey()
+        if embedding_generator is None:
+            cache_enabled = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+            embedding_generator = EmbeddingGenerator(cache=EmbeddingCache() if cache_enabled else None)
+        self.embedding_generator = embedding_generator
+        self.storage = storage or open_storage
+        self.model_thread = _ModelThread(
+            embedding_generator,
+            max_batch_size or int(os.getenv("MODEL_SERVICE_BATCH_MAX_SIZE", "64")),
+            max_wait_ms if max_wait_ms is not None else float(os.getenv("MODEL_SERVICE_BATCH_WAIT_MS", "2"))
+        )
+        
+        # Workspace directory -> (vector DB, registry); opened on first use and kept open
+        self._storage: Dict[str, Tuple[Any, Any]] = {}
+        self._lock = threading.Lock()
+        # Serializes opening each directory, so a slow open (partition migration,
+        # lexical backfill) never holds up calls for other workspaces
+        self._open_locks: Dict[str, threading.Lock] = {}
+        # Kept apart from _lock so counting a call never waits behind it
+        self._calls_lock = threading.Lock()
+        self.num_connections = 0
+        self.num_calls = 0
+        self._listener = None
+    
+    def serve_forever(self) -> None:
+        """Load the model, then accept worker connections until interrupted"""
+        self._remove_stale_socket()
+        logger.info("Loading embedding model")
+        self.embedding_generator.warm_up()
+        
+        # Create the socket accessible to its owner only
+        umask = os.umask(0o177)
+        try:
+            self._listener = Listener(self.address, family="AF_UNIX", backlog=128, authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        logger.info(f"Model service listening on {self.address}")
+        try:
+            while True:
+                try:
+                    connection = self._listener.accept()
+                except OSError:
+                    if self._listener is None:
+                        return
+                    logger.exception("Error accepting a model service connection")
+                    continue
+                with self._lock:
+                    self.num_connections += 1
+                threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+        finally:
+            self.close()
+    
+    def _remove_stale_socket(self) -> None:
+        if not os.path.exists(self.address):
+            return
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(self.address)
+        except OSError:
+            os.unlink(self.address)
+        else:
+            raise RuntimeError(f"A model service is already listening on {self.address}")
+        finally:
+            probe.close()
+    
+    def _handle(self, connection) -> None:
+        """Answer one worker connection's calls until it closes"""
+        with connection:
+            while True:
+                try:
+                    target, method, args, kwargs = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    response = ("ok", self.dispatch(target, method, args, kwargs))
+                except Exception as e:
+                    logger.exception(f"Error in model service call {target[0]}.{method}")
+                    response = ("error", f"{type(e).__name__}: {e}")
+                try:
+                    connection.send(response)
+                except (EOFError, OSError):
+                    return
+    
+    def dispatch(self, target: Tuple[str, Optional[str]], method: str, args: tuple, kwargs: dict) -> Any:
+        """
+        Run one call from a worker
+        
+        Args:
+            target: (kind, workspace directory) of the object called; the
+                directory is None for the embeddings and the service itself
+            method: Method name, or attribute name for version
+        """
+        kind, directory = target
+        if method not in ALLOWED_CALLS.get(kind, ()):
+            raise ValueError(f"Call {kind}.{method} is not served")
+        with self._calls_lock:
+            self.num_calls += 1
+        
+        if kind == "service":
+            return getattr(self, method)(*args, **kwargs)
+        if kind == EMBEDDINGS:
+            return self._embeddings_call(method, *args, **kwargs)
+        
+        vector_db, registry = self._open(directory)
+        if kind == "vector_db":
+            if method == "version":
+                return vector_db.version
+            return getattr(vector_db, method)(*args, **kwargs)
+        if kind == "lexical_index":
+            return vector_db.lexical_index.search(*args, **kwargs)
+        return getattr(registry, method)(*args, **kwargs)
+    
+    def _embeddings_call(self, method: str, *args, **kwargs) -> Any:
+        if method == "encode_batch":
+            return self.model_thread.encode(*args)
+        if method == "embed_texts":
+            # Chunk embeddings go through the generator so the embedding cache is used
+            texts = args[0]
+            chunks = self.model_thread.call(self.embedding_generator.process_chunks, [{"text": text} for text in texts])
+            return [chunk["embedding"] for chunk in chunks]
+        if method == "warm_up":
+            return self.model_thread.call(self.embedding_generator.warm_up, *args)
+        return {
+            "model_name": self.embedding_generator.model_name,
+            "embedding_dimension": self.model_thread.call(lambda: self.embedding_generator.embedding_dimension)
+        }
+    
+    def _open(self, directory: str) -> Tuple[Any, Any]:
+        with self._lock:
+            storage = self._storage.get(directory)
+            if storage is not None:
+                return storage
+            open_lock = self._open_locks.setdefault(directory, threading.Lock())
+        with open_lock:
+            # Another call may have opened it while this one waited
+            with self._lock:
+                storage = self._storage.get(directory)
+            if storage is None:
+                logger.info(f"Opening workspace storage in {directory}")
+                storage = self.storage(directory)
+                with self._lock:
+                    self._storage[directory] = storage
+            return storage
+    
+    def open_storage(self, directory: str) -> Dict[str, Any]:
+        """Open a workspace directory's storage; returns what its proxies need to know"""
+        vector_db, _ = self._open(directory)
+        return {
+            "persist_directory": vector_db.persist_directory,
+            "lexical_index": vector_db.lexical_index is not None
+        }
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._calls_lock:
+            num_calls = self.num_calls
+        with self._lock:
+            return {
+                "address": self.address,
+                "connections": self.num_connections,
+                "calls": num_calls,
+                "open_workspaces": len(self._storage),
+                "encode_requests": self.model_thread.num_requests,
+                "encode_batches": self.model_thread.num_batches,
+                "embedding_cache": (
+                    self.embedding_generator.cache.stats() if self.embedding_generator.cache is not None else None
+                )
+            }
+    
+    def close(self) -> None:
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+        self.model_thread.stop()
+        with self._lock:
+            for vector_db, registry in self._storage.values():
+                vector_db.close()
+                registry.close()
+            self._storage.clear()
+        if self.embedding_generator.cache is not None:
+            self.embedding_generator.cache.close()
+
+
+def _env_authkey() -> Optional[bytes]:
+    authkey = os.getenv("MODEL_SERVICE_AUTHKEY")
+    return authkey.encode("utf-8") if authkey else None
+
+
+class ModelServiceClient:
+    def __init__(
+        self,
+        address: Optional[str] = None,
+        authkey: Optional[bytes] = None,
+        timeout: Optional[float] = None
+    ):
+        """
+        Connection of an API worker to the model service
+        
+        Connections are pooled, so threads can call the service concurrently;
+        a pooled connection that broke (e.g. because the service restarted) is
+        replaced once before a call fails. Calls block, so async code makes
+        them on a worker thread.
+        
+        Args:
+            address: Path of the service's Unix socket (env MODEL_SERVICE_ADDRESS)
+            authkey: Shared secret of the service (env MODEL_SERVICE_AUTHKEY)
+            timeout: Seconds to wait for the reply to a call, 0 for no limit
+                (env MODEL_SERVICE_TIMEOUT_SECONDS)
+        """
+        self.address = os.path.abspath(address or os.getenv("MODEL_SERVICE_ADDRESS") or "./model_service.sock")
+        self.authkey = authkey if authkey is not None else _env_authkey()
+        self.timeout = timeout if timeout is not None else float(os.getenv("MODEL_SERVICE_TIMEOUT_SECONDS", "60"))
+        self._connections = queue.LifoQueue()
+    
+    def _connect(self):
+        try:
+            return Client(self.address, family="AF_UNIX", authkey=self.authkey)
+        except OSError as e:
+            raise ModelServiceError(f"Cannot reach the model service at {self.address}: {e}")
+    
+    def call(
+        self,
+        target: Tuple[str, Optional[str]],
+        method: str,
+        *args,
+        timeout: Optional[float] = None,
+        **kwargs
+    ) -> Any:
+        """
+        Call a method of an object owned by the service
+        
+        Args:
+            timeout: Seconds to wait for the reply instead of the client's
+                timeout, 0 for no limit; not passed on to the method
+        
+        Raises:
+            ModelServiceError: If the service is unreachable, did not reply in
+                time or the call failed
+        """
+        timeout = self.timeout if timeout is None else timeout
+        for attempt in range(2):
+            try:
+                connection, pooled = self._connections.get_nowait(), True
+            except queue.Empty:
+                connection, pooled = self._connect(), False
+            try:
+                connection.send((target, method, args, kwargs))
+                if timeout and not connection.poll(timeout):
+                    # The late reply would be read by the next call, so the connection is dropped
+                    connection.close()
+                    raise ModelServiceError(
+                        f"The model service at {self.address} did not answer {method} within {timeout:g} seconds"
+                    )
+                status, result = connection.recv()
+            except (EOFError, OSError) as e:
+                connection.close()
+                if pooled and attempt == 0:
+                    continue
+                raise ModelServiceError(f"Lost the connection to the model service at {self.address}: {e}")
+            self._connections.put(connection)
+            if status == "error":
+                raise ModelServiceError(result)
+            return result
+    
+    def embedding_generator(self) -> "RemoteEmbeddingGenerator":
+        return RemoteEmbeddingGenerator(self)
+    
+    def open_storage(self, persist_directory: str) -> Tuple["RemoteVectorStore", "RemoteDocumentRegistry"]:
+        """Proxies for a workspace directory's vector DB and catalog; drop-in for workspaces.open_storage"""
+        directory = os.path.abspath(persist_directory)
+        info = self.call(("service", None), "open_storage", directory)
+        return RemoteVectorStore(self, directory, info), RemoteDocumentRegistry(self, directory)
+    
+    def stats(self) -> Dict[str, Any]:
+        return self.call(("service", None), "stats")
+    
+    def close(self) -> None:
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class RemoteEmbeddingGenerator:
+    def __init__(self, client: ModelServiceClient):
+        """EmbeddingGenerator interface backed by the model service"""
+        self.client = client
+        self._info = None
+    
+    def _call(self, method: str, *args) -> Any:
+        return self.client.call((EMBEDDINGS, None), method, *args)
+    
+    @property
+    def model_name(self) -> str:
+        if self._info is None:
+            self._info = self._call("info")
+        return self._info["model_name"]
+    
+    @property
+    def embedding_dimension(self) -> int:
+        if self._info is None:
+            self._info = self._call("info")
+        return self._info["embedding_dimension"]
+    
+    def encode_batch(self, texts: List[str]) -> np.ndarray:
+        return self._call("encode_batch", texts)
+    
+    def process_chunks(
+        self,
+        chunks: List[Dict[str, Any]],
+        progress: Optional[Callable[[int, int], None]] = None
+    ) -> List[Dict[str, Any]]:
+        if not chunks:
+            return []
+        embeddings = self._call("embed_texts", [chunk["text"] for chunk in chunks])
+        for chunk, embedding in zip(chunks, embeddings):
+            chunk["embedding"] = embedding
+        # The service encodes the whole call at once, so progress is only known at the end
+        if progress is not None:
+            progress(len(chunks), len(chunks))
+        return chunks
+    
+    def warm_up(self, encode: bool = True) -> None:
+        # Loading the model may take longer than any call should; warm-up runs off the event loop
+        self.client.call((EMBEDDINGS, None), "warm_up", encode, timeout=0)
+
+
+class RemoteLexicalIndex:
+    def __init__(self, client: ModelServiceClient, directory: str):
+        self.client = client
+        self.directory = directory
+    
+    def search(self, query: str, n_results: int = 5, filter_source: Optional[str] = None) -> List[Tuple[str, float]]:
+        return self.client.call(("lexical_index", self.directory), "search", query, n_results, filter_source)
+    
+    def close(self) -> None:
+        pass
+
+
+class RemoteVectorStore:
+    def __init__(self, client: ModelServiceClient, directory: str, info: Dict[str, Any]):
+        """
+        VectorStore interface backed by the model service
+        
+        The version is read from the service, so answers cached in one worker
+        stop matching as soon as any worker changes the corpus. Listeners are
+        called after writes made through this proxy.
+        """
+        self.client = client
+        self.directory = directory
+        self.persist_directory = info["persist_directory"]
+        self.lexical_index = RemoteLexicalIndex(client, directory) if info["lexical_index"] else None
+        self._listeners = []
+    
+    def _call(self, method: str, *args, **kwargs) -> Any:
+        return self.client.call(("vector_db", self.directory), method, *args, **kwargs)
+    
+    @property
+    def version(self) -> int:
+        return self._call("version")
+    
+    def add_chunks(self, chunks: List[Dict[str, Any]]) -> None:
+        self._call("add_chunks", chunks)
+        self._notify_changed()
+    
+    def delete_chunks(self, ids: List[str]) -> None:
+        self._call("delete_chunks", ids)
+        self._notify_changed()
+    
+    def query(self, query_embedding: List[float], n_results: int = 5, filter_source: Optional[str] = None) -> Dict[str, Any]:
+        return self._call("query", query_embedding, n_results=n_results, filter_source=filter_source)
+    
+    def query_many(
+        self,
+        query_embeddings: List[List[float]],
+        n_results: int = 5,
+        filter_source: Optional[str] = None
+    ) -> Dict[str, Any]:
+        return self._call("query_many", query_embeddings, n_results=n_results, filter_source=filter_source)
+    
+    def count(self) -> int:
+        return self._call("count")
+    
+    def peek(self, *args, **kwargs) -> Dict[str, Any]:
+        return self._call("peek", *args, **kwargs)
+    
+    def get_chunks(self, ids: List[str]) -> List[Dict[str, Any]]:
+        return self._call("get_chunks", ids)
+    
+    def get_chunk_ids_by_source(self) -> Dict[str, List[str]]:
+        return self._call("get_chunk_ids_by_source")
+    
+    def all_chunks(self) -> List[Dict[str, Any]]:
+        return self._call("all_chunks")
+    
+    def add_listener(self, callback: Callable[[], None]) -> None:
+        self._listeners.append(callback)
+    
+    def _notify_changed(self) -> None:
+        for callback in self._listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Error in vector DB change listener: {e}")
+    
+    def close(self) -> None:
+        """The service owns the store; nothing to release in the worker"""
+
+
+class RemoteDocumentRegistry:
+    def __init__(self, client: ModelServiceClient, directory: str):
+        """DocumentRegistry interface backed by the model service, shared by all workers"""
+        self.client = client
+        self.directory = directory
+    
+    def _call(self, method: str, *args, **kwargs) -> Any:
+        return self.client.call(("registry", self.directory), method, *args, **kwargs)
+    
+    def list_documents(self) -> List[Dict[str, Any]]:
+        return self._call("list_documents")
+    
+    def sources(self) -> List[str]:
+        return self._call("sources")
+    
+    def __len__(self) -> int:
+        return self._call("__len__")
+    
+    def get(self, source: str) -> Optional[Dict[str, Any]]:
+        return self._call("get", source)
+    
+    def get_chunk_ids(self, source: str) -> List[str]:
+        return self._call("get_chunk_ids", source)
+    
+    def save(
+        self,
+        source: str,
+        sha256: str,
+        num_pages: int,
+        chunk_ids: List[str],
+        embedding_model: Optional[str] = None
+    ) -> None:
+        self._call("save", source, sha256, num_pages, chunk_ids, embedding_model)
+    
+    def remove(self, source: str) -> None:
+        self._call("remove", source)
+    
+    def close(self) -> None:
+        """The service owns the catalog; nothing to release in the worker"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the embedding model and workspace indexes to the API workers")
+    parser.add_argument("--address", help="Unix socket path (defaults to env MODEL_SERVICE_ADDRESS)")
+    args = parser.parse_args()
+    
+    load_dotenv("config.env")
+    log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+    logging.basicConfig(
+        level=logging.INFO if log_level == "OFF" else log_level,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    if log_level == "OFF":
+        logging.disable(logging.CRITICAL)
+    service = ModelService(address=args.address)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Model service stopped")
+
+
+if __name__ == "__main__":
+    main()
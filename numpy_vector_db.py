@@ -0,0 +1,528 @@
+import logging
+import os
+import sqlite3
+import threading
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+from pdf_processor import assign_chunk_ids
+from vector_store import VectorStore
+
+logger = logging.getLogger(__name__)
+
+# Storage formats for the candidate-search matrix
+QUANTIZATIONS = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+# Rows scored per block, bounding the float32 temporaries made from compact rows
+SCORE_BLOCK_ROWS = 65536
+
+
+def row_metadata(source: str, chunk_size: int, chunk_index: Optional[int], token_count: Optional[int]) -> Dict[str, Any]:
+    """Metadata of a stored chunk in the shape Chroma returns it; absent fields are left out"""
+    metadata = {"source": source, "chunk_size": chunk_size}
+    if chunk_index is not None:
+        metadata["chunk_index"] = chunk_index
+    if token_count is not None:
+        metadata["token_count"] = token_count
+    return metadata
+
+
+def quantize(vectors: np.ndarray, quantization: str):
+    """
+    Encode float32 vectors in the given storage format
+    
+    int8 uses a symmetric per-vector scale (max |x| maps to 127), so a dot
+    product is recovered as scale * (codes . query).
+    
+    Returns:
+        (codes, scales) where scales is None unless quantization is int8
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if quantization == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales = np.maximum(scales, 1e-12).astype(np.float32)
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales
+    return vectors.astype(QUANTIZATIONS[quantization]), None
+
+
+class NumpyVectorDB(VectorStore):
+    def __init__(
+        self,
+        persist_directory: str = "./chroma_db/numpy_index",
+        initial_capacity: int = 1024,
+        quantization: Optional[str] = None,
+        rescore: Optional[bool] = None,
+        rescore_factor: Optional[int] = None
+    ):
+        """
+        In-process brute-force vector index backed by a memory-mapped .npy file
+        
+        Embeddings are kept L2-normalized in one contiguous matrix, so a cosine
+        top-k query is a single matrix-vector product plus argpartition. The
+        matrix can be stored as float16 or int8 (with a per-vector scale) to
+        cut disk and page-cache use; with rescore enabled a float32 copy is
+        kept alongside and only read for the top candidates, which are then
+        re-ranked by their exact score. With rescore turned off the copy is
+        left on disk but ignored; rows written or moved meanwhile are marked
+        stale and restored from the stored matrix once rescore is back on.
+        Chunk text and metadata live in a
+        SQLite side table and are only read for the returned rows. Per-source
+        row index arrays make source-filtered queries score only that source's
+        rows.
+        
+        Args:
+            persist_directory: Directory holding embeddings.npy and chunks.sqlite3
+            initial_capacity: Rows allocated when the matrix is first created
+            quantization: float32, float16 or int8 (defaults to env NUMPY_INDEX_QUANTIZATION)
+            rescore: Re-rank candidates with exact float32 scores (defaults to env NUMPY_INDEX_RESCORE)
+            rescore_factor: Candidates fetched per requested result when rescoring
+        """
+        logger.info(f"Initializing NumPy vector index with persistence at {persist_directory}")
+        os.makedirs(persist_directory, exist_ok=True)
+        self.persist_directory = persist_directory
+        self.initial_capacity = initial_capacity
+        self.quantization = (quantization or os.getenv("NUMPY_INDEX_QUANTIZATION", "float32")).lower()
+        if self.quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization '{self.quantization}', expected one of {list(QUANTIZATIONS)}")
+        self.rescore = rescore if rescore is not None else os.getenv("NUMPY_INDEX_RESCORE", "false").lower() == "true"
+        self.rescore_factor = rescore_factor or int(os.getenv("NUMPY_INDEX_RESCORE_FACTOR", "4"))
+        self._paths = {
+            "codes": os.path.join(persist_directory, "embeddings.npy"),
+            "scales": os.path.join(persist_directory, "scales.npy"),
+            "exact": os.path.join(persist_directory, "exact.npy"),
+        }
+        
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(persist_directory, "chunks.sqlite3"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, source TEXT NOT NULL, "
+            "text TEXT NOT NULL, chunk_size INTEGER NOT NULL, chunk_index INTEGER, token_count INTEGER)"
+        )
+        # Indexes created before chunk positions and token counts were stored
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(chunks)")}
+        for column in ("chunk_index", "token_count"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE chunks ADD COLUMN {column} INTEGER")
+        # Rows whose float32 copy was not kept up to date while rescore was off
+        if "exact_stale" not in columns:
+            self._conn.execute("ALTER TABLE chunks ADD COLUMN exact_stale INTEGER")
+        self._conn.commit()
+        
+        self._init_change_tracking()
+        self._load()
+        
+        logger.info(f"NumPy vector index has {self.count()} chunks "
+                    f"({self.quantization}{', exact rescore' if self.rescore else ''})")
+    
+    def _load(self) -> None:
+        """Open the matrices and rebuild the in-memory row indexes from SQLite"""
+        self._arrays = {
+            name: np.load(path, mmap_mode="r+")
+            for name, path in self._paths.items()
+            if os.path.exists(path)
+        }
+        
+        rows = self._conn.execute("SELECT row, id, source FROM chunks").fetchall()
+        self._num_rows = max((row for row, _, _ in rows), default=-1) + 1
+        self._row_by_id = {chunk_id: row for row, chunk_id, _ in rows}
+        self._source_by_row = {row: source for row, _, source in rows}
+        self._alive = np.zeros(self._num_rows, dtype=bool)
+        self._alive[[row for row, _, _ in rows]] = True
+        self._rebuild_source_rows()
+        
+        codes = self._arrays.get("codes")
+        if codes is not None:
+            stored = next(name for name, dtype in QUANTIZATIONS.items() if codes.dtype == dtype)
+            if stored != self.quantization:
+                logger.warning(f"index is stored as {stored}, ignoring requested {self.quantization}")
+                self.quantization = stored
+            if self.rescore and "exact" not in self._arrays and self._num_rows:
+                logger.warning("index has no float32 copy, exact rescore disabled")
+                self.rescore = False
+        if not self.rescore:
+            # Left on disk for when rescore is enabled again; its stale rows are tracked
+            self._arrays.pop("exact", None)
+        elif "exact" in self._arrays:
+            self._restore_stale_exact_rows()
+    
+    def _restore_stale_exact_rows(self) -> None:
+        """Rewrite the float32 copy of rows written or moved while rescore was off"""
+        stale_rows = [row for row, in self._conn.execute("SELECT row FROM chunks WHERE exact_stale = 1")]
+        if not stale_rows:
+            return
+        logger.warning(f"Restoring {len(stale_rows)} rows of the float32 copy written while rescore was off "
+                       f"from the {self.quantization} matrix")
+        codes = self._arrays["codes"]
+        exact = self._arrays["exact"]
+        if exact.shape[0] < codes.shape[0]:
+            self._rewrite_array("exact", codes.shape[0], codes.shape[1], np.arange(min(exact.shape[0], self._num_rows)))
+        vectors = np.asarray(codes[stale_rows], dtype=np.float32)
+        if self.quantization == "int8":
+            vectors *= self._arrays["scales"][stale_rows][:, None]
+        self._arrays["exact"][stale_rows] = self._normalize(vectors)
+        self._arrays["exact"].flush()
+        with self._conn:
+            self._conn.execute("UPDATE chunks SET exact_stale = NULL WHERE exact_stale = 1")
+    
+    def _array_specs(self) -> Dict[str, Any]:
+        """dtype and per-row shape suffix of each matrix this index maintains"""
+        specs = {"codes": (QUANTIZATIONS[self.quantization], True)}
+        if self.quantization == "int8":
+            specs["scales"] = (np.float32, False)
+        if self.rescore:
+            specs["exact"] = (np.float32, True)
+        return specs
+    
+    def _rewrite_array(self, name: str, capacity: int, dim: int, rows: np.ndarray) -> None:
+        """Replace one matrix with a new file of the given capacity holding the given rows first"""
+        dtype, per_dim = self._array_specs()[name]
+        shape = (capacity, dim) if per_dim else (capacity,)
+        old = self._arrays.get(name)
+        tmp_path = self._paths[name] + ".tmp"
+        rewritten = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+        if old is not None and len(rows):
+            rewritten[:len(rows)] = old[rows]
+        rewritten.flush()
+        del rewritten
+        self._arrays.pop(name, None)
+        os.replace(tmp_path, self._paths[name])
+        self._arrays[name] = np.load(self._paths[name], mmap_mode="r+")
+    
+    def _rebuild_source_rows(self, sources: Optional[set] = None) -> None:
+        """Recompute the sorted row index array of each (or the given) source"""
+        if sources is None:
+            self._source_rows = {}
+            sources = set(self._source_by_row.values())
+        grouped = {source: [] for source in sources}
+        for row, source in self._source_by_row.items():
+            if source in grouped:
+                grouped[source].append(row)
+        for source, rows in grouped.items():
+            if rows:
+                self._source_rows[source] = np.array(sorted(rows), dtype=np.int64)
+            else:
+                self._source_rows.pop(source, None)
+    
+    def _ensure_capacity(self, num_rows: int, dim: int) -> None:
+        """Grow the memory-mapped matrices (doubling) so they hold num_rows rows"""
+        codes = self._arrays.get("codes")
+        if codes is not None and codes.shape[1] != dim:
+            raise ValueError(f"Embedding dimension {dim} does not match index dimension {codes.shape[1]}")
+        
+        capacity = self.initial_capacity if codes is None else codes.shape[0]
+        while capacity < num_rows:
+            capacity *= 2
+        
+        existing = np.arange(self._num_rows)
+        for name in self._array_specs():
+            array = self._arrays.get(name)
+            if array is None or array.shape[0] < capacity:
+                self._rewrite_array(name, capacity, dim, existing)
+    
+    def _write_rows(self, rows: List[int], embeddings: np.ndarray) -> None:
+        """Store normalized float32 embeddings at the given rows in every format kept"""
+        codes, scales = quantize(embeddings, self.quantization)
+        self._arrays["codes"][rows] = codes
+        if scales is not None:
+            self._arrays["scales"][rows] = scales
+        if self.rescore:
+            self._arrays["exact"][rows] = embeddings
+        for array in self._arrays.values():
+            array.flush()
+    
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+    
+    def add_chunks(self, chunks: List[Dict[str, Any]]) -> None:
+        """
+        Add chunks to the index, replacing chunks that already exist
+        
+        Args:
+            chunks: List of chunks with text, embedding, and metadata
+        """
+        if not chunks:
+            logger.debug("No chunks to add to vector DB")
+            return
+        
+        logger.debug(f"Adding {len(chunks)} chunks to NumPy vector index")
+        assign_chunk_ids(chunks)
+        embeddings = self._normalize([chunk["embedding"] for chunk in chunks])
+        
+        with self._lock:
+            rows = []
+            next_row = self._num_rows
+            for chunk in chunks:
+                row = self._row_by_id.get(chunk["id"])
+                if row is None:
+                    row = next_row
+                    next_row += 1
+                    self._row_by_id[chunk["id"]] = row
+                rows.append(row)
+            
+            self._ensure_capacity(next_row, embeddings.shape[1])
+            self._write_rows(rows, embeddings)
+            
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO chunks "
+                    "(row, id, source, text, chunk_size, chunk_index, token_count, exact_stale) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (row, chunk["id"], chunk["source"], chunk["text"], chunk["chunk_size"],
+                         chunk.get("chunk_index"), chunk.get("token_count"), None if self.rescore else 1)
+                        for row, chunk in zip(rows, chunks)
+                    ]
+                )
+            
+            if next_row > self._num_rows:
+                self._alive = np.concatenate([self._alive, np.zeros(next_row - self._num_rows, dtype=bool)])
+                self._num_rows = next_row
+            self._alive[rows] = True
+            
+            changed_sources = set()
+            for row, chunk in zip(rows, chunks):
+                previous = self._source_by_row.get(row)
+                if previous is not None:
+                    changed_sources.add(previous)
+                self._source_by_row[row] = chunk["source"]
+                changed_sources.add(chunk["source"])
+            self._rebuild_source_rows(changed_sources)
+        
+        self._update_lexical_index(added=chunks)
+        self._notify_changed()
+        logger.debug(f"Successfully added chunks to vector DB. Index now has {self.count()} chunks")
+    
+    def delete_chunks(self, ids: List[str]) -> None:
+        """
+        Remove chunks from the index
+        
+        Rows are tombstoned; the matrix is compacted once most of it is dead.
+        
+        Args:
+            ids: IDs of the chunks to delete
+        """
+        if not ids:
+            return
+        
+        logger.debug(f"Deleting {len(ids)} chunks from NumPy vector index")
+        with self._lock:
+            rows = [self._row_by_id.pop(chunk_id) for chunk_id in ids if chunk_id in self._row_by_id]
+            if not rows:
+                return
+            with self._conn:
+                self._conn.executemany("DELETE FROM chunks WHERE row = ?", [(row,) for row in rows])
+            self._alive[rows] = False
+            changed_sources = {self._source_by_row.pop(row) for row in rows}
+            self._rebuild_source_rows(changed_sources)
+            
+            if self._num_rows > self.initial_capacity and self.count() < self._num_rows // 2:
+                self.compact()
+        
+        self._update_lexical_index(deleted=ids)
+        self._notify_changed()
+    
+    def compact(self) -> None:
+        """Rewrite the matrices and side table without deleted rows"""
+        with self._lock:
+            live_rows = np.flatnonzero(self._alive)
+            logger.info(f"Compacting NumPy vector index from {self._num_rows} to {len(live_rows)} rows")
+            new_row_of = {int(old): new for new, old in enumerate(live_rows)}
+            
+            codes = self._arrays.get("codes")
+            if codes is not None:
+                capacity = max(self.initial_capacity, len(live_rows))
+                for name in self._array_specs():
+                    self._rewrite_array(name, capacity, codes.shape[1], live_rows)
+            
+            with self._conn:
+                # Move rows in increasing order so new positions are always free; without
+                # rescore the float32 copy is not rewritten, so moved rows go stale
+                move = "UPDATE chunks SET row = ? WHERE row = ?" if self.rescore else (
+                    "UPDATE chunks SET row = ?, exact_stale = 1 WHERE row = ?"
+                )
+                for old, new in sorted(new_row_of.items()):
+                    if old != new:
+                        self._conn.execute(move, (new, old))
+            
+            self._load()
+    
+    def count(self) -> int:
+        """Number of chunks in the index"""
+        with self._lock:
+            return len(self._row_by_id)
+    
+    def peek(self, limit: int = 3) -> List[Dict[str, Any]]:
+        """A few stored chunks with their text and metadata, for diagnostics"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, text, source, chunk_size, chunk_index, token_count FROM chunks ORDER BY row LIMIT ?", (limit,)
+            ).fetchall()
+        return [{"id": row[0], "text": row[1], "metadata": row_metadata(*row[2:])} for row in rows]
+    
+    def get_chunks(self, ids: List[str]) -> List[Dict[str, Any]]:
+        """Chunks with id, text and metadata, in the order of ids; unknown IDs are skipped"""
+        with self._lock:
+            rows = [self._row_by_id[chunk_id] for chunk_id in ids if chunk_id in self._row_by_id]
+            fetched = self._fetch(rows, [0.0] * len(rows))
+        return [
+            {"id": chunk_id, "text": text, "metadata": metadata}
+            for chunk_id, text, metadata in zip(fetched["ids"], fetched["documents"], fetched["metadatas"])
+        ]
+    
+    def get_chunk_ids_by_source(self) -> Dict[str, List[str]]:
+        """Chunk IDs grouped by source"""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, source FROM chunks ORDER BY row").fetchall()
+        by_source = {}
+        for chunk_id, source in rows:
+            by_source.setdefault(source, []).append(chunk_id)
+        return by_source
+    
+    def _score(self, queries: np.ndarray, candidate_rows: Optional[np.ndarray]) -> np.ndarray:
+        """
+        Approximate cosine scores of every candidate row against every query
+        
+        Compact rows are widened to float32 one block at a time, so the
+        temporary memory stays bounded regardless of index size.
+        
+        Returns:
+            Array of shape (num_candidates, num_queries)
+        """
+        codes = self._arrays.get("codes")
+        num_candidates = self._num_rows if candidate_rows is None else len(candidate_rows)
+        scores = np.empty((num_candidates, len(queries)), dtype=np.float32)
+        if codes is None:
+            return scores[:0]
+        
+        for start in range(0, num_candidates, SCORE_BLOCK_ROWS):
+            end = min(start + SCORE_BLOCK_ROWS, num_candidates)
+            index = slice(start, end) if candidate_rows is None else candidate_rows[start:end]
+            block = np.asarray(codes[index], dtype=np.float32)
+            scores[start:end] = block @ queries.T
+            if self.quantization == "int8":
+                scores[start:end] *= self._arrays["scales"][index][:, None]
+        return scores
+    
+    def _rescore(self, rows: List[int], query: np.ndarray, n_results: int):
+        """Re-rank candidate rows by their exact float32 score"""
+        if not rows:
+            return rows, []
+        exact = self._arrays["exact"][rows] @ query
+        order = np.argsort(-exact)[:n_results]
+        return [rows[i] for i in order], [float(exact[i]) for i in order]
+    
+    def _top_k(self, scores: np.ndarray, candidate_rows: Optional[np.ndarray], n_results: int):
+        """Rows and scores of the n_results best live candidates, best first"""
+        if candidate_rows is None:
+            scores = np.where(self._alive, scores, -np.inf)
+        k = min(n_results, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return [], []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        rows = top if candidate_rows is None else candidate_rows[top]
+        return [int(row) for row in rows], [float(score) for score in scores[top]]
+    
+    def _fetch(self, rows: List[int], scores: List[float]) -> Dict[str, List[Any]]:
+        """Read text and metadata of the given rows, in order"""
+        if not rows:
+            return {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        placeholders = ",".join("?" * len(rows))
+        found = {
+            fields[0]: fields[1:]
+            for fields in self._conn.execute(
+                "SELECT row, id, text, source, chunk_size, chunk_index, token_count "
+                f"FROM chunks WHERE row IN ({placeholders})", rows
+            )
+        }
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for row, score in zip(rows, scores):
+            chunk_id, text, *metadata = found[row]
+            result["ids"].append(chunk_id)
+            result["documents"].append(text)
+            result["metadatas"].append(row_metadata(*metadata))
+            # Same convention as Chroma's cosine space
+            result["distances"].append(1.0 - score)
+        return result
+    
+    def query_many(
+        self,
+        query_embeddings: List[List[float]],
+        n_results: int = 5,
+        filter_source: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Query the index for several embeddings with one matrix product
+        
+        Args:
+            query_embeddings: Embeddings of the queries
+            n_results: Number of results to return per query
+            filter_source: Filter results by source (filename), shared by all queries
+            
+        Returns:
+            Dictionary with one list of results per query under each key
+        """
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        if len(query_embeddings) == 0:
+            return results
+        
+        queries = self._normalize(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        with self._lock:
+            candidate_rows = None
+            if filter_source:
+                candidate_rows = self._source_rows.get(filter_source)
+                if candidate_rows is None:
+                    candidate_rows = np.zeros(0, dtype=np.int64)
+            
+            all_scores = self._score(queries, candidate_rows)
+            num_candidates = n_results * self.rescore_factor if self.rescore else n_results
+            
+            for column in range(len(queries)):
+                top = self._top_k(all_scores[:, column], candidate_rows, num_candidates) if len(all_scores) else ([], [])
+                if self.rescore:
+                    top = self._rescore(top[0], queries[column], n_results)
+                fetched = self._fetch(*top)
+                for key in results:
+                    results[key].append(fetched[key])
+        return results
+    
+    def query(
+        self,
+        query_embedding: List[float],
+        n_results: int = 5,
+        filter_source: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Query the index for similar chunks
+        
+        Args:
+            query_embedding: Embedding of the query
+            n_results: Number of results to return
+            filter_source: Filter results by source (filename)
+            
+        Returns:
+            Dictionary with query results, shaped like Chroma's
+        """
+        try:
+            return self.query_many([query_embedding], n_results=n_results, filter_source=filter_source)
+        except Exception as e:
+            logger.exception(f"Error querying vector DB: {e}")
+            return {
+                "documents": [[]],
+                "metadatas": [[]],
+                "distances": [[]],
+                "ids": [[]]
+            }
+    
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+            self._arrays = {}
+        super().close()
@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+from typing import List, Optional, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MODEL_FILE = "model.onnx"
+QUANTIZED_MODEL_FILE = "model_int8.onnx"
+CONFIG_FILE = "encoder_config.json"
+
+
+def model_directory(model_name: str, cache_dir: Optional[str] = None) -> str:
+    """Where the exported ONNX files of a model are cached (under env ONNX_MODEL_DIR)"""
+    root = cache_dir or os.getenv("ONNX_MODEL_DIR", "./models/onnx")
+    return os.path.join(root, model_name.replace("/", "__"))
+
+
+def export_model(model_name: str, directory: str) -> None:
+    """
+    Export a sentence-transformers model to ONNX with its tokenizer and pooling settings
+    
+    Only needed once per model; it is the one step that still needs torch and
+    sentence-transformers.
+    
+    Args:
+        model_name: sentence-transformers model with mean pooling
+        directory: Directory the files are written to
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize, Pooling
+    
+    logger.info(f"Exporting {model_name} to ONNX in {directory}")
+    st_model = SentenceTransformer(model_name, device="cpu")
+    transformer = st_model[0]
+    pooling = next((module for module in st_model if isinstance(module, Pooling)), None)
+    if pooling is None or not pooling.pooling_mode_mean_tokens:
+        raise ValueError(f"Only mean-pooled models can be exported to ONNX, {model_name} is not one")
+    
+    os.makedirs(directory, exist_ok=True)
+    transformer.tokenizer.save_pretrained(directory)
+    
+    sample = transformer.tokenizer(["export"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+        
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs)))[0]
+    
+    with torch.no_grad():
+        torch.onnx.export(
+            LastHiddenState(transformer.auto_model.eval()),
+            tuple(sample[name] for name in input_names),
+            os.path.join(directory, MODEL_FILE),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]},
+            opset_version=14
+        )
+    
+    with open(os.path.join(directory, CONFIG_FILE), "w") as f:
+        json.dump({
+            "model_name": model_name,
+            "dimension": st_model.get_sentence_embedding_dimension(),
+            "max_seq_length": st_model.max_seq_length,
+            "normalize": any(isinstance(module, Normalize) for module in st_model)
+        }, f, indent=2)
+
+
+def quantize_model(directory: str) -> None:
+    """Write an int8 copy of the exported model with dynamically quantized weights"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    
+    logger.info(f"Quantizing the ONNX model in {directory} to int8")
+    quantize_dynamic(
+        os.path.join(directory, MODEL_FILE),
+        os.path.join(directory, QUANTIZED_MODEL_FILE),
+        weight_type=QuantType.QInt8
+    )
+
+
+class OnnxEncoder:
+    def __init__(
+        self,
+        model_name: str = "all-MiniLM-L6-v2",
+        cache_dir: Optional[str] = None,
+        quantize: Optional[bool] = None,
+        intra_op_threads: Optional[int] = None,
+        batch_size: Optional[int] = None
+    ):
+        """
+        Drop-in for SentenceTransformer.encode running an exported model on ONNX Runtime
+        
+        The model is exported (and quantized) on first use and cached on disk;
+        afterwards only onnxruntime and the tokenizer are loaded. Texts are
+        sorted by token length and each batch is padded only to its own
+        longest text, so short chunks do not pay for long ones.
+        
+        Args:
+            model_name: sentence-transformers model with mean pooling
+            cache_dir: Directory of exported models (env ONNX_MODEL_DIR)
+            quantize: Run the int8-quantized model (env ONNX_QUANTIZE)
+            intra_op_threads: Threads per model call, 0 for one per physical
+                core (env ONNX_INTRA_OP_THREADS)
+            batch_size: Default texts per model call
+        """
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+        
+        self.model_name = model_name
+        self.directory = model_directory(model_name, cache_dir)
+        self.quantize = quantize if quantize is not None else os.getenv("ONNX_QUANTIZE", "false").lower() == "true"
+        self.intra_op_threads = (
+            intra_op_threads if intra_op_threads is not None else int(os.getenv("ONNX_INTRA_OP_THREADS", "0"))
+        )
+        self.batch_size = batch_size or 32
+        
+        if not os.path.exists(os.path.join(self.directory, MODEL_FILE)):
+            export_model(model_name, self.directory)
+        if self.quantize and not os.path.exists(os.path.join(self.directory, QUANTIZED_MODEL_FILE)):
+            quantize_model(self.directory)
+        with open(os.path.join(self.directory, CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        # Parallelism comes from within each operator; one model call runs at a time
+        options.intra_op_num_threads = self.intra_op_threads
+        options.inter_op_num_threads = 1
+        model_file = QUANTIZED_MODEL_FILE if self.quantize else MODEL_FILE
+        self.session = ort.InferenceSession(
+            os.path.join(self.directory, model_file), sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(self.directory)
+        logger.info(f"Loaded ONNX model {self.model_name} ({model_file}, {self.intra_op_threads or 'auto'} threads)")
+    
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.config["dimension"]
+    
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: Optional[int] = None,
+        convert_to_numpy: bool = True,
+        **kwargs
+    ) -> np.ndarray:
+        """
+        Embed texts like SentenceTransformer.encode
+        
+        Args:
+            sentences: A text or a list of texts
+            batch_size: Texts per model call (defaults to the encoder's batch size)
+        
+        Returns:
+            float32 array, one row per text (a single row for a single text)
+        """
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        embeddings = np.zeros((len(texts), self.config["dimension"]), dtype=np.float32)
+        if not texts:
+            return embeddings
+        batch_size = batch_size or self.batch_size
+        
+        encoded = self.tokenizer(texts, truncation=True, max_length=self.config["max_seq_length"], padding=False)
+        lengths = np.array([len(ids) for ids in encoded["input_ids"]])
+        order = np.argsort(-lengths, kind="stable")
+        
+        for start in range(0, len(texts), batch_size):
+            rows = order[start:start + batch_size]
+            width = int(lengths[rows].max())
+            attention_mask = (np.arange(width)[None, :] < lengths[rows][:, None]).astype(np.int64)
+            feed = {}
+            for name in ("input_ids", "token_type_ids"):
+                if name not in self.input_names:
+                    continue
+                batch = np.zeros((len(rows), width), dtype=np.int64)
+                if name in encoded:
+                    for index, row in enumerate(rows):
+                        batch[index, :lengths[row]] = encoded[name][row]
+                feed[name] = batch
+            if "attention_mask" in self.input_names:
+                feed["attention_mask"] = attention_mask
+            
+            hidden = self.session.run(None, feed)[0]
+            # Mean over the real tokens of each text
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.config["normalize"]:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            embeddings[rows] = pooled
+        
+        return embeddings[0] if single else embeddings
@@ -1,7 +1,182 @@
+import logging
 import os
 import fitz  # PyMuPDF
 import re
-from typing import List, Dict, Any, Tuple
+import hashlib
+from typing import List, Dict, Any, Tuple, Optional, Iterator
+
+from context_packer import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def empty_document_placeholder(filename: str) -> str:
+    """Text stored for documents that have no extractable text"""
+    return f"[This document appears to be image-based or contains no extractable text: {filename}]"
+
+
+def source_hash(source: str) -> str:
+    """Short stable hash of a source name; prefixes its chunk IDs"""
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+
+def make_chunk_id(source: str, text: str, occurrence: int = 0) -> str:
+    """
+    Stable ID for a chunk, derived from its document and content
+    
+    Unchanged chunks keep their ID across re-uploads and restarts.
+    
+    Args:
+        source: The name of the source PDF file
+        text: The chunk text
+        occurrence: How many identical chunks came before this one in the document
+    """
+    doc_hash = source_hash(source)
+    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+    chunk_id = f"{doc_hash}_{text_hash}"
+    return f"{chunk_id}_{occurrence}" if occurrence else chunk_id
+
+
+def assign_chunk_ids(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Set a stable 'id' and an estimated token_count on every chunk that does not already have them"""
+    occurrences = {}
+    for chunk in chunks:
+        chunk.setdefault("token_count", estimate_tokens(chunk["text"]))
+        if "id" in chunk:
+            continue
+        key = (chunk["source"], chunk["text"])
+        chunk["id"] = make_chunk_id(chunk["source"], chunk["text"], occurrences.get(key, 0))
+        occurrences[key] = occurrences.get(key, 0) + 1
+    return chunks
+
+
+class StreamingChunker:
+    def __init__(self, source: str, chunk_size: int = 1000, chunk_overlap: int = 200):
+        """
+        Incremental version of PDFProcessor.chunk_text
+        
+        Text is fed in pieces (typically one page at a time) and chunks are
+        returned as soon as they are complete. Feeding the pages of a document
+        produces the same chunks as chunk_text on the concatenated text, except
+        that text running on for more than chunk_size characters without a
+        sentence end (tables, code, lists) is cut at whitespace, so the text
+        held back for the next piece stays bounded.
+        
+        Args:
+            source: The name of the source PDF file
+            chunk_size: The size of text chunks in characters
+            chunk_overlap: The overlap between chunks in characters
+        """
+        self.source = source
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.num_chunks = 0
+        
+        # Occurrence counts of chunk texts, so repeated chunks get distinct IDs
+        self._occurrences = {}
+        
+        # Trailing sentence that may continue in the next piece of text
+        self._tail = ""
+        self._current_chunk = ""
+        self._started = False
+    
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        """
+        Add text and return any chunks that are now complete
+        
+        Args:
+            text: The next piece of document text
+            
+        Returns:
+            List of completed chunk dictionaries (possibly empty)
+        """
+        # Only the new text is normalized; the tail already is, so just
+        # collapse a whitespace run spanning the boundary as chunk_text would
+        text = re.sub(r'\s+', ' ', text)
+        if text.startswith(" ") and self._tail.endswith(" "):
+            text = text[1:]
+        buffer = self._tail + text
+        if not self._started:
+            buffer = buffer.lstrip()
+            if not buffer:
+                return []
+            self._started = True
+        
+        sentences = re.split(r'(?<=[.!?])\s+', buffer)
+        # The last sentence may be cut off by the page boundary
+        self._tail = sentences.pop()
+        sentences.extend(self._split_long_tail())
+        return self._add_sentences(sentences)
+    
+    def _split_long_tail(self) -> List[str]:
+        """Cut pieces of at most chunk_size characters off the tail until it is no longer than that"""
+        pieces = []
+        while len(self._tail) > self.chunk_size:
+            cut = self._tail.rfind(" ", 0, self.chunk_size + 1)
+            if cut <= 0:
+                # No whitespace to cut at
+                cut = self.chunk_size
+            pieces.append(self._tail[:cut])
+            self._tail = self._tail[cut:].lstrip(" ")
+        return pieces
+    
+    def finish(self) -> List[Dict[str, Any]]:
+        """
+        Flush the remaining text
+        
+        Returns:
+            The final chunks; a placeholder chunk if the document had no text
+        """
+        chunks = self._add_sentences([self._tail.strip()])
+        self._tail = ""
+        
+        if self._current_chunk:
+            chunks.append(self._make_chunk(self._current_chunk))
+            self._current_chunk = ""
+        
+        if self.num_chunks == 0:
+            logger.warning(f"No text extracted from {self.source}, adding placeholder chunk")
+            chunks.append(self._make_chunk(empty_document_placeholder(self.source)))
+        
+        return chunks
+    
+    def _add_sentences(self, sentences: List[str]) -> List[Dict[str, Any]]:
+        chunks = []
+        for para in sentences:
+            para = para.strip()
+            if not para:
+                continue
+            
+            # If adding this sentence exceeds chunk size and we already have content
+            if len(self._current_chunk) + len(para) > self.chunk_size and self._current_chunk:
+                chunks.append(self._make_chunk(self._current_chunk))
+                
+                # Start new chunk with overlap
+                if len(self._current_chunk) > self.chunk_overlap:
+                    self._current_chunk = self._current_chunk[-self.chunk_overlap:] + " " + para
+                else:
+                    self._current_chunk = para
+            else:
+                if self._current_chunk:
+                    self._current_chunk += " " + para
+                else:
+                    self._current_chunk = para
+        return chunks
+    
+    def _make_chunk(self, text: str) -> Dict[str, Any]:
+        self.num_chunks += 1
+        text_hash = hashlib.sha256(text.encode("utf-8")).digest()
+        occurrence = self._occurrences.get(text_hash, 0)
+        self._occurrences[text_hash] = occurrence + 1
+        return {
+            "id": make_chunk_id(self.source, text, occurrence),
+            "text": text,
+            "source": self.source,
+            "chunk_size": len(text),
+            "chunk_index": self.num_chunks - 1,
+            "token_count": estimate_tokens(text)
+        }
+
 
 class PDFProcessor:
     def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200):
@@ -15,16 +190,26 @@ class PDFProcessor:
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
     
-    def extract_text_from_pdf(self, file_path: str) -> str:
-        """Extract all text from a PDF file with enhanced error handling"""
-        print(f"Extracting text from PDF: {file_path}")
+    def count_pages(self, file_path: str) -> int:
+        """Return the number of pages in a PDF file"""
+        with fitz.open(file_path) as doc:
+            return len(doc)
+    
+    def iter_page_texts(self, file_path: str, start_page: int = 0, end_page: Optional[int] = None) -> Iterator[str]:
+        """
+        Yield the text of each page in [start_page, end_page) one page at a time
         
-        try:
-            doc = fitz.open(file_path)
-            text = ""
+        Args:
+            file_path: Path to the PDF file
+            start_page: First page to read (0-based)
+            end_page: Page to stop before (defaults to the end of the document)
             
-            print(f"PDF has {len(doc)} pages")
-            for page_num in range(len(doc)):
+        Yields:
+            Text of each page (a placeholder for image-only pages)
+        """
+        with fitz.open(file_path) as doc:
+            end_page = len(doc) if end_page is None else min(end_page, len(doc))
+            for page_num in range(start_page, end_page):
                 try:
                     page = doc.load_page(page_num)
                     
@@ -33,7 +218,7 @@ class PDFProcessor:
                     
                     # If page has no text but might have images/scan
                     if not page_text.strip():
-                        print(f"Page {page_num+1} has no readable text, checking for images...")
+                        logger.debug(f"Page {page_num+1} has no readable text, checking for images...")
                         
                         # Alternative: get text from images if page seems empty
                         # This uses simple image-based text extraction
@@ -42,29 +227,81 @@ class PDFProcessor:
                             # Try to extract images and treat as text
                             image_list = page.get_images(full=True)
                             if image_list:
-                                print(f"Page {page_num+1} has {len(image_list)} images. Text might be in image form.")
+                                logger.debug(f"Page {page_num+1} has {len(image_list)} images. Text might be in image form.")
                                 # Since we don't have OCR set up, just note this
                                 page_text = f"[Image-based content on page {page_num+1}]"
                         except Exception as img_err:
-                            print(f"Error checking for images on page {page_num+1}: {str(img_err)}")
+                            logger.error(f"Error checking for images on page {page_num+1}: {str(img_err)}")
                     
-                    text += page_text
-                    print(f"Page {page_num+1}: Extracted {len(page_text)} characters")
+                    yield page_text
                 except Exception as e:
-                    print(f"Error extracting text from page {page_num+1}: {str(e)}")
+                    logger.error(f"Error extracting text from page {page_num+1}: {str(e)}")
+    
+    def extract_text_from_pdf(self, file_path: str) -> str:
+        """Extract all text from a PDF file with enhanced error handling"""
+        logger.debug(f"Extracting text from PDF: {file_path}")
+        
+        try:
+            # Collect pages and join once; repeated string concatenation is quadratic
+            text = "".join(self.iter_page_texts(file_path))
             
             if not text.strip():
-                print("WARNING: No text extracted from PDF. The file might be scanned or image-based.")
+                logger.warning("No text extracted from PDF. The file might be scanned or image-based.")
                 # Provide a placeholder for completely empty documents
-                text = f"[This document appears to be image-based or contains no extractable text: {os.path.basename(file_path)}]"
+                text = empty_document_placeholder(os.path.basename(file_path))
             else:
-                print(f"Successfully extracted {len(text)} characters from PDF")
+                logger.debug(f"Successfully extracted {len(text)} characters from PDF")
                 
             return text
         except Exception as e:
-            print(f"Error opening PDF file: {str(e)}")
+            logger.error(f"Error opening PDF file: {str(e)}")
             raise
     
+    def iter_chunks(self, file_path: str, source_name: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Stream chunks from a PDF page by page
+        
+        Produces the same chunks as process_pdf, but only the current page and
+        the chunk being built are held in memory.
+        
+        Args:
+            file_path: Path to the PDF file
+            source_name: Source name to store on the chunks (defaults to the file's basename)
+            
+        Yields:
+            Chunk dictionaries with text and metadata
+        """
+        chunker = StreamingChunker(source_name or os.path.basename(file_path), self.chunk_size, self.chunk_overlap)
+        for page_text in self.iter_page_texts(file_path):
+            yield from chunker.feed(page_text)
+        yield from chunker.finish()
+    
+    def iter_chunk_batches(
+        self,
+        file_path: str,
+        batch_size: int = 64,
+        source_name: Optional[str] = None
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Stream chunks from a PDF in lists of at most batch_size chunks
+        
+        Args:
+            file_path: Path to the PDF file
+            batch_size: Maximum number of chunks per batch
+            source_name: Source name to store on the chunks
+            
+        Yields:
+            Lists of chunk dictionaries
+        """
+        batch = []
+        for chunk in self.iter_chunks(file_path, source_name=source_name):
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    
     def chunk_text(self, text: str, filename: str) -> List[Dict[str, Any]]:
         """
         Chunk text with intelligent splitting at paragraph/section boundaries
@@ -76,19 +313,20 @@ class PDFProcessor:
         Returns:
             List of dictionaries containing chunks with metadata
         """
-        print(f"Chunking text for {filename}, total length: {len(text)} characters")
+        logger.debug(f"Chunking text for {filename}, total length: {len(text)} characters")
         
         # Clean text, normalize whitespace
         text = re.sub(r'\s+', ' ', text).strip()
         
         # If text is too short, don't chunk it
         if len(text) < self.chunk_size:
-            print(f"Text is shorter than chunk size ({len(text)} < {self.chunk_size}), creating single chunk")
-            return [{
+            logger.debug(f"Text is shorter than chunk size ({len(text)} < {self.chunk_size}), creating single chunk")
+            return assign_chunk_ids([{
                 "text": text,
                 "source": filename,
-                "chunk_size": len(text)
-            }]
+                "chunk_size": len(text),
+                "chunk_index": 0
+            }])
         
         # Split text into paragraphs (approximation)
         paragraphs = re.split(r'\n\s*\n|\r\n\s*\r\n', text)
@@ -96,11 +334,11 @@ class PDFProcessor:
         
         # If the split doesn't work well (e.g., very few paragraphs), use sentence splitting
         if len(paragraphs) < 3:
-            print("Few paragraphs detected, trying sentence-based splitting")
+            logger.debug("Few paragraphs detected, trying sentence-based splitting")
             paragraphs = re.split(r'(?<=[.!?])\s+', text)
             paragraphs = [p.strip() for p in paragraphs if p.strip()]
         
-        print(f"Split text into {len(paragraphs)} paragraphs")
+        logger.debug(f"Split text into {len(paragraphs)} paragraphs")
         
         chunks = []
         current_chunk = ""
@@ -136,36 +374,40 @@ class PDFProcessor:
                 "chunk_size": len(current_chunk)
             })
         
-        print(f"Created {len(chunks)} chunks from text")
+        logger.debug(f"Created {len(chunks)} chunks from text")
         
         # Print a sample of the first chunk
         if chunks:
-            print(f"First chunk sample: {chunks[0]['text'][:100]}...")
+            logger.debug(f"First chunk sample: {chunks[0]['text'][:100]}...")
             
         # Ensure we always return at least one chunk, even if it's a placeholder
         if not chunks:
-            print("WARNING: No chunks created, adding placeholder chunk")
+            logger.warning("No chunks created, adding placeholder chunk")
             chunks = [{
                 "text": f"[No processable content in document: {filename}]",
                 "source": filename,
                 "chunk_size": 50
             }]
-            
-        return chunks
+        
+        # Position in the document, so the context packer can merge neighbouring chunks
+        for chunk_index, chunk in enumerate(chunks):
+            chunk["chunk_index"] = chunk_index
+        return assign_chunk_ids(chunks)
     
-    def process_pdf(self, file_path: str) -> Tuple[List[Dict[str, Any]], str]:
+    def process_pdf(self, file_path: str, source_name: Optional[str] = None) -> Tuple[List[Dict[str, Any]], str]:
         """
         Process a PDF file: extract text and create chunks
         
         Args:
             file_path: Path to the PDF file
+            source_name: Source name to store on the chunks (defaults to the file's basename)
             
         Returns:
             Tuple of (chunks, original_text)
         """
         # Get the real filename for storage (without the temp path)
-        filename = os.path.basename(file_path)
-        print(f"Processing PDF: {filename}")
+        filename = source_name or os.path.basename(file_path)
+        logger.debug(f"Processing PDF: {filename}")
         
         text = self.extract_text_from_pdf(file_path)
         chunks = self.chunk_text(text, filename)
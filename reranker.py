@@ -0,0 +1,233 @@
+import logging
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+def question_hash(question: str) -> str:
+    """Stable key of a question for the score cache; ignores case and whitespace"""
+    return hashlib.sha256(" ".join(question.lower().split()).encode("utf-8")).hexdigest()[:16]
+
+
+class CrossEncoderReranker:
+    def __init__(
+        self,
+        model_name: Optional[str] = None,
+        threshold: Optional[float] = None,
+        overfetch_factor: Optional[int] = None,
+        latency_budget_ms: Optional[float] = None,
+        cache: Optional[TTLCache] = None
+    ):
+        """
+        Re-rank retrieved chunks with a local cross-encoder
+        
+        Retrieval over-fetches candidates, every (question, chunk) pair that is
+        not cached yet is scored in one batched forward pass on a dedicated
+        thread, and only chunks scoring at least the threshold are kept, best
+        first. Scores are cached per (question hash, chunk ID); chunk IDs are
+        derived from the chunk text, so cached scores stay valid when the
+        corpus changes.
+        
+        Re-ranking is skipped (the retrieval order is kept) when the request
+        has already used its latency budget or the scoring thread is still busy
+        with another request, and abandoned if scoring would overrun the budget;
+        the abandoned scores still land in the cache. Skipping while busy keeps
+        requests from queueing behind scoring nobody waits for anymore.
+        
+        Args:
+            model_name: sentence-transformers cross-encoder (env RERANK_MODEL)
+            threshold: Minimum relevance, 0-1 after a sigmoid (env RERANK_THRESHOLD)
+            overfetch_factor: Candidates retrieved per requested chunk (env RERANK_OVERFETCH_FACTOR)
+            latency_budget_ms: Time since the request started after which re-ranking
+                is skipped, 0 for no limit (env RERANK_LATENCY_BUDGET_MS)
+            cache: Score cache (defaults to one sized by RERANK_CACHE_SIZE/RERANK_CACHE_TTL)
+        """
+        self.model_name = model_name or os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+        self.threshold = threshold if threshold is not None else float(os.getenv("RERANK_THRESHOLD", "0.1"))
+        self.overfetch_factor = overfetch_factor or int(os.getenv("RERANK_OVERFETCH_FACTOR", "3"))
+        self.latency_budget_ms = (
+            latency_budget_ms if latency_budget_ms is not None
+            else float(os.getenv("RERANK_LATENCY_BUDGET_MS", "1500"))
+        )
+        self.cache = cache or TTLCache(
+            max_size=int(os.getenv("RERANK_CACHE_SIZE", "8192")),
+            ttl=float(os.getenv("RERANK_CACHE_TTL", "3600"))
+        )
+        
+        # Loaded on first use or by warm_up()
+        self._model = None
+        self._load_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+        
+        self._lock = threading.Lock()
+        # Set while the scoring thread works, including on abandoned requests
+        self._scoring = False
+        self.num_requests = 0
+        self.num_pairs_scored = 0
+        self.num_skipped = 0
+        self.num_timeouts = 0
+        self.num_dropped = 0
+    
+    @property
+    def model(self):
+        """The cross-encoder, loaded on first access"""
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    # Imported here so that torch is only loaded once the model is needed
+                    from sentence_transformers import CrossEncoder
+                    logger.info(f"Loading cross-encoder {self.model_name} for re-ranking")
+                    self._model = CrossEncoder(self.model_name, device="cpu")
+        return self._model
+    
+    def warm_up(self, encode: bool = True) -> None:
+        """
+        Load the model ahead of the first request
+        
+        Args:
+            encode: Also score one dummy pair (bypassing the cache)
+        """
+        if encode:
+            self.model.predict([("warm up", "warm up")], convert_to_numpy=True)
+        else:
+            self.model
+    
+    def candidate_count(self, num_results: int) -> int:
+        """Chunks to retrieve so that num_results remain to choose from after re-ranking"""
+        return num_results * self.overfetch_factor
+    
+    def score(self, question: str, ids: List[str], documents: List[str]) -> List[float]:
+        """
+        Relevance of each chunk to the question, from the cache or one batched forward pass
+        
+        Args:
+            question: The question
+            ids: Chunk IDs (cache keys)
+            documents: Chunk texts, aligned with ids
+        
+        Returns:
+            Scores between 0 and 1, aligned with ids
+        """
+        key = question_hash(question)
+        scores = [self.cache.get((key, chunk_id)) for chunk_id in ids]
+        missing = [index for index, score in enumerate(scores) if score is None]
+        if missing:
+            import torch
+            predicted = self.model.predict(
+                [(question, documents[index]) for index in missing],
+                batch_size=len(missing),
+                activation_fct=torch.nn.Sigmoid(),
+                convert_to_numpy=True
+            )
+            for index, score in zip(missing, predicted):
+                scores[index] = float(score)
+                self.cache.put((key, ids[index]), scores[index])
+            with self._lock:
+                self.num_pairs_scored += len(missing)
+        return scores
+    
+    async def rerank(
+        self,
+        question: str,
+        ids: List[str],
+        documents: List[str],
+        metadatas: List[Dict],
+        num_results: int,
+        started_at: Optional[float] = None
+    ) -> Tuple[List[str], List[Dict]]:
+        """
+        Re-order retrieved chunks by cross-encoder score and drop irrelevant ones
+        
+        Args:
+            question: The question
+            ids, documents, metadatas: Retrieved candidates, best first
+            num_results: Chunks to keep at most
+            started_at: time.perf_counter() when the request started, for the latency budget
+        
+        Returns:
+            Tuple of (documents, metadatas) of the kept chunks, best first; the
+            first num_results candidates unchanged if re-ranking was skipped
+        """
+        with self._lock:
+            self.num_requests += 1
+        fallback = (documents[:num_results], metadatas[:num_results])
+        if not ids:
+            return fallback
+        
+        timeout = None
+        if self.latency_budget_ms and started_at is not None:
+            timeout = self.latency_budget_ms / 1000.0 - (time.perf_counter() - started_at)
+            if timeout <= 0:
+                logger.info("Request is over its latency budget, skipping re-ranking")
+                with self._lock:
+                    self.num_skipped += 1
+                return fallback
+        
+        with self._lock:
+            busy = self._scoring
+            if busy:
+                self.num_skipped += 1
+            else:
+                self._scoring = True
+        if busy:
+            logger.info("Re-ranking is busy with another request, keeping retrieval order")
+            return fallback
+        
+        loop = asyncio.get_running_loop()
+        try:
+            scores = await asyncio.wait_for(
+                loop.run_in_executor(self.executor, self._score_and_release, question, ids, documents),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            logger.info("Re-ranking would exceed the latency budget, keeping retrieval order")
+            with self._lock:
+                self.num_timeouts += 1
+            return fallback
+        except Exception as e:
+            logger.error(f"Error re-ranking chunks, keeping retrieval order: {e}")
+            return fallback
+        
+        ranked = sorted(range(len(ids)), key=lambda index: scores[index], reverse=True)
+        kept = [index for index in ranked if scores[index] >= self.threshold][:num_results]
+        with self._lock:
+            self.num_dropped += sum(1 for score in scores if score < self.threshold)
+        logger.debug(f"Re-ranking kept {len(kept)} of {len(ids)} chunks "
+                     f"(scores {[round(scores[index], 3) for index in ranked[:num_results]]})")
+        return [documents[index] for index in kept], [metadatas[index] for index in kept]
+    
+    def _score_and_release(self, question: str, ids: List[str], documents: List[str]) -> List[float]:
+        """Score on the re-ranking thread and mark it free once done, even if the request gave up"""
+        try:
+            return self.score(question, ids, documents)
+        finally:
+            with self._lock:
+                self._scoring = False
+    
+    def stats(self) -> Dict[str, Any]:
+        """Re-ranking counters and score cache statistics"""
+        with self._lock:
+            return {
+                "model": self.model_name,
+                "threshold": self.threshold,
+                "overfetch_factor": self.overfetch_factor,
+                "latency_budget_ms": self.latency_budget_ms,
+                "requests": self.num_requests,
+                "pairs_scored": self.num_pairs_scored,
+                "chunks_dropped": self.num_dropped,
+                "skipped_over_budget": self.num_skipped,
+                "timeouts": self.num_timeouts,
+                "cache": self.cache.stats()
+            }
+    
+    def shutdown(self) -> None:
+        """Stop the scoring thread"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
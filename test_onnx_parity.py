@@ -0,0 +1,68 @@
+"""
+Regression check that the ONNX Runtime embedding backend agrees with PyTorch
+
+Skipped unless onnxruntime and sentence-transformers are installed. The
+model is exported into a temporary directory on the first run, so it also
+covers export_model and quantize_model. benchmarks/onnx_parity.py measures
+agreement and speed on whole documents.
+
+Usage:
+    python -m pytest test_onnx_parity.py
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("sentence_transformers")
+
+from embeddings import EmbeddingGenerator
+from onnx_encoder import OnnxEncoder
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+# Same minimums as benchmarks/onnx_parity.py
+MIN_COSINE = 0.999
+MIN_COSINE_INT8 = 0.95
+
+SENTENCES = [
+    "What is the warranty period of the product?",
+    "The access code for unit K123-456 is 7781.",
+    "Refunds are issued within 14 days of receiving the returned item, provided it is unused "
+    "and in its original packaging; shipping costs are not refunded.",
+    "Table 3",
+    "def chunk_text(self, text: str, filename: str) -> List[Dict[str, Any]]:",
+    "Die Garantie gilt zwei Jahre ab Kaufdatum.",
+]
+
+
+@pytest.fixture(scope="module")
+def reference():
+    model = EmbeddingGenerator(MODEL_NAME, backend="torch").model
+    return np.asarray(model.encode(SENTENCES, convert_to_numpy=True), dtype=np.float32)
+
+
+@pytest.fixture(scope="module")
+def cache_dir(tmp_path_factory):
+    return str(tmp_path_factory.mktemp("onnx"))
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return (a * b).sum(axis=1)
+
+
+@pytest.mark.parametrize("quantize, minimum", [(False, MIN_COSINE), (True, MIN_COSINE_INT8)])
+def test_onnx_matches_torch(reference, cache_dir, quantize, minimum):
+    encoder = OnnxEncoder(MODEL_NAME, cache_dir=cache_dir, quantize=quantize, intra_op_threads=1)
+    embeddings = encoder.encode(SENTENCES, batch_size=4)
+    
+    assert embeddings.shape == reference.shape
+    assert cosine(embeddings, reference).min() >= minimum
+
+
+def test_onnx_batching_does_not_change_embeddings(cache_dir):
+    encoder = OnnxEncoder(MODEL_NAME, cache_dir=cache_dir, intra_op_threads=1)
+    one_by_one = np.stack([encoder.encode(sentence) for sentence in SENTENCES])
+    batched = encoder.encode(SENTENCES, batch_size=len(SENTENCES))
+    
+    assert np.allclose(one_by_one, batched, atol=1e-5)
@@ -1,30 +1,199 @@
+import logging
 import chromadb
+import numpy as np
 from chromadb.utils import embedding_functions
-from typing import List, Dict, Any, Optional, Union
+from typing import List, Dict, Any, Optional, Union, Tuple
+from concurrent.futures import ThreadPoolExecutor
 import os
+import threading
 
-class VectorDB:
-    def __init__(self, persist_directory: str = "./chroma_db"):
+from pdf_processor import assign_chunk_ids, source_hash
+from vector_store import VectorStore
+
+logger = logging.getLogger(__name__)
+
+# Collection holding every chunk when the DB is not partitioned
+GLOBAL_COLLECTION = "pdf_documents"
+# Prefix of the per-source collections of a partitioned DB
+PARTITION_PREFIX = "src_"
+# Written once a DB is partitioned; from then on it can only be opened partitioned
+PARTITIONED_MARKER = "partitioned"
+
+def chunk_metadata(chunk: Dict[str, Any]) -> Dict[str, Any]:
+    """Metadata stored with a chunk; Chroma rejects None values, so absent fields are left out"""
+    metadata = {"source": chunk["source"], "chunk_size": chunk["chunk_size"]}
+    for key in ("chunk_index", "token_count"):
+        if chunk.get(key) is not None:
+            metadata[key] = chunk[key]
+    return metadata
+
+
+class VectorDB(VectorStore):
+    def __init__(
+        self,
+        persist_directory: str = "./chroma_db",
+        partitioned: Optional[bool] = None,
+        query_workers: Optional[int] = None
+    ):
         """
         Initialize the vector database with ChromaDB
         
+        By default all chunks share one collection and source filters are a
+        metadata where-clause. When partitioned, every source gets its own
+        collection (and HNSW graph): a source-filtered query only searches
+        that graph, and an unfiltered query searches all partitions
+        concurrently and merges their top results.
+        
         Args:
             persist_directory: Directory to persist the database
+            partitioned: One collection per source (defaults to env VECTOR_DB_PARTITIONED).
+                Partitioning an existing DB moves its chunks out of the single
+                collection, so it is one-way
+            query_workers: Threads for fanning out unfiltered partitioned queries
+                (defaults to env VECTOR_DB_QUERY_WORKERS)
+        
+        Raises:
+            RuntimeError: If opening a partitioned DB unpartitioned
         """
-        print(f"Initializing ChromaDB with persistence at {persist_directory}")
+        logger.info(f"Initializing ChromaDB with persistence at {persist_directory}")
         os.makedirs(persist_directory, exist_ok=True)
+        self.persist_directory = persist_directory
+        self.partitioned = (
+            partitioned if partitioned is not None
+            else os.getenv("VECTOR_DB_PARTITIONED", "false").lower() == "true"
+        )
         
         # Initialize the ChromaDB client with persistence
         self.client = chromadb.PersistentClient(path=persist_directory)
         
-        # Create or get the collection
-        self.collection = self.client.get_or_create_collection(
-            name="pdf_documents",
-            metadata={"hnsw:space": "cosine"}  # Use cosine similarity
-        )
+        self._init_change_tracking()
         
-        print(f"ChromaDB initialized with collection 'pdf_documents'")
-        print(f"Collection has {self.collection.count()} documents")
+        if self.partitioned:
+            self.collection = None
+            self._partitions = {}
+            self._partitions_lock = threading.Lock()
+            for collection in self.client.list_collections():
+                if collection.name.startswith(PARTITION_PREFIX):
+                    self._partitions[collection.name[len(PARTITION_PREFIX):]] = collection
+            self.query_executor = ThreadPoolExecutor(
+                max_workers=query_workers or int(os.getenv("VECTOR_DB_QUERY_WORKERS", "4")),
+                thread_name_prefix="vector-query"
+            )
+            self._migrate_unpartitioned()
+            
+            logger.info(f"ChromaDB initialized with {len(self._partitions)} source partitions")
+        else:
+            if os.path.exists(os.path.join(persist_directory, PARTITIONED_MARKER)):
+                raise RuntimeError(
+                    f"The vector DB in {persist_directory} has been partitioned by source, which cannot be "
+                    "undone; set VECTOR_DB_PARTITIONED=true to open it"
+                )
+            # Create or get the collection
+            self.collection = self.client.get_or_create_collection(
+                name=GLOBAL_COLLECTION,
+                metadata={"hnsw:space": "cosine"}  # Use cosine similarity
+            )
+            
+            logger.info(f"ChromaDB initialized with collection '{GLOBAL_COLLECTION}'")
+        logger.info(f"Collection has {self.count()} documents")
+    
+    def _partition(self, source: str, create: bool = False):
+        """The collection holding a source's chunks, or None if it has none"""
+        key = source_hash(source)
+        collection = self._partitions.get(key)
+        if collection is None and create:
+            with self._partitions_lock:
+                collection = self._partitions.get(key)
+                if collection is None:
+                    collection = self.client.get_or_create_collection(
+                        name=PARTITION_PREFIX + key,
+                        metadata={"hnsw:space": "cosine", "source": source}
+                    )
+                    self._partitions[key] = collection
+        return collection
+    
+    def _collections_for_ids(self, ids: List[str]) -> List[Tuple[Any, List[str]]]:
+        """
+        Group chunk IDs by the collection holding them
+        
+        Chunk IDs start with their source's hash. IDs that do not map to a
+        partition (e.g. from before stable IDs) are looked up in all of them.
+        """
+        if not self.partitioned:
+            return [(self.collection, list(ids))]
+        
+        groups = {}
+        unknown = []
+        for chunk_id in ids:
+            collection = self._partitions.get(chunk_id.split("_", 1)[0])
+            if collection is None:
+                unknown.append(chunk_id)
+            else:
+                groups.setdefault(collection.name, (collection, []))[1].append(chunk_id)
+        if unknown:
+            for collection in list(self._partitions.values()):
+                groups.setdefault(collection.name, (collection, []))[1].extend(unknown)
+        return list(groups.values())
+    
+    def _migrate_unpartitioned(self) -> None:
+        """
+        Move the chunks of an existing single-collection DB into source partitions
+        
+        The single collection is only deleted once the marker recording the
+        finished migration is written. A migration cut short is simply run
+        again, as the copies are upserts.
+        """
+        marker = os.path.join(self.persist_directory, PARTITIONED_MARKER)
+        try:
+            legacy = self.client.get_collection(GLOBAL_COLLECTION)
+        except ValueError:
+            legacy = None
+        if legacy is None or os.path.exists(marker):
+            self._write_partitioned_marker(marker)
+            if legacy is not None:
+                # Left over from a migration that stopped after its marker was written
+                self.client.delete_collection(GLOBAL_COLLECTION)
+            return
+        
+        total = legacy.count()
+        logger.info(f"Moving {total} chunks from '{GLOBAL_COLLECTION}' into source partitions")
+        batch_size = 1000
+        for offset in range(0, total, batch_size):
+            results = legacy.get(
+                limit=batch_size,
+                offset=offset,
+                include=["documents", "metadatas", "embeddings"]
+            )
+            by_source = {}
+            for row in zip(results["ids"], results["documents"], results["embeddings"], results["metadatas"]):
+                by_source.setdefault(row[3].get("source", "unknown"), []).append(row)
+            for source, rows in by_source.items():
+                ids, documents, embeddings, metadatas = (list(column) for column in zip(*rows))
+                self._upsert(self._partition(source, create=True), ids, documents, embeddings, metadatas)
+        self._write_partitioned_marker(marker)
+        self.client.delete_collection(GLOBAL_COLLECTION)
+        logger.info(f"Moved {total} chunks into {len(self._partitions)} source partitions")
+    
+    @staticmethod
+    def _write_partitioned_marker(marker: str) -> None:
+        if not os.path.exists(marker):
+            with open(marker, "w") as f:
+                f.write("Chunks are stored in one collection per source; open with VECTOR_DB_PARTITIONED=true\n")
+    
+    def _upsert(self, collection, ids, documents, embeddings, metadatas) -> None:
+        # Add to collection in batches to avoid memory issues with large uploads
+        batch_size = 100
+        for i in range(0, len(ids), batch_size):
+            end_idx = min(i + batch_size, len(ids))
+            logger.debug(f"Adding batch {i//batch_size + 1}: {end_idx - i} chunks")
+            
+            # Add batch to collection, overwriting chunks that already exist
+            collection.upsert(
+                ids=ids[i:end_idx],
+                documents=documents[i:end_idx],
+                embeddings=embeddings[i:end_idx],
+                metadatas=metadatas[i:end_idx]
+            )
     
     def add_chunks(self, chunks: List[Dict[str, Any]]) -> None:
         """
@@ -34,43 +203,169 @@ class VectorDB:
             chunks: List of chunks with text, embedding, and metadata
         """
         if not chunks:
-            print("No chunks to add to vector DB")
+            logger.debug("No chunks to add to vector DB")
             return
-            
-        print(f"Adding {len(chunks)} chunks to vector DB")
         
-        # Prepare data for ChromaDB
-        ids = [f"doc_{i}_{hash(chunk['text'])}" for i, chunk in enumerate(chunks)]
-        documents = [chunk["text"] for chunk in chunks]
-        embeddings = [chunk["embedding"] for chunk in chunks]
-        metadatas = [{
-            "source": chunk["source"],
-            "chunk_size": chunk["chunk_size"]
-        } for chunk in chunks]
+        logger.debug(f"Adding {len(chunks)} chunks to vector DB")
         
-        # Add to collection in batches to avoid memory issues with large uploads
-        batch_size = 100
-        for i in range(0, len(chunks), batch_size):
-            end_idx = min(i + batch_size, len(chunks))
-            batch_ids = ids[i:end_idx]
-            batch_documents = documents[i:end_idx]
-            batch_embeddings = embeddings[i:end_idx]
-            batch_metadatas = metadatas[i:end_idx]
-            
-            print(f"Adding batch {i//batch_size + 1}: {len(batch_ids)} chunks")
-            
-            # Add batch to collection
-            self.collection.add(
-                ids=batch_ids,
-                documents=batch_documents,
-                embeddings=batch_embeddings,
-                metadatas=batch_metadatas
+        # Content-derived IDs keep re-uploads idempotent
+        assign_chunk_ids(chunks)
+        
+        if self.partitioned:
+            by_source = {}
+            for chunk in chunks:
+                by_source.setdefault(chunk["source"], []).append(chunk)
+            groups = [(self._partition(source, create=True), group) for source, group in by_source.items()]
+        else:
+            groups = [(self.collection, chunks)]
+        
+        for collection, group in groups:
+            # Prepare data for ChromaDB, which only takes embeddings as lists of floats
+            self._upsert(
+                collection,
+                [chunk["id"] for chunk in group],
+                [chunk["text"] for chunk in group],
+                np.asarray([chunk["embedding"] for chunk in group], dtype=np.float32).tolist(),
+                [chunk_metadata(chunk) for chunk in group]
             )
         
-        print(f"Successfully added chunks to vector DB. Collection now has {self.collection.count()} documents")
+        self._update_lexical_index(added=chunks)
+        self._notify_changed()
+        logger.debug(f"Successfully added chunks to vector DB. Collection now has {self.count()} documents")
+    
+    def _collections(self) -> List[Any]:
+        return list(self._partitions.values()) if self.partitioned else [self.collection]
+    
+    def count(self) -> int:
+        """Number of chunks in the collection (or all partitions)"""
+        return sum(collection.count() for collection in self._collections())
+    
+    def peek(self, limit: int = 3) -> List[Dict[str, Any]]:
+        """A few stored chunks with their text and metadata, for diagnostics"""
+        samples = []
+        for collection in self._collections():
+            if len(samples) >= limit:
+                break
+            results = collection.get(limit=limit - len(samples))
+            samples.extend(
+                {"id": chunk_id, "text": document, "metadata": metadata}
+                for chunk_id, document, metadata in zip(results["ids"], results["documents"], results["metadatas"])
+            )
+        return samples
+    
+    def get_chunks(self, ids: List[str]) -> List[Dict[str, Any]]:
+        """
+        Fetch stored chunks by ID
+        
+        Args:
+            ids: Chunk IDs to fetch
+        
+        Returns:
+            Chunks with id, text and metadata, in the order of ids; unknown IDs are skipped
+        """
+        if not ids:
+            return []
+        found = {}
+        for collection, group_ids in self._collections_for_ids(ids):
+            results = collection.get(ids=group_ids, include=["documents", "metadatas"])
+            for chunk_id, document, metadata in zip(results["ids"], results["documents"], results["metadatas"]):
+                found[chunk_id] = {"id": chunk_id, "text": document, "metadata": metadata}
+        return [found[chunk_id] for chunk_id in ids if chunk_id in found]
+    
+    def get_chunk_ids_by_source(self) -> Dict[str, List[str]]:
+        """
+        Scan the whole collection and group chunk IDs by source
+        
+        Only meant for one-off maintenance such as backfilling the document
+        catalog; regular lookups should go through the DocumentRegistry.
+        """
+        by_source = {}
+        for collection in self._collections():
+            results = collection.get(include=["metadatas"])
+            for chunk_id, metadata in zip(results["ids"], results["metadatas"]):
+                by_source.setdefault(metadata.get("source", "unknown"), []).append(chunk_id)
+        return by_source
+    
+    def delete_chunks(self, ids: List[str]) -> None:
+        """
+        Remove chunks from the vector database
+        
+        Args:
+            ids: IDs of the chunks to delete
+        """
+        if not ids:
+            return
+        
+        logger.debug(f"Deleting {len(ids)} chunks from vector DB")
+        batch_size = 100
+        for collection, group_ids in self._collections_for_ids(ids):
+            for i in range(0, len(group_ids), batch_size):
+                collection.delete(ids=group_ids[i:i + batch_size])
+        
+        self._update_lexical_index(deleted=ids)
+        self._notify_changed()
+    
+    def close(self) -> None:
+        if self.partitioned:
+            self.query_executor.shutdown(wait=False)
+        # Stopping the client's system closes its SQLite connections and segment files
+        system = getattr(self.client, "_system", None)
+        if system is not None:
+            system.stop()
+        super().close()
+    
+    def _query_partitions(
+        self,
+        query_embeddings: List[List[float]],
+        n_results: int,
+        filter_source: Optional[str]
+    ) -> Dict[str, Any]:
+        """
+        Query the source partitions and merge the results
+        
+        A filtered query searches only its source's partition. An unfiltered
+        query searches every partition concurrently and keeps the n_results
+        closest chunks per query embedding.
+        """
+        if filter_source:
+            collection = self._partition(filter_source)
+            collections = [collection] if collection is not None else []
+        else:
+            collections = list(self._partitions.values())
+        
+        def search(collection) -> Optional[Dict[str, Any]]:
+            # Chroma rejects n_results larger than the collection
+            size = collection.count()
+            if not size:
+                return None
+            return collection.query(query_embeddings=query_embeddings, n_results=min(n_results, size))
+        
+        if len(collections) == 1:
+            partial_results = [search(collections[0])]
+        else:
+            partial_results = list(self.query_executor.map(search, collections))
+        partial_results = [results for results in partial_results if results is not None]
+        
+        merged = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for position in range(len(query_embeddings)):
+            candidates = []
+            for results in partial_results:
+                candidates.extend(zip(
+                    results["distances"][position],
+                    results["ids"][position],
+                    results["documents"][position],
+                    results["metadatas"][position]
+                ))
+            candidates.sort(key=lambda candidate: candidate[0])
+            top = candidates[:n_results]
+            merged["distances"].append([candidate[0] for candidate in top])
+            merged["ids"].append([candidate[1] for candidate in top])
+            merged["documents"].append([candidate[2] for candidate in top])
+            merged["metadatas"].append([candidate[3] for candidate in top])
+        return merged
     
     def query(
-        self, 
+        self,
         query_embedding: List[float],
         n_results: int = 5,
         filter_source: Optional[str] = None
@@ -82,15 +377,20 @@ class VectorDB:
             query_embedding: Embedding of the query
             n_results: Number of results to return
             filter_source: Filter results by source (filename)
-            
+        
         Returns:
             Dictionary with query results
         """
-        print(f"Querying vector DB for {n_results} results")
+        logger.debug(f"Querying vector DB for {n_results} results")
         if filter_source:
-            print(f"Filtering by source: {filter_source}")
-            
+            logger.debug(f"Filtering by source: {filter_source}")
+        
         try:
+            if self.partitioned:
+                results = self._query_partitions([list(query_embedding)], n_results, filter_source)
+                logger.debug(f"Found {len(results['documents'][0])} matching documents")
+                return results
+            
             # Build query parameters
             query_params = {
                 "query_embeddings": [query_embedding],
@@ -104,13 +404,11 @@ class VectorDB:
             # Execute query
             results = self.collection.query(**query_params)
             
-            print(f"Found {len(results['documents'][0])} matching documents")
+            logger.debug(f"Found {len(results['documents'][0])} matching documents")
             return results
-            
+        
         except Exception as e:
-            print(f"Error querying vector DB: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"Error querying vector DB: {e}")
             
             # Return empty results on error
             return {
@@ -118,4 +416,48 @@ class VectorDB:
                 "metadatas": [[]],
                 "distances": [[]],
                 "ids": [[]]
-            }
\ No newline at end of file
+            }
+    
+    def query_many(
+        self,
+        query_embeddings: List[List[float]],
+        n_results: int = 5,
+        filter_source: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Query the vector database for several embeddings in one call
+        
+        Args:
+            query_embeddings: Embeddings of the queries
+            n_results: Number of results to return per query
+            filter_source: Filter results by source (filename), shared by all queries
+        
+        Returns:
+            Dictionary with one list of results per query under each key
+        """
+        if not query_embeddings:
+            return {"documents": [], "metadatas": [], "distances": [], "ids": []}
+        
+        logger.debug(f"Querying vector DB with {len(query_embeddings)} queries for {n_results} results each")
+        try:
+            if self.partitioned:
+                return self._query_partitions([list(embedding) for embedding in query_embeddings], n_results, filter_source)
+            
+            query_params = {
+                "query_embeddings": [list(embedding) for embedding in query_embeddings],
+                "n_results": n_results
+            }
+            if filter_source:
+                query_params["where"] = {"source": filter_source}
+            
+            return self.collection.query(**query_params)
+        
+        except Exception as e:
+            logger.exception(f"Error querying vector DB: {e}")
+            
+            return {
+                "documents": [[] for _ in query_embeddings],
+                "metadatas": [[] for _ in query_embeddings],
+                "distances": [[] for _ in query_embeddings],
+                "ids": [[] for _ in query_embeddings]
+            }
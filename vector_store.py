@@ -0,0 +1,104 @@
+import logging
+import os
+from typing import Any, Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+class VectorStore:
+    """
+    Behaviour shared by the vector DB backends
+    
+    Backends implement add_chunks, delete_chunks, query, query_many, count,
+    peek, get_chunks and get_chunk_ids_by_source. Every write calls
+    _update_lexical_index and then _notify_changed, so the keyword index and
+    caches keyed on the corpus follow the stored chunks.
+    """
+    
+    def _init_change_tracking(self) -> None:
+        # Bumped whenever the stored chunks change; used to invalidate caches
+        self.version = 0
+        self._listeners = []
+        self.lexical_index = None
+    
+    def attach_lexical_index(self, index) -> None:
+        """
+        Keep a LexicalIndex in step with this store's writes
+        
+        Args:
+            index: LexicalIndex to update on every add_chunks and delete_chunks
+        """
+        self.lexical_index = index
+    
+    def _update_lexical_index(self, added: List[Dict[str, Any]] = (), deleted: List[str] = ()) -> None:
+        if self.lexical_index is None:
+            return
+        if deleted:
+            self.lexical_index.delete_chunks(list(deleted))
+        if added:
+            self.lexical_index.add_chunks([
+                {"id": chunk["id"], "text": chunk["text"], "source": chunk["source"]}
+                for chunk in added
+            ])
+    
+    def all_chunks(self) -> List[Dict[str, Any]]:
+        """Every stored chunk with its text and metadata; for one-off backfills only"""
+        ids = [chunk_id for chunk_ids in self.get_chunk_ids_by_source().values() for chunk_id in chunk_ids]
+        return self.get_chunks(ids)
+    
+    def close(self) -> None:
+        """Release files and threads held by the store"""
+        if self.lexical_index is not None:
+            self.lexical_index.close()
+    
+    def add_listener(self, callback: Callable[[], None]) -> None:
+        """
+        Register a callback run after every change to the stored chunks
+        
+        Args:
+            callback: Function called with no arguments
+        """
+        self._listeners.append(callback)
+    
+    def _notify_changed(self) -> None:
+        self.version += 1
+        for callback in self._listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Error in vector DB change listener: {e}")
+
+
+VECTOR_DB_BACKENDS: List[str] = ["chroma", "numpy"]
+
+
+def create_vector_db(persist_directory: str = "./chroma_db", backend: str = None) -> VectorStore:
+    """
+    Create the configured vector DB backend
+    
+    Args:
+        persist_directory: Directory to persist the database
+        backend: "chroma" or "numpy" (defaults to env VECTOR_DB_BACKEND, then "chroma")
+        
+    Returns:
+        A VectorStore with the add_chunks/query interface, with a LexicalIndex
+        attached unless LEXICAL_INDEX_ENABLED is false
+    """
+    backend = (backend or os.getenv("VECTOR_DB_BACKEND", "chroma")).lower()
+    if backend == "chroma":
+        from vector_db import VectorDB
+        db = VectorDB(persist_directory=persist_directory)
+    elif backend == "numpy":
+        from numpy_vector_db import NumpyVectorDB
+        db = NumpyVectorDB(persist_directory=os.path.join(persist_directory, "numpy_index"))
+    else:
+        raise ValueError(f"Unknown vector DB backend '{backend}', expected one of {VECTOR_DB_BACKENDS}")
+    
+    # Keyword index for hybrid retrieval, stored next to the vectors it mirrors
+    if os.getenv("LEXICAL_INDEX_ENABLED", "true").lower() == "true":
+        from lexical_index import LexicalIndex
+        db.attach_lexical_index(LexicalIndex(
+            os.path.join(db.persist_directory, "lexical_index.sqlite3"),
+            backfill=db.all_chunks
+        ))
+    return db
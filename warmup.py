@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class WarmUp:
+    def __init__(self):
+        """
+        Background initialization of lazily loaded components, behind a readiness probe
+        
+        Components load themselves on first use, so the server can bind its
+        port as soon as the app is imported. The registered steps (loading
+        models, opening the default index) then run one after another on a
+        worker thread; until all of them have finished, ready is False and a
+        load balancer should keep traffic away. Requests that arrive earlier
+        still work, they just wait for whatever they need to load.
+        """
+        self.steps: List[Tuple[str, Callable[[], Any]]] = []
+        self.status = "pending"
+        self.error: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+        self.created_at = time.perf_counter()
+        self.ready_after: Optional[float] = None
+        self._lock = threading.Lock()
+        self._task = None
+    
+    def add(self, name: str, step: Callable[[], Any]) -> None:
+        """
+        Register a step to run at startup
+        
+        Args:
+            name: Name reported by the readiness probe
+            step: Function called with no arguments on the warm-up thread
+        """
+        self.steps.append((name, step))
+    
+    @property
+    def ready(self) -> bool:
+        return self.status == "ready"
+    
+    def run(self) -> None:
+        """Run every step in order; a failing step leaves the service not ready"""
+        with self._lock:
+            self.status = "running"
+        for name, step in self.steps:
+            start = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                logger.exception(f"Warm-up step '{name}' failed")
+                with self._lock:
+                    self.status = "failed"
+                    self.error = f"{name}: {e}"
+                return
+            self.timings[name] = round(time.perf_counter() - start, 3)
+            logger.info(f"Warm-up step '{name}' finished in {self.timings[name]:.2f} seconds")
+        with self._lock:
+            self.status = "ready"
+            self.ready_after = round(time.perf_counter() - self.created_at, 3)
+        logger.info(f"Ready {self.ready_after:.2f} seconds after start")
+    
+    def start(self) -> None:
+        """Run the steps on a worker thread without blocking the event loop"""
+        self._task = asyncio.get_running_loop().run_in_executor(None, self.run)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "status": self.status,
+                "error": self.error,
+                "pending": [name for name, _ in self.steps if name not in self.timings],
+                "step_seconds": dict(self.timings),
+                "ready_after_seconds": self.ready_after
+            }
@@ -0,0 +1,372 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+from cache import TTLCache
+from document_registry import DocumentRegistry
+from vector_store import VectorStore, create_vector_db
+
+logger = logging.getLogger(__name__)
+
+WORKSPACE_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+
+
+class WorkspaceLimitExceeded(Exception):
+    """Raised when a workspace is over one of its quotas"""
+
+
+def open_storage(persist_directory: str) -> Tuple[VectorStore, DocumentRegistry]:
+    """
+    Open a workspace's vector DB and the catalog of its documents
+    
+    Returns:
+        Tuple of (vector DB, document registry)
+    """
+    vector_db = create_vector_db(persist_directory=persist_directory)
+    # Catalog kept with the vector DB it describes; chunks stored before it existed are backfilled once
+    registry = DocumentRegistry(
+        os.path.join(vector_db.persist_directory, "document_registry.sqlite3"),
+        backfill=vector_db.get_chunk_ids_by_source
+    )
+    return vector_db, registry
+
+
+class Workspace:
+    def __init__(
+        self,
+        name: str,
+        persist_directory: str,
+        max_chunks: int,
+        max_concurrent_requests: int,
+        storage: Callable[[str], Tuple[VectorStore, DocumentRegistry]] = open_storage
+    ):
+        """
+        One tenant's isolated index, document catalog and answer cache
+        
+        Args:
+            name: Workspace name
+            persist_directory: Directory holding the workspace's vector DB and catalog
+            max_chunks: Chunks the workspace may store (0 for no limit); uploads are
+                rejected once it is full and ingestion fails files that do not fit
+            max_concurrent_requests: Requests served at once before new ones are rejected (0 for no limit)
+            storage: Opens the vector DB and catalog of a directory (open_storage,
+                or a model service's proxies)
+        """
+        self.name = name
+        self.max_chunks = max_chunks
+        self.max_concurrent_requests = max_concurrent_requests
+        
+        self.vector_db, self.registry = storage(persist_directory)
+        self.answer_cache = TTLCache(
+            max_size=int(os.getenv("ANSWER_CACHE_SIZE", "512")),
+            ttl=float(os.getenv("ANSWER_CACHE_TTL", "600"))
+        )
+        self.vector_db.add_listener(self.answer_cache.clear)
+        
+        self._lock = threading.Lock()
+        self._active_requests = 0
+        # Requests and queued ingestion jobs that need the workspace to stay loaded
+        self._pins = 0
+        # Chunks being embedded or written by ingestion, not yet in the vector DB's count
+        self._quota_lock = threading.Lock()
+        self._reserved_chunks = 0
+    
+    def pin(self) -> None:
+        """Keep the workspace loaded until a matching unpin()"""
+        with self._lock:
+            self._pins += 1
+    
+    def unpin(self) -> None:
+        with self._lock:
+            self._pins -= 1
+    
+    @property
+    def pinned(self) -> bool:
+        return self._pins > 0
+    
+    def begin_request(self) -> None:
+        """
+        Count a request against the concurrency limit and pin the workspace
+        
+        Raises:
+            WorkspaceLimitExceeded: If the workspace is already serving its maximum
+        """
+        with self._lock:
+            if self.max_concurrent_requests and self._active_requests >= self.max_concurrent_requests:
+                raise WorkspaceLimitExceeded(
+                    f"Workspace '{self.name}' is already serving {self.max_concurrent_requests} requests"
+                )
+            self._active_requests += 1
+            self._pins += 1
+    
+    def end_request(self) -> None:
+        with self._lock:
+            self._active_requests -= 1
+            self._pins -= 1
+    
+    def num_chunks(self) -> int:
+        """Chunks stored in the workspace's vector DB; what the quota is enforced on"""
+        return self.vector_db.count()
+    
+    def check_chunk_quota(self) -> None:
+        """
+        Raises:
+            WorkspaceLimitExceeded: If the workspace has no room for more chunks,
+                counting those claimed by ingestion jobs still running
+        """
+        if not self.max_chunks:
+            return
+        with self._quota_lock:
+            full = self.num_chunks() + self._reserved_chunks >= self.max_chunks
+        if full:
+            raise WorkspaceLimitExceeded(
+                f"Workspace '{self.name}' has reached its limit of {self.max_chunks} chunks"
+            )
+    
+    def reserve_chunks(self, num_chunks: int) -> None:
+        """
+        Claim room for chunks about to be written; pair with release_chunks()
+        
+        Chunks other ingestion jobs have claimed count as well, so uploads
+        processed together cannot overshoot the quota between them.
+        
+        Raises:
+            WorkspaceLimitExceeded: If the chunks would take the workspace over its quota
+        """
+        if not self.max_chunks:
+            return
+        with self._quota_lock:
+            stored = self.num_chunks()
+            if stored + self._reserved_chunks + num_chunks > self.max_chunks:
+                raise WorkspaceLimitExceeded(
+                    f"Workspace '{self.name}' would exceed its limit of {self.max_chunks} chunks"
+                )
+            self._reserved_chunks += num_chunks
+    
+    def release_chunks(self, num_chunks: int) -> None:
+        """Give back a claim once its chunks are written (or failed to be)"""
+        if not self.max_chunks:
+            return
+        with self._quota_lock:
+            self._reserved_chunks -= num_chunks
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "documents": len(self.registry),
+            "active_requests": self._active_requests,
+            "pins": self._pins,
+            "reserved_chunks": self._reserved_chunks,
+            "answer_cache": self.answer_cache.stats(),
+            "corpus_version": self.vector_db.version
+        }
+    
+    def close(self) -> None:
+        self.vector_db.close()
+        self.registry.close()
+
+
+class WorkspaceManager:
+    def __init__(
+        self,
+        root: Optional[str] = None,
+        default_workspace: Optional[str] = None,
+        default_directory: str = "./chroma_db",
+        max_loaded: Optional[int] = None,
+        max_chunks: Optional[int] = None,
+        max_concurrent_requests: Optional[int] = None,
+        storage: Callable[[str], Tuple[VectorStore, DocumentRegistry]] = open_storage
+    ):
+        """
+        Lazily loaded, LRU-evicted set of tenant workspaces
+        
+        A workspace's vector DB and catalog are opened on first use and closed
+        again once it is the least recently used of more than max_loaded
+        loaded workspaces, so memory follows the active workspaces rather than
+        all of them. Workspaces with requests or ingestion jobs in flight are
+        never evicted. Loading a workspace only blocks callers that want the
+        same one, and async callers (aget, abegin_request) load it on a
+        worker thread so the event loop keeps serving other requests.
+        
+        Args:
+            root: Directory holding one subdirectory per workspace (env WORKSPACES_DIR)
+            default_workspace: Workspace used when a request names none (env DEFAULT_WORKSPACE)
+            default_directory: Where the default workspace is stored, so data
+                uploaded before workspaces existed stays in it
+            max_loaded: Workspaces kept loaded at once (env WORKSPACE_MAX_LOADED)
+            max_chunks: Per-workspace chunk quota, 0 for none (env WORKSPACE_MAX_CHUNKS)
+            max_concurrent_requests: Per-workspace request limit, 0 for none
+                (env WORKSPACE_MAX_CONCURRENT_REQUESTS)
+            storage: Opens the vector DB and catalog of a workspace directory
+        """
+        self.root = root or os.getenv("WORKSPACES_DIR", "./workspaces")
+        self.default_workspace = default_workspace or os.getenv("DEFAULT_WORKSPACE", "default")
+        self.default_directory = default_directory
+        self.max_loaded = max_loaded or int(os.getenv("WORKSPACE_MAX_LOADED", "8"))
+        self.max_chunks = max_chunks if max_chunks is not None else int(os.getenv("WORKSPACE_MAX_CHUNKS", "0"))
+        self.max_concurrent_requests = (
+            max_concurrent_requests if max_concurrent_requests is not None
+            else int(os.getenv("WORKSPACE_MAX_CONCURRENT_REQUESTS", "0"))
+        )
+        self.storage = storage
+        
+        self._workspaces: "OrderedDict[str, Workspace]" = OrderedDict()
+        self._lock = threading.RLock()
+        # One lock per workspace name, held while that workspace loads
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self.loads = 0
+        self.evictions = 0
+    
+    def resolve_name(self, name: Optional[str]) -> str:
+        """
+        Validate a workspace name, falling back to the default workspace
+        
+        Raises:
+            ValueError: If the name could not be used as a directory name
+        """
+        name = (name or "").strip() or self.default_workspace
+        if not WORKSPACE_NAME_PATTERN.match(name):
+            raise ValueError(
+                "Workspace names must be 1-64 letters, digits, '-' or '_' and start with a letter or digit"
+            )
+        return name
+    
+    def _directory(self, name: str) -> str:
+        if name == self.default_workspace:
+            return self.default_directory
+        return os.path.join(self.root, name)
+    
+    def get(self, name: Optional[str] = None, pin: bool = False) -> Workspace:
+        """
+        The named workspace, loading it on first use
+        
+        Args:
+            name: Workspace name (None for the default workspace)
+            pin: Pin the workspace before any eviction can run; the caller must unpin() it
+        
+        Raises:
+            ValueError: If the name is invalid
+        """
+        return self._acquire(name, lambda workspace: workspace.pin() if pin else None)
+    
+    def begin_request(self, name: Optional[str] = None) -> Workspace:
+        """
+        The named workspace with a request counted against its limit; pair with end_request()
+        
+        Raises:
+            ValueError: If the name is invalid
+            WorkspaceLimitExceeded: If the workspace is serving its maximum number of requests
+        """
+        return self._acquire(name, lambda workspace: workspace.begin_request())
+    
+    async def aget(self, name: Optional[str] = None, pin: bool = False) -> Workspace:
+        """get() for async callers; a workspace that is not loaded yet is loaded on a worker thread"""
+        return await self._aacquire(name, lambda workspace: workspace.pin() if pin else None)
+    
+    async def abegin_request(self, name: Optional[str] = None) -> Workspace:
+        """begin_request() for async callers; a workspace that is not loaded yet is loaded on a worker thread"""
+        return await self._aacquire(name, lambda workspace: workspace.begin_request())
+    
+    async def _aacquire(self, name: Optional[str], claim) -> Workspace:
+        name = self.resolve_name(name)
+        workspace = self._claim_loaded(name, claim)
+        if workspace is not None:
+            return workspace
+        return await asyncio.get_running_loop().run_in_executor(None, self._acquire, name, claim)
+    
+    def _claim_loaded(self, name: str, claim) -> Optional[Workspace]:
+        """The workspace if it is loaded, claimed under the lock so it cannot be evicted before the caller uses it"""
+        with self._lock:
+            workspace = self._workspaces.get(name)
+            if workspace is not None:
+                self._workspaces.move_to_end(name)
+                claim(workspace)
+            return workspace
+    
+    def _acquire(self, name: Optional[str], claim) -> Workspace:
+        name = self.resolve_name(name)
+        workspace = self._claim_loaded(name, claim)
+        if workspace is not None:
+            return workspace
+        
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            # Another caller may have loaded it while this one waited
+            workspace = self._claim_loaded(name, claim)
+            if workspace is not None:
+                return workspace
+            
+            # Opened outside the manager lock, so other workspaces stay available meanwhile
+            logger.info(f"Loading workspace '{name}'")
+            workspace = Workspace(
+                name, self._directory(name), self.max_chunks, self.max_concurrent_requests, self.storage
+            )
+            with self._lock:
+                self._workspaces[name] = workspace
+                self.loads += 1
+                claim(workspace)
+                evicted = self._evict(keep=name)
+        
+        for evicted_name, evicted_workspace in evicted:
+            logger.info(f"Evicting idle workspace '{evicted_name}'")
+            evicted_workspace.close()
+        return workspace
+    
+    def _evict(self, keep: str) -> List[Tuple[str, Workspace]]:
+        """
+        Drop least recently used idle workspaces other than keep while more than max_loaded are loaded
+        
+        Returns:
+            The dropped workspaces, for the caller to close outside the lock
+        """
+        evicted = []
+        excess = len(self._workspaces) - self.max_loaded
+        for name, workspace in list(self._workspaces.items()):
+            if excess <= 0:
+                break
+            if workspace.pinned or name == keep:
+                continue
+            del self._workspaces[name]
+            evicted.append((name, workspace))
+            self.evictions += 1
+            excess -= 1
+        return evicted
+    
+    def list_workspaces(self) -> List[str]:
+        """Names of all workspaces stored on disk or loaded"""
+        with self._lock:
+            names = set(self._workspaces)
+        if os.path.isdir(self.root):
+            names.update(
+                entry for entry in os.listdir(self.root)
+                if WORKSPACE_NAME_PATTERN.match(entry) and os.path.isdir(os.path.join(self.root, entry))
+            )
+        names.add(self.default_workspace)
+        return sorted(names)
+    
+    def stats(self) -> Dict[str, Any]:
+        # Workspace stats call into storage, so they are read outside the lock;
+        # the pins keep the snapshotted workspaces from being closed meanwhile
+        with self._lock:
+            loaded = list(self._workspaces.items())
+            for _, workspace in loaded:
+                workspace.pin()
+            stats = {"loaded": {}, "max_loaded": self.max_loaded, "loads": self.loads, "evictions": self.evictions}
+        try:
+            for name, workspace in loaded:
+                workspace_stats = stats["loaded"][name] = workspace.stats()
+                workspace_stats["pins"] -= 1  # Not counting the pin taken here
+        finally:
+            for _, workspace in loaded:
+                workspace.unpin()
+        return stats
+    
+    def close(self) -> None:
+        with self._lock:
+            for workspace in self._workspaces.values():
+                workspace.close()
+            self._workspaces.clear()